@@ -19,6 +19,8 @@ from __future__ import print_function
 import os
 import sys
 
+from contextlib             import contextmanager
+
 from layman.config          import BareConfig
 from layman.dbbase          import UnknownOverlayException, UnknownOverlayMessage
 from layman.db              import DB
@@ -26,8 +28,13 @@ from layman.remotedb        import RemoteDB
 from layman.overlays.source import require_supported
 #from layman.utils import path, delete_empty_directory
 from layman.compatibility   import encode
-from layman.utils           import verify_overlay_src
+from layman.drift           import (check_drift, drift_message, DRIFT_OK,
+    DRIFT_SOURCE, DRIFT_TYPE)
 from layman.mounter         import Mounter
+from layman.locking         import (LockManager, CACHE_LOCK, INSTALLED_LOCK,
+    JOURNAL_LOCK, overlay_lock)
+from layman.syncjournal     import SyncJournal
+from layman.utils           import file_stamp
 
 if sys.hexversion >= 0x30200f0:
     STR = str
@@ -63,11 +70,18 @@ class LaymanAPI(object):
 
         # get installed and available dbs
         self._installed_db = None
+        self._installed_stamp = None
         self._installed_ids = None
         self._available_db = None
         self._available_ids = None
+        self._available_set = None
+        self._installed_set = None
         self._error_messages = []
         self.sync_results = []
+        self._catalog_diff = None
+        self._locks = None
+        self._sync_journal = None
+        self.sync_skipped = []
 
         self.config.set_option('mounts', Mounter(self._get_installed_db,
                                                  self.get_installed,
@@ -81,7 +95,8 @@ class LaymanAPI(object):
         @type ovl: str
         @rtype boolean
         """
-        return ovl in self.get_available()
+        self.get_available()
+        return ovl in self._available_set
 
 
     def is_installed(self, ovl):
@@ -91,7 +106,8 @@ class LaymanAPI(object):
         @type ovl: str
         @rtype boolean
         """
-        return ovl in self.get_installed()
+        self.get_installed()
+        return ovl in self._installed_set
 
 
     @staticmethod
@@ -117,53 +133,59 @@ class LaymanAPI(object):
         repos = self._check_repo_type(repos, "delete_repo")
         results = []
         for ovl in repos:
-            if not self.is_installed(ovl):
-                self.output.error("Repository '"+ovl+"' was not installed")
-                results.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().delete(
-                    self._get_installed_db().select(ovl))
-            except Exception as e:
-                self._error(
-                        "Exception caught removing repository '"+ovl+
-                            "':\n"+str(e))
-            results.append(success)
-            self.get_installed(dbreload=True)
+            with self._lock(overlay_lock(ovl)), self._lock(INSTALLED_LOCK):
+                self._fresh_installed_db()
+                if not self.is_installed(ovl):
+                    self.output.error("Repository '"+ovl+"' was not installed")
+                    results.append(False)
+                    continue
+                success = False
+                try:
+                    success = self._get_installed_db().delete(
+                        self._get_installed_db().select(ovl))
+                except Exception as e:
+                    self._error(
+                            "Exception caught removing repository '"+ovl+
+                                "':\n"+str(e))
+                results.append(success)
+                self.get_installed(dbreload=True)
         if False in results:
             return False
         return True
 
 
-    def add_repos(self, repos, update_news=False):
+    def add_repos(self, repos, update_news=False, jobs=None):
         """installs the seleted repo id
 
         @type repos: list of strings or string
         @param repos: ['repo-id', ...] or 'repo-id'
         @param update_news: bool, defaults to False
+        @param jobs: int, number of repos to check out in parallel,
+                     defaults to the 'jobs' config option or 1
         @rtype dict
         """
         repos = self._check_repo_type(repos, "add_repo")
+        if jobs is None:
+            jobs = int(self.config['jobs'] or 1)
+        if jobs > 1 and len(repos) > 1:
+            return self._add_repos_parallel(repos, update_news, jobs)
         results = []
         for ovl in repos:
-            if self.is_installed(ovl):
-                self.output.error("Repository '"+ovl+"' was already installed")
-                results.append(False)
-                continue
-            if not self.is_repo(ovl):
-                self.output.error(UnknownOverlayMessage(ovl))
-                results.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().add(
-                    self._get_remote_db().select(ovl))
-            except Exception as e:
-                self._error("Exception caught installing repository '"+ovl+
-                    "' : "+str(e))
-            results.append(success)
-            self.get_installed(dbreload=True)
+            # the checkout only holds the lock of its overlay, the
+            # installed lock is taken to check and to record it
+            with self._lock(overlay_lock(ovl)):
+                overlays = self._select_new_repos([ovl], results)
+                if not overlays:
+                    continue
+                try:
+                    if not self._get_installed_db().checkout(overlays[0]):
+                        results.append(False)
+                        continue
+                    results.extend(self._install_repos(overlays).values())
+                except Exception as e:
+                    self._error("Exception caught installing repository '"+ovl+
+                        "' : "+str(e))
+                    results.append(False)
         if (True in results) and update_news:
             self.update_news(repos)
 
@@ -172,6 +194,91 @@ class LaymanAPI(object):
         return True
 
 
+    def _add_repos_parallel(self, repos, update_news, jobs):
+        """installs the repos, checking out up to jobs of them in
+        parallel, see add_repos()
+        """
+        # the same overlay must not be checked out twice at once
+        unique = []
+        seen = set()
+        for ovl in repos:
+            if ovl not in seen:
+                seen.add(ovl)
+                unique.append(ovl)
+        repos = unique
+        results = []
+        with self._overlay_locks(repos):
+            overlays = self._select_new_repos(repos, results)
+            if overlays:
+                try:
+                    added, failed = self._get_installed_db().checkout_many(
+                        overlays, jobs)
+                    results.extend(failed.values())
+                    results.extend(self._install_repos(added).values())
+                except Exception as e:
+                    self._error("Exception caught installing repositories: "
+                        + str(e))
+                    results.append(False)
+        if (True in results) and update_news:
+            self.update_news(repos)
+
+        if False in results:
+            return False
+        return True
+
+
+    def _select_new_repos(self, repos, results):
+        """returns the remote Overlay objects of the repos that can be
+        added, appending False to results for the others.  Holds the
+        installed lock only for the check.
+        """
+        overlays = []
+        with self._lock(INSTALLED_LOCK, shared=True):
+            self._fresh_installed_db()
+            for ovl in repos:
+                if self.is_installed(ovl):
+                    self.output.error("Repository '"+ovl+"' was already installed")
+                    results.append(False)
+                    continue
+                if not self.is_repo(ovl):
+                    self.output.error(UnknownOverlayMessage(ovl))
+                    results.append(False)
+                    continue
+                overlays.append(self._get_remote_db().select(ovl))
+        return overlays
+
+
+    def _install_repos(self, overlays):
+        """records checked out overlays in the installed list and the
+        repo config files under the installed lock
+
+        @rtype dict {'repo-id': bool}
+        """
+        if not overlays:
+            return {}
+        with self._lock(INSTALLED_LOCK):
+            results = self._fresh_installed_db().install(overlays)
+            self.get_installed(dbreload=True)
+        return results
+
+
+    @contextmanager
+    def _overlay_locks(self, repos):
+        """holds the overlay locks of all repos, taken in name order so
+        processes locking overlapping sets cannot deadlock
+        """
+        held = []
+        try:
+            for name in sorted(set(repos)):
+                lock = self._lock(overlay_lock(name))
+                lock.__enter__()
+                held.append(lock)
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.__exit__(None, None, None)
+
+
     def readd_repos(self, repos, update_news=False):
         """reinstalls any given amount of repos
         by deleting them and readding them
@@ -192,19 +299,21 @@ class LaymanAPI(object):
         repos = self._check_repo_type(repos, "disable_repo")
         results = []
         for ovl in repos:
-            if not self.is_repo(ovl):
-                self.output.error(UnknownOverlayMessage(ovl))
-                result.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().disable(
-                    self._get_installed_db().select(ovl))
-            except Exception as e:
-                self._error('Exception caught disabling repository "%(repo)s"'\
-                    ': %(err)s' % ({'repo': ovl, 'err': e}))
-            results.append(success)
-            self.get_installed(dbreload=True)
+            with self._lock(INSTALLED_LOCK):
+                self._fresh_installed_db()
+                if not self.is_repo(ovl):
+                    self.output.error(UnknownOverlayMessage(ovl))
+                    result.append(False)
+                    continue
+                success = False
+                try:
+                    success = self._get_installed_db().disable(
+                        self._get_installed_db().select(ovl))
+                except Exception as e:
+                    self._error('Exception caught disabling repository "%(repo)s"'\
+                        ': %(err)s' % ({'repo': ovl, 'err': e}))
+                results.append(success)
+                self.get_installed(dbreload=True)
         if (True in results) and update_news:
             self.update_news(repos)
 
@@ -217,19 +326,21 @@ class LaymanAPI(object):
         repos = self._check_repo_type(repos, "enable_repo")
         results = []
         for ovl in repos:
-            if not self.is_repo(ovl):
-                self.output.error(UnknownOverlayMessage(ovl))
-                result.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().enable(
-                    self._get_installed_db().select(ovl))
-            except Exception as e:
-                self._error('Exception caught enabling repository "%(repo)s"'\
-                    ': %(err)s' % ({'repo': ovl, 'err': e}))
-            results.append(success)
-            self.get_installed(dbreload=True)
+            with self._lock(INSTALLED_LOCK):
+                self._fresh_installed_db()
+                if not self.is_repo(ovl):
+                    self.output.error(UnknownOverlayMessage(ovl))
+                    result.append(False)
+                    continue
+                success = False
+                try:
+                    success = self._get_installed_db().enable(
+                        self._get_installed_db().select(ovl))
+                except Exception as e:
+                    self._error('Exception caught enabling repository "%(repo)s"'\
+                        ': %(err)s' % ({'repo': ovl, 'err': e}))
+                results.append(success)
+                self.get_installed(dbreload=True)
         if (True in results) and update_news:
             self.update_news(repos)
 
@@ -283,26 +394,7 @@ class LaymanAPI(object):
                 self._error(error)
                 result[ovl] = ('', False, False)
             else:
-                result[ovl] = {
-                    'name': overlay.name,
-                    'owner_name': overlay.owner_name,
-                    'owner_email': overlay.owner_email,
-                    'homepage': overlay.homepage,
-                    'irc': overlay.irc,
-                    'description': [e for e in overlay.descriptions],
-                    'feeds': overlay.feeds,
-                    'sources': [(e.src, e.type, e.branch) \
-                        for e in overlay.sources],
-                    #'src_uris': [e.src for e in overlay.sources],
-                    'src_uris': overlay.source_uris(),
-                    'src_types': overlay.source_types(),
-                    #'src_types': [e.type for e in overlay.sources],
-                    'priority': overlay.priority,
-                    'quality': overlay.quality,
-                    'status': overlay.status,
-                    'official': overlay.is_official(),
-                    'supported': overlay.is_supported(),
-                    }
+                result[ovl] = overlay.to_record()
 
         return result
 
@@ -366,155 +458,176 @@ class LaymanAPI(object):
             return self._get_remote_db().list(verbose=verbose, width=width)
 
 
-    def _verify_overlay_type(self, odb, ordb):
+    def iter_info_list(self, local=True, verbose=False, width=0):
+        """yields the rows of get_info_list() one at a time, in name order,
+        without rendering the whole list first
+
+        @param local: bool (defaults to True)
+        @param verbose: bool(defaults to False)
+        @param width: int (defaults to 0)
+        @rtype generator of tuples (info string, supported, official)
         """
-        Verifies the overlay type against the type reported by
-        remote database.
+        if local:
+            db = self._get_installed_db()
+        else:
+            db = self._get_remote_db()
+        return db.iter_list(verbose=verbose, width=width)
+
+
+    def get_records(self, repos=None, local=True):
+        """yields the recorded information about the repo(s) as plain
+        dictionaries, one repo at a time, see Overlay.to_record()
 
-        @param odb: local database of overlay information.
-        @param ordb: remote database of overlay information.
-        @rtype (boolean, msg)
+        @type repos: list of strings or string
+        @param repos: ['repo-id1', ...] or 'repo-id', defaults to all
+                      repos in name order
+        @param local: bool (defaults to True)
+        @rtype generator of dicts
         """
-        remote_type = ordb.sources[0].type
-        current_type = odb.sources[0].type
-
-        if remote_type not in current_type:
-            msg = 'The overlay type of overlay "%(repo_name)s" seems to have changed.\n'\
-                  'The current overlay type is:\n'\
-                  '\n'\
-                  '  %(current_type)s\n'\
-                  '\n'\
-                  'while the remote overlay is of type:\n'\
-                  '\n'\
-                  '  %(remote_type)s\n'\
-                  '\n'\
-                  'the overlay will be readded using %(remote_type)s' %\
-                  ({
-                      'repo_name': odb.name,
-                      'current_type': current_type,
-                      'remote_type': remote_type,
-                  })
-            return True, msg
-        return False, ''
-
-    def _verify_overlay_source(self, odb, ordb):
+        if local:
+            db = self._get_installed_db()
+        else:
+            db = self._get_remote_db()
+
+        if repos is None:
+            for record in db.records():
+                yield record
+            return
+
+        for ovl in self._check_repo_type(repos, "get_records"):
+            try:
+                overlay = db.select(ovl)
+            except UnknownOverlayException as error:
+                self._error(error)
+                continue
+            yield overlay.to_record()
+
+
+    def query_repos(self, local=False, official=None, supported=None,
+                    quality=None, src_type=None, owner=None, name=None,
+                    description=None, regex=False, sort='name',
+                    reverse=False, offset=0, limit=None):
+        """retrieves a filtered, sorted page of repo records.
+        See DbBase.query() for the filter parameters.
+
+        @param local: bool (defaults to False)
+        @param offset: int, number of matching repos to skip
+        @param limit: int, maximum number of records to return
+        @rtype tuple (int, list of dicts)
+        @return: (total matches, [{'name': str, 'official': bool, ...},...])
         """
-        Verifies the overlay source url against the source url(s)
-        reported by the remote database.
+        if local:
+            db = self._get_installed_db()
+        else:
+            db = self._get_remote_db()
+
+        return db.query(official=official, supported=supported,
+                        quality=quality, src_type=src_type, owner=owner,
+                        name=name, description=description, regex=regex,
+                        sort=sort, reverse=reverse, offset=offset,
+                        limit=limit)
+
 
-        @param odb: local database of overlay information.
-        @param ordb: remote database of overlay information.
-        @rtype (boolean, msg)
+    def check_drift(self, repos=None):
+        """compares the installed repos against the cached remote lists
+        in a single pass, without any network or VCS access
+
+        @type repos: list of strings or string
+        @param repos: ['repo-id1', ...] or 'repo-id', defaults to all
+                      installed repos
+        @rtype dict {'repo-id': {'status': str, 'current_type': str,
+                                 'remote_type': str, 'current_src': str,
+                                 'remote_srcs': [str,...]},...}
+        @return: status is one of 'ok', 'missing', 'type' or 'source'
         """
-        current_src = odb.sources[0].src
-        (available_srcs, valid) = verify_overlay_src(current_src,
-            set(e.src for e in ordb.sources))
-
-        if ordb and odb and not valid:
-            if len(available_srcs) == 1:
-                plural = ''
-                candidates = '  %s' % tuple(available_srcs)[0]
-            else:
-                plural = 's'
-                candidates = '\n'.join(('  %d. %s' % (ovl + 1, v)) \
-                    for ovl, v in enumerate(available_srcs))
-            msg = 'The source of the overlay "%(repo_name)s" seems to have changed.\n'\
-                  'You currently sync from\n'\
-                  '\n'\
-                  '  %(current_src)s\n'\
-                  '\n'\
-                  'while the remote lists report\n'\
-                  '\n'\
-                  '%(candidates)s\n'\
-                  '\n'\
-                  'as correct location%(plural)s.\n'\
-                  '\n'\
-                  'Repo: "%(repo_name)s" was automatically updated...' %\
-                  ({
-                     'repo_name':odb.name,
-                     'current_src':current_src,
-                     'candidates':candidates,
-                     'plural':plural,
-                  })
-            return True, msg, available_srcs
-        return False, '', available_srcs
-
-    def sync(self, repos, output_results=True, update_news=False):
+        if repos is not None:
+            repos = self._check_repo_type(repos, "check_drift")
+        return check_drift(self._get_installed_db().overlays,
+                           self._get_remote_db().overlays, repos)
+
+
+    def sync(self, repos, output_results=True, update_news=False,
+             resume=False, max_age=None, adaptive=False, callback=None,
+             sync_all=False):
         """syncs the specified repo(s) specified by repos
 
+        The outcome of every repo is recorded in the sync journal, see
+        layman.syncjournal.  Only a sync of all repos or a resumed one
+        is a sync run there, so syncing a few repos in between does not
+        end an interrupted run.  With resume or max_age, repos another layman
+        process is syncing at the same time are skipped instead of waited
+        for, so several runs can share the work; the skipped repos are
+        left in self.sync_skipped.
+
         @type repos: list of strings or string
         @param repos: ['repo-id1', ...] or 'repo-id'
         @param output_results: bool, defaults to True
         @param update_news: bool, defaults to False
+        @param resume: bool, continue the last sync run if it was
+                       interrupted, skipping the repos it already synced
+        @param max_age: int, skip repos synced successfully within that
+                        many seconds
+        @param adaptive: bool, back off on repos whose recent syncs
+                         brought no changes, see SyncJournal.schedule()
+        @param callback: function called after each repo with
+                         (repo-id, successes, warnings, fatals), the
+                         message lists of that repo
+        @param sync_all: bool, repos are all the installed repos
         @rtype bool or {'repo-id': bool,...}
         """
-        self.output.debug("API.sync(); repos to sync = %s" % ', '.join((x.decode() if isinstance(x, bytes) else x) for x in repos), 5)
+        self.output.debug(lambda: "API.sync(); repos to sync = %s" % ', '.join((x.decode() if isinstance(x, bytes) else x) for x in repos), 5)
         fatals = []
         warnings = []
         success  = []
+        self.sync_skipped = []
         repos = self._check_repo_type(repos, "sync")
+        journal = self._get_sync_journal()
+        run = sync_all or resume
+        if run:
+            started = journal.begin(resume)
+        since = started if resume else None
+        claim = resume or max_age is not None
+        if claim:
+            due = set(journal.due(repos, since, max_age))
+            self.sync_skipped = [ovl for ovl in repos if ovl not in due]
+            repos = [ovl for ovl in repos if ovl in due]
+            if self.sync_skipped:
+                self.output.info('Skipping %d recently synced overlay(s): %s'
+                    % (len(self.sync_skipped), ', '.join(self.sync_skipped)), 3)
+        if adaptive:
+            due = journal.schedule(repos)
+            dormant = [ovl for ovl in repos if ovl not in due]
+            if dormant:
+                self.output.info('Skipping %d dormant overlay(s): %s'
+                    % (len(dormant), ', '.join(dormant)), 3)
+            self.sync_skipped.extend(dormant)
+            repos = due
         db = self._get_installed_db()
 
+        drift = self.check_drift(repos)
+
         self.output.debug("API.sync(); starting ovl loop", 5)
         for ovl in repos:
-            update_url = False
-            self.output.debug("API.sync(); starting ovl = %s" %ovl, 5)
-            try:
-                #self.output.debug("API.sync(); selecting %s, db = %s" % (ovl, str(db)), 5)
-                odb = db.select(ovl)
-                self.output.debug("API.sync(); %s now selected" %ovl, 5)
-            except UnknownOverlayException as error:
-                #self.output.debug("API.sync(); UnknownOverlayException selecting %s" %ovl, 5)
-                #self._error(str(error))
-                fatals.append((ovl,
-                    'Failed to select overlay "' + ovl + '".\nError was: '
-                    + str(error)))
-                self.output.debug("API.sync(); UnknownOverlayException "
-                    "selecting %s.   continuing to next ovl..." %ovl, 5)
-                continue
-
-            try:
-                self.output.debug("API.sync(); try: self._get_remote_db().select(ovl)", 5)
-                ordb = self._get_remote_db().select(ovl)
-            except UnknownOverlayException:
-                message = 'Overlay "%s" could not be found in the remote lists.\n' \
-                        'Please check if it has been renamed and re-add if necessary.' % ovl
-                warnings.append((ovl, message))
-                (diff_type, update_url) = (False, False)
-            else:
-                self.output.debug("API.sync(); else: self._get_remote_db().select(ovl)", 5)
-
-                (diff_type, type_msg) = self._verify_overlay_type(odb, ordb)
-                (update_url, url_msg, available_srcs) = self._verify_overlay_source(odb, ordb)
-
-                try:
-                    if diff_type:
-                        self.output.debug("API.sync(); starting API.readd_repos(ovl)", 5)
-                        warnings.append((ovl, type_msg))
-                        self.readd_repos(ovl)
-                        success.append((ovl, 'Successfully readded overlay "' + ovl + '".'))
-                    else:
-                        if update_url:
-                            self.output.debug("API.sync() starting db.update(ovl)", 5)
-                            warnings.append((ovl, url_msg))
-                            update_success = db.update(ordb, available_srcs)
-                            if not update_success:
-                                self.output.warn('Failed to update repo...readding', 2)
-                                self.readd_repos(ovl)
-                except Exception as error:
-                    self.output.warn('Failed to perform overlay type or url updates', 2)
-                    self.output.warn('    for Overlay: %s' % ovl, 2)
-                    self.output.warn('    Error was: %s' % str(error))
+            marks = (len(success), len(warnings), len(fatals))
+            # other processes may sync other overlays at the same time
+            with self._lock(overlay_lock(ovl), wait=not claim) as locked:
+                if claim and locked:
+                    # the overlay may have been synced while we waited
+                    journal.load()
+                    locked = journal.is_due(ovl, since, max_age)
+                if not locked:
+                    self.output.info('Skipping overlay "%s", another layman '
+                        'process is syncing it.' % ovl, 3)
+                    self.sync_skipped.append(ovl)
                     continue
-
-            try:
-                    self.output.debug("API.sync(); starting db.sync(ovl)", 5)
-                    db.sync(ovl)
-                    success.append((ovl,'Successfully synchronized overlay "' + ovl + '".'))
-            except Exception as error:
-                fatals.append((ovl,
-                    'Failed to sync overlay "' + ovl + '".\nError was: '
-                    + str(error)))
+                changed = self._sync_repo(db, ovl, drift, success, warnings,
+                                          fatals)
+            journal.record(ovl, changed is not None, changed)
+            if callback is not None:
+                callback(ovl, success[marks[0]:], warnings[marks[1]:],
+                         fatals[marks[2]:])
+        if run:
+            journal.end()
 
         if output_results:
             if success:
@@ -543,6 +656,130 @@ class LaymanAPI(object):
         return fatals == []
 
 
+    def _sync_repo(self, db, ovl, drift, success, warnings, fatals):
+        """syncs a single repo with its overlay lock held, appending
+        (repo-id, message) tuples to the success, warnings and fatals lists
+
+        @rtype bool or None: whether the sync brought changes, None if
+                             the repo was not synced
+        """
+        self.output.debug("API.sync(); starting ovl = %s" %ovl, 5)
+        try:
+            #self.output.debug("API.sync(); selecting %s, db = %s" % (ovl, str(db)), 5)
+            odb = db.select(ovl)
+            self.output.debug("API.sync(); %s now selected" %ovl, 5)
+        except UnknownOverlayException as error:
+            #self.output.debug("API.sync(); UnknownOverlayException selecting %s" %ovl, 5)
+            #self._error(str(error))
+            fatals.append((ovl,
+                'Failed to select overlay "' + ovl + '".\nError was: '
+                + str(error)))
+            self.output.debug("API.sync(); UnknownOverlayException "
+                "selecting %s.   continuing to next ovl..." %ovl, 5)
+            return None
+
+        entry = drift[ovl]
+        status = entry['status']
+        if status != DRIFT_OK:
+            warnings.append((ovl, drift_message(ovl, entry)))
+        try:
+            if status == DRIFT_TYPE:
+                self.output.debug("API.sync(); starting API.readd_repos(ovl)", 5)
+                self.readd_repos(ovl)
+                success.append((ovl, 'Successfully readded overlay "' + ovl + '".'))
+            elif status == DRIFT_SOURCE:
+                self.output.debug("API.sync() starting db.update(ovl)", 5)
+                ordb = self._get_remote_db().select(ovl)
+                with self._lock(INSTALLED_LOCK):
+                    db = self._fresh_installed_db()
+                    update_success = db.update(ordb,
+                        set(entry['remote_srcs']))
+                if not update_success:
+                    self.output.warn('Failed to update repo...readding', 2)
+                    self.readd_repos(ovl)
+        except Exception as error:
+            self.output.warn('Failed to perform overlay type or url updates', 2)
+            self.output.warn('    for Overlay: %s' % ovl, 2)
+            self.output.warn('    Error was: %s' % str(error))
+            return None
+
+        try:
+                self.output.debug("API.sync(); starting db.sync(ovl)", 5)
+                changed = db.sync(ovl)
+                success.append((ovl,'Successfully synchronized overlay "' + ovl + '".'))
+        except Exception as error:
+            changed = self._sync_failover(ovl, success)
+            if changed is None:
+                fatals.append((ovl,
+                    'Failed to sync overlay "' + ovl + '".\nError was: '
+                    + str(error)))
+        return changed
+
+
+    def _sync_failover(self, ovl, success):
+        """syncs a repo whose own source failed from the other sources of
+        the same type the remote lists give for it, healthiest and fastest
+        first.  Each one is tried on the checkout before it is recorded in
+        the installed list, the checkout is pointed back at its own source
+        if none worked.
+
+        @rtype bool or None: see _sync_repo()
+        """
+        try:
+            remote = self._get_remote_db().select(ovl)
+        except UnknownOverlayException:
+            return None
+        db = self._get_installed_db()
+        overlay = db.select(ovl)
+        source = overlay.sources[0]
+        current = source.src
+        alternatives = [s.src for s in remote.sources
+                        if s.type_key == source.type_key and s.src != current]
+        for src in db.stats.rank(alternatives):
+            self.output.warn('Trying alternative source %s for overlay "%s"'
+                '...' % (src, ovl), 2)
+            if not self._point_source(overlay, src):
+                continue
+            try:
+                changed = db.sync(ovl)
+            except Exception as error:
+                self.output.warn(str(error), 2)
+                continue
+            with self._lock(INSTALLED_LOCK):
+                installed = self._fresh_installed_db()
+                # the checkout already points at src, a re-read db
+                # still has the old one
+                installed.select(ovl).set_source(src)
+                if not installed.update(remote, [src]):
+                    self.output.warn('Failed to record source %s for overlay'
+                        ' "%s"' % (src, ovl), 2)
+            success.append((ovl, 'Successfully synchronized overlay "%s" '
+                'from alternative source %s.' % (ovl, src)))
+            return changed
+        if source.src != current:
+            self._point_source(overlay, current)
+        return None
+
+
+    def _point_source(self, overlay, src):
+        """points the source of an installed overlay and, for the types
+        supporting it, its checkout at src without recording it in the
+        installed list
+
+        @rtype bool: whether the checkout could be pointed at src
+        """
+        source = overlay.sources[0]
+        if source.type in self.config.get_option('support_url_updates'):
+            try:
+                if source.update(self.config['storage'], src) != 0:
+                    return False
+            except Exception as error:
+                self.output.warn(str(error), 2)
+                return False
+        overlay.set_source(src)
+        return True
+
+
     def fetch_remote_list(self):
         """
         Fetches the latest remote overlay list.
@@ -551,7 +788,10 @@ class LaymanAPI(object):
         """
 
         try:
-            dbreload, succeeded = self._get_remote_db().cache()
+            with self._lock(CACHE_LOCK):
+                db = self._get_remote_db()
+                dbreload, succeeded = db.cache()
+            self._catalog_diff = db.last_diff
             self.output.debug(
                 'LaymanAPI.fetch_remote_list(); cache updated = %s'
                 % str(dbreload),8)
@@ -559,16 +799,49 @@ class LaymanAPI(object):
             self.output.error('Failed to fetch overlay list!\n Original Error was: '
                     + str(error))
             return False
-        self.get_available(dbreload)
+        if dbreload:
+            # cache() already re-read the updated lists
+            self._available_ids = None
+        self.get_available()
         return succeeded
 
 
+    def get_catalog_diff(self):
+        """returns the changes the last fetch_remote_list() brought in
+
+        @rtype dict or None if the remote list was not fetched
+        @return: {'added': [repo-id,...], 'removed': [repo-id,...],
+                  'renamed': [(old repo-id, new repo-id),...],
+                  'changed': {repo-id: {'sources': (old urls, new urls),
+                                        'types': (old types, new types)}}}
+        """
+        if self._catalog_diff is None:
+            return None
+        return self._catalog_diff.to_dict()
+
+
+    def search(self, terms, limit=None):
+        """searches the cached remote lists for overlays matching
+        all of the given terms
+
+        @type terms: list of strings or string
+        @param limit: int, maximum number of results (defaults to all)
+        @rtype list of tuples [(repo-id, score),...]
+        @return: matching repo ids, best match first
+        """
+        if isinstance(terms, STR):
+            terms = [terms]
+        terms = [encode(i) for i in terms]
+        return self._get_remote_db().search(terms, limit)
+
+
     def get_available(self, dbreload=False):
         """returns the list of available overlays"""
-        self.output.debug('LaymanAPI.get_available() dbreload = %s'
-            % str(dbreload), 8)
+        self.output.debug('LaymanAPI.get_available() dbreload = %s', 8,
+            dbreload)
         if self._available_ids is None or dbreload:
             self._available_ids = self._get_remote_db(dbreload).list_ids()
+            self._available_set = set(self._available_ids)
         return self._available_ids[:] or ['None']
 
 
@@ -576,25 +849,71 @@ class LaymanAPI(object):
         """returns the list of installed overlays"""
         if self._installed_ids is None or dbreload:
             self._installed_ids = self._get_installed_db(dbreload).list_ids()
+            self._installed_set = set(self._installed_ids)
         return self._installed_ids[:]
 
 
     def _get_installed_db(self, dbreload=False):
         """returns the list of installed overlays"""
         if not self._installed_db or dbreload:
-            self._installed_db = DB(self.config)
-        self.output.debug("API._get_installed_db; len(installed) = %s, %s"
-            %(len(self._installed_db.list_ids()), self._installed_db.list_ids()), 5)
+            with self._lock(INSTALLED_LOCK, shared=True):
+                self._installed_db = DB(self.config)
+                self._installed_stamp = file_stamp(self.config['installed'])
+        self.output.debug(lambda: "API._get_installed_db; len(installed) "
+            "= %s, %s" % (len(self._installed_db.overlays),
+                          self._installed_db.list_ids()), 5)
         return self._installed_db
 
 
     def _get_remote_db(self, dbreload=False):
         """returns the list of installed overlays"""
         if self._available_db is None or dbreload:
-            self._available_db = RemoteDB(self.config)
+            with self._lock(CACHE_LOCK, shared=True):
+                self._available_db = RemoteDB(self.config)
         return self._available_db
 
 
+    def _fresh_installed_db(self):
+        """returns the installed db, re-reading it first if another
+        process changed it since it was read.  Call it with the installed
+        lock held before changing the db.
+        """
+        if self._installed_db is None or \
+                file_stamp(self.config['installed']) != self._installed_stamp:
+            self.get_installed(dbreload=True)
+        return self._installed_db
+
+
+    def _lock(self, name, shared=False, wait=True):
+        """returns a context manager holding the named cross-process
+        lock on the storage directory, see layman.locking
+        """
+        if self._locks is None:
+            self._locks = LockManager(
+                os.path.join(self.config['storage'], '.locks'), self.output)
+        return self._locks.lock(name, shared, wait)
+
+
+    def _get_sync_journal(self):
+        """returns the journal of sync runs kept in the storage directory"""
+        if self._sync_journal is None:
+            self._sync_journal = SyncJournal(
+                os.path.join(self.config['storage'], 'sync_journal.json'),
+                self.output, lambda: self._lock(JOURNAL_LOCK))
+        return self._sync_journal
+
+
+    def get_lock_waits(self):
+        """returns how long this instance waited for the cross-process
+        locks held by other layman processes
+
+        @rtype list of tuples [(lock name, 'shared' or 'exclusive', seconds),...]
+        """
+        if self._locks is None:
+            return []
+        return list(self._locks.waits)
+
+
     def reload(self):
         """reloads the installed and remote db's to the data on disk"""
         self.get_available(dbreload=True)
@@ -36,6 +36,9 @@ from argparse import ArgumentParser
 
 from layman.config import BareConfig
 from layman.constants import OFF
+from layman.dbbase import SORT_KEYS
+from layman.overlays.overlay import QUALITY_LEVELS
+from layman.syncjournal import parse_age
 from layman.version import VERSION
 
 
@@ -44,6 +47,7 @@ _USAGE = """
   # it also supports multiple actions
   layman (-a|-d|-r|-s|-i) (OVERLAY|ALL) [ [(-a|-d|-r|-s|-i) (OVERLAY)] ...]
   layman -f [-o URL]
+  layman --search TERM [TERM ...]
   layman (-l|-L|-S)"""
 
 
@@ -95,6 +99,12 @@ class ArgsParser(BareConfig):
                              help = 'Remove the given overlay from your locally inst'
                              'alled overlays. Specify "ALL" to remove all overlays.')
 
+        actions.add_argument('--check',
+                             action = 'store_true',
+                             help = 'Report the installed overlays whose type or '
+                             'source no longer matches the cached remote lists. '
+                             'This does not access the network.')
+
         actions.add_argument('-D',
                              '--disable',
                              nargs = '+',
@@ -114,6 +124,12 @@ class ArgsParser(BareConfig):
                              ' deprecated. The fetch operation will be performed by '
                              'default when you run sync, sync-all, or list.')
 
+        actions.add_argument('--diff',
+                             action = 'store_true',
+                             help = 'Use this with the --fetch switch to report the '
+                             'overlays added, removed, renamed or changed by the '
+                             'fetch.')
+
         actions.add_argument('-i',
                              '--info',
                              nargs = '+',
@@ -135,6 +151,22 @@ class ArgsParser(BareConfig):
                              action = 'store_true',
                              help = 'Do not fetch a remote list of overlays.')
 
+        actions.add_argument('--jobs',
+                             action = 'store',
+                             type = int,
+                             help = 'Use this with the --add switch to check out up'
+                             ' to this many overlays in parallel. Defaults to the '
+                             '"jobs" config option or 1.')
+
+        actions.add_argument('--probe',
+                             action = 'store_true',
+                             dest = 'probe_sources',
+                             default = None,
+                             help = 'Use this with the --add switch to probe all '
+                             'sources of an overlay in parallel and add it from '
+                             'the fastest one that answers. Defaults to the '
+                             '"probe_sources" config option.')
+
         actions.add_argument('-p',
                              '--priority',
                              action = 'store',
@@ -150,6 +182,12 @@ class ArgsParser(BareConfig):
                              ' remote list to your locally installed overlays... Specify'
                              ' "ALL" to re-add all local overlays.')
 
+        actions.add_argument('--search',
+                             nargs = '+',
+                             help = 'Search the remote list for overlays whose name,'
+                             ' description, owner, homepage or feeds match all of '
+                             'the given terms. Best matches are listed first.')
+
         actions.add_argument('-s',
                              '--sync',
                              nargs = '+',
@@ -161,6 +199,102 @@ class ArgsParser(BareConfig):
                              action = 'store_true',
                              help = 'Update all overlays.')
 
+        actions.add_argument('--resume',
+                             action = 'store_true',
+                             help = 'Use this with the --sync or --sync-all switch '
+                             'to continue an interrupted sync run, skipping the '
+                             'overlays it already synced.')
+
+        actions.add_argument('--max-age',
+                             type = parse_age,
+                             metavar = 'AGE',
+                             help = 'Use this with the --sync or --sync-all switch '
+                             'to skip overlays synced successfully within AGE, '
+                             'given in seconds or with an s, m, h or d suffix.')
+
+        actions.add_argument('--adaptive',
+                             action = 'store_true',
+                             help = 'Use this with the --sync or --sync-all switch '
+                             'to sync the overlays that changed recently on every '
+                             'run and dormant ones less and less often.')
+
+        actions.add_argument('--force',
+                             action = 'store_true',
+                             help = 'Use this with the --sync or --sync-all switch '
+                             'to sync all selected overlays, overriding '
+                             '--adaptive and --max-age.')
+
+        #-----------------------------------------------------------------
+        # List filtering Options
+
+        list_opts = self.parser.add_argument_group('<List filtering options>')
+
+        list_opts.add_argument('--official',
+                               action = 'store_true',
+                               dest = 'filter_official',
+                               help = 'Use this with --list or --list-local to '
+                               'only list official overlays.')
+
+        list_opts.add_argument('--supported',
+                               action = 'store_true',
+                               dest = 'filter_supported',
+                               help = 'Use this with --list or --list-local to '
+                               'only list overlays that are supported on this '
+                               'system.')
+
+        list_opts.add_argument('--quality',
+                               nargs = '+',
+                               dest = 'filter_quality',
+                               choices = QUALITY_LEVELS,
+                               help = 'Only list overlays of the given quality '
+                               'level(s).')
+
+        list_opts.add_argument('--type',
+                               nargs = '+',
+                               dest = 'filter_type',
+                               help = 'Only list overlays using the given source '
+                               'type(s), e.g. "git".')
+
+        list_opts.add_argument('--owner',
+                               action = 'store',
+                               dest = 'filter_owner',
+                               help = 'Only list overlays whose owner name or '
+                               'email contains OWNER.')
+
+        list_opts.add_argument('--name',
+                               action = 'store',
+                               dest = 'filter_name',
+                               help = 'Only list overlays whose name contains '
+                               'NAME.')
+
+        list_opts.add_argument('--description',
+                               action = 'store',
+                               dest = 'filter_description',
+                               help = 'Only list overlays whose description '
+                               'contains DESCRIPTION.')
+
+        list_opts.add_argument('--regex',
+                               action = 'store_true',
+                               dest = 'filter_regex',
+                               help = 'Treat the --owner, --name and --descript'
+                               'ion values as regular expressions.')
+
+        list_opts.add_argument('--sort',
+                               action = 'store',
+                               choices = sorted(SORT_KEYS),
+                               help = 'Sort the listed overlays by name, priority'
+                               ' or quality [default: name].')
+
+        list_opts.add_argument('--offset',
+                               action = 'store',
+                               type = int,
+                               help = 'Skip the first OFFSET matching overlays.')
+
+        list_opts.add_argument('--limit',
+                               action = 'store',
+                               type = int,
+                               help = 'List at most LIMIT overlays.')
+
         #-----------------------------------------------------------------
         # Additional Options
 
@@ -215,6 +349,14 @@ class ArgsParser(BareConfig):
                               'messages will be selected, 10 selects all debugging me'
                               'ssages. Default is "4".')
 
+        out_opts.add_argument('--format',
+                              action = 'store',
+                              choices = ['text', 'json', 'jsonl'],
+                              help = 'Print the results of --list, --list-local, --info a'
+                              'nd --sync as machine readable records: "json" prints a'
+                              ' JSON array, "jsonl" one JSON object per line. All oth'
+                              'er messages go to stderr. Default is "text".')
+
         out_opts.add_argument('-k',
                               '--nocheck',
                               action = 'store_true',
@@ -330,8 +472,20 @@ class ArgsParser(BareConfig):
         elif self.options['quietness']:
             self.set_option('quietness', self.options['quietness'])
 
+        # self.options and self.defaults were changed directly above
+        self.invalidate()
+
 
-    def __getitem__(self, key):
+    def _snapshot_keys(self):
+        names = list(self.options)
+        if self.config:
+            names.extend(self.config.options('MAIN'))
+        names.extend(self._options)
+        names.extend(self.defaults)
+        return names
+
+
+    def _resolve(self, key):
 
         if key == 'storage':
             storage = ''
@@ -357,20 +511,20 @@ class ArgsParser(BareConfig):
             if len(overlays):
                 return  overlays
 
-        self.output.debug('ARGSPARSER: Retrieving options option: %s' % key, 9)
+        self.output.debug('ARGSPARSER: Retrieving options option: %s', 9, key)
 
         if (key in self.options.keys()
             and not self.options[key] is False):
             return self.options[key]
 
-        self.output.debug('ARGSPARSER: Retrieving config option: %s' % key, 9)
+        self.output.debug('ARGSPARSER: Retrieving config option: %s', 9, key)
 
         if self.config.has_option('MAIN', key):
             if key in self._defaults['t/f_options']:
                 return self.t_f_check(self.config.get('MAIN', key))
             return self.config.get('MAIN', key)
 
-        self.output.debug('ARGSPARSER: Retrieving option: %s' % key, 9)
+        self.output.debug('ARGSPARSER: Retrieving option: %s', 9, key)
 
         if key in self._options.keys():
             return self._options[key]
@@ -383,24 +537,22 @@ class ArgsParser(BareConfig):
         return None
 
 
-    def keys(self):
-        '''Special handler for the configuration keys.'''
+    def _ordered_keys(self):
 
         self.output.debug('ARGSPARSER: Retrieving keys', 9)
 
         keys = [i for i in self.options
                 if not self.options[i] is False
                 and not self.options[i] is None]
+        seen = set(keys)
+        names = list(self.defaults)
+        if self.config:
+            names = self.config.options('MAIN') + names
+        for i in names:
+            if i not in seen:
+                seen.add(i)
+                keys.append(i)
 
-        self.output.debug('ARGSPARSER: Retrieving keys 2', 9)
-
-        keys += [name for name, _ in self.config.items('MAIN')
-                 if not name in keys]
-
-        self.output.debug('ARGSPARSER: Retrieving keys 3', 9)
-
-        keys += [i for i in self.defaults.keys()
-                 if not i in keys]
         self.output.debug('ARGSPARSER: Returning keys', 9)
 
         return keys
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN CATALOG DIFF
+#################################################################################
+# File:       catalogdiff.py
+#
+#             Compares two overlay catalogs
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Reports the differences between two overlay catalogs, e.g. the cached
+remote lists before and after a fetch.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import sys
+
+#===============================================================================
+#
+# Class CatalogDiff
+#
+#-------------------------------------------------------------------------------
+
+class CatalogDiff(object):
+    '''
+    The differences between two {name: Overlay} catalogs.
+
+    added    -- sorted list of new overlay names
+    removed  -- sorted list of dropped overlay names
+    renamed  -- sorted list of (old name, new name) tuples for overlays
+                that reappeared under a new name with a common source URL
+    changed  -- {name: {'sources': (old urls, new urls),
+                        'types': (old types, new types)}} for overlays whose
+                source URLs or types changed; only differing keys are set
+    '''
+
+    def __init__(self, old, new):
+        self.added = []
+        self.removed = []
+        self.renamed = []
+        self.changed = {}
+        self._compare(old, new)
+
+
+    @staticmethod
+    def _sources(overlay):
+        return (sorted(set(s.src for s in overlay.sources)),
+                sorted(set(s.type for s in overlay.sources)))
+
+
+    def _compare(self, old, new):
+        added = sorted(name for name in new if name not in old)
+        removed = sorted(name for name in old if name not in new)
+
+        for name in sorted(name for name in new if name in old):
+            if old[name].fingerprint == new[name].fingerprint:
+                continue
+            old_urls, old_types = self._sources(old[name])
+            new_urls, new_types = self._sources(new[name])
+            change = {}
+            if old_urls != new_urls:
+                change['sources'] = (old_urls, new_urls)
+            if old_types != new_types:
+                change['types'] = (old_types, new_types)
+            if change:
+                self.changed[name] = change
+
+        # An overlay that vanished while a new one appeared with one of its
+        # source urls was renamed.
+        by_url = {}
+        for name in added:
+            for url in self._sources(new[name])[0]:
+                by_url.setdefault(url, name)
+        renamed_to = set()
+        for name in removed:
+            for url in self._sources(old[name])[0]:
+                target = by_url.get(url)
+                if target is not None and target not in renamed_to:
+                    self.renamed.append((name, target))
+                    renamed_to.add(target)
+                    break
+        renamed_from = set(pair[0] for pair in self.renamed)
+
+        self.added = [name for name in added if name not in renamed_to]
+        self.removed = [name for name in removed if name not in renamed_from]
+
+
+    def is_empty(self):
+        '''Returns True if both catalogs describe the same overlays.'''
+        return not (self.added or self.removed or self.renamed or
+                    self.changed)
+
+
+    def affected(self):
+        '''
+        Returns the set of overlay names in the new catalog that were added,
+        renamed or changed and thus need re-indexing or re-verifying.
+        '''
+        names = set(self.added)
+        names.update(pair[1] for pair in self.renamed)
+        names.update(self.changed)
+        return names
+
+
+    def to_dict(self):
+        '''Returns the differences as plain lists and dictionaries.'''
+        return {
+            'added': self.added[:],
+            'removed': self.removed[:],
+            'renamed': self.renamed[:],
+            'changed': dict((name, dict(change))
+                            for name, change in self.changed.items()),
+            }
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -24,9 +24,13 @@ from __future__ import unicode_literals
 __version__ = "$Id: cli.py 2011-01-15 23:52 PST Brian Dolbec$"
 
 
+import errno
+import json
 import os, sys
+from contextlib import contextmanager
 
 from layman.api import LaymanAPI
+from layman.compatibility import encode
 from layman.utils import (decode_selection, encoder, get_encoding,
     pad, terminal_width)
 from layman.constants import (NOT_OFFICIAL_MSG, NOT_SUPPORTED_MSG,
@@ -37,6 +41,43 @@ if sys.hexversion >= 0x30200f0:
 else:
     ALL_KEYWORD = 'ALL'
 
+def _stdout_closed(error):
+    '''
+    Tells whether error was raised because the reader of stdout went
+    away, e.g. "layman -L | head".  Any further output is then sent to
+    /dev/null, so that nothing fails on the closed pipe anymore.
+    '''
+    if getattr(error, 'errno', None) != errno.EPIPE:
+        return False
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    return True
+
+
+@contextmanager
+def _stdout_to_stderr():
+    '''
+    Sends everything written to stdout in the with block, by layman
+    itself or by the commands it runs, to stderr instead.  Yields a
+    file on the original stdout.
+    '''
+    sys.stdout.flush()
+    fd = sys.stdout.fileno()
+    out = os.fdopen(os.dup(fd), 'w')
+    os.dup2(sys.stderr.fileno(), fd)
+    try:
+        yield out
+    finally:
+        sys.stdout.flush()
+        os.dup2(out.fileno(), fd)
+        try:
+            out.close()
+        except (IOError, OSError) as error:
+            if getattr(error, 'errno', None) != errno.EPIPE:
+                raise
+
+
 class ListPrinter(object):
     def __init__(self, config):
         self.config = config
@@ -79,6 +120,15 @@ class ListPrinter(object):
                                complain)
 
 
+    def print_records(self, records, complain):
+        '''Prints a list of overlay records in the order given.'''
+        for overlay in records:
+            self.print_overlay(self.my_lister(overlay),
+                               overlay['supported'],
+                               overlay['official'],
+                               complain)
+
+
     def print_overlay(self, summary, supported, official, complain):
         # Is the overlay supported?
         if supported:
@@ -116,7 +166,7 @@ class ListPrinter(object):
         if len(set(e for e in overlay['src_types'])) == 1:
             _type = overlay['src_types'][0]
         else:
-            _type = '%s/..' % overlay['src_type'][0]
+            _type = '%s/..' % overlay['src_types'][0]
         mtype  = ' [' + pad(_type, 10) + ']'
 
         source = ', '.join(overlay['src_uris'])
@@ -128,6 +178,33 @@ class ListPrinter(object):
         return encoder(name + mtype + source, self._encoding_)
 
 
+class RecordPrinter(object):
+    '''
+    Streams records as JSON, either as one array ("json") or as one
+    object per line ("jsonl").  Every record is flushed as soon as it
+    is written.
+    '''
+    def __init__(self, fmt, out=None):
+        self.fmt = fmt
+        self.out = out or sys.stdout
+        self.count = 0
+
+    def write(self, record):
+        text = json.dumps(record, sort_keys=True)
+        if self.fmt == 'json':
+            text = ('[\n' if not self.count else ',\n') + text
+        else:
+            text += '\n'
+        self.out.write(text)
+        self.out.flush()
+        self.count += 1
+
+    def close(self):
+        if self.fmt == 'json':
+            self.out.write('\n]\n' if self.count else '[]\n')
+            self.out.flush()
+
+
 class Main(object):
     '''Performs the actions the user selected.
     '''
@@ -138,11 +215,18 @@ class Main(object):
         self.api = LaymanAPI(config,
                              report_errors=False,
                              output=config.output)
+        self.record_format = None
+        if config['format'] in ('json', 'jsonl'):
+            self.record_format = config['format']
+            # stdout is reserved for the records
+            self.output.std_out = self.output.error_out
         # Given in order of precedence
         self.actions = [('fetch',      'Fetch'),
                         ('add',        'Add'),
                         ('sync',       'Sync'),
                         ('info',       'Info'),
+                        ('check',      'Check'),
+                        ('search',     'Search'),
                         ('sync_all',   'Sync'),
                         ('readd',      'Readd'),
                         ('delete',     'Delete'),
@@ -166,7 +250,7 @@ class Main(object):
         # Make fetching the overlay list a default action
         if not 'nofetch' in self.config.keys():
             # Actions that implicitely call the fetch operation before
-            fetch_actions = ['sync', 'sync_all', 'list']
+            fetch_actions = ['sync', 'sync_all', 'list', 'search']
             for i in fetch_actions:
                 if i in self.config.keys():
                     # Implicitely call fetch, break loop
@@ -205,6 +289,11 @@ class Main(object):
             self.output.debug('Completed action %s, result %s'
                 % (action[0], result==0), 4)
 
+        waits = self.api.get_lock_waits()
+        if waits:
+            self.output.debug('Waited %.3fs for %d lock(s) held by other '
+                'layman processes', 4, sum(w[2] for w in waits), len(waits))
+
         self.output.debug('Checking for action errors', 4)
         if action_errors:
             for action, _errors in action_errors:
@@ -230,11 +319,38 @@ class Main(object):
         result = self.api.fetch_remote_list()
         if result:
             self.output.info('Fetch Ok', 2)
+        if self.config['diff']:
+            self.print_catalog_diff()
         # blank newline  -- no " *"
         self.output.notice('')
         return result
 
 
+    def print_catalog_diff(self):
+        ''' Prints the changes the last fetch brought in.
+        '''
+        diff = self.api.get_catalog_diff()
+        if diff is None:
+            return
+        lines = []
+        for name in diff['added']:
+            lines.append('Added: %s' % name)
+        for name in diff['removed']:
+            lines.append('Removed: %s' % name)
+        for old_name, new_name in diff['renamed']:
+            lines.append('Renamed: %s -> %s' % (old_name, new_name))
+        for name in sorted(diff['changed']):
+            for key, label in (('sources', 'Source'), ('types', 'Type')):
+                if key in diff['changed'][name]:
+                    old, new = diff['changed'][name][key]
+                    lines.append('%s changed: %s: %s -> %s'
+                        % (label, name, ', '.join(old), ', '.join(new)))
+        if not lines:
+            self.output.info('No changes to the remote overlay list.', 1)
+        for line in lines:
+            self.output.info(line, 1)
+
+
     def Add(self):
         ''' Adds the selected overlay(s).
         '''
@@ -276,15 +392,91 @@ class Main(object):
         self.output.info("Syncing selected overlay(s)...", 2)
         # Note api.sync() defaults to printing results
         selection = decode_selection(self.config['sync'])
-        if self.config['sync_all'] or ALL_KEYWORD in selection:
+        sync_all = self.config['sync_all'] or ALL_KEYWORD in selection
+        if sync_all:
             selection = self.api.get_installed()
         self.output.debug('Updating selected overlay(s)', 6)
-        result = self.api.sync(selection, update_news=True)
+        if self.record_format:
+            return self._sync_records(selection, sync_all)
+        result = self.api.sync(selection, update_news=True,
+                               **self._sync_options(sync_all))
         # blank newline  -- no " *"
         self.output.notice('')
         return result
 
 
+    def _sync_options(self, sync_all):
+        ''' Returns the scheduling options of api.sync() selected on the
+        command line.
+        '''
+        force = self.config['force']
+        return {'sync_all': sync_all,
+                'resume': self.config['resume'],
+                'max_age': None if force else self.config['max_age'],
+                'adaptive': self.config['adaptive'] and not force}
+
+
+    def _sync_records(self, selection, sync_all):
+        ''' Syncs the overlays one by one, printing a record of the
+        result for each of them as soon as it is done.
+
+        The VCS commands and portage's news notifications print to
+        stdout, so everything but the records goes to stderr meanwhile.
+        Once the reader of the records goes away the sync carries on
+        without them.
+        '''
+        closed = []
+
+        def guard(action, *args):
+            if closed:
+                return
+            try:
+                action(*args)
+            except (IOError, OSError) as error:
+                if getattr(error, 'errno', None) != errno.EPIPE:
+                    raise
+                closed.append(error)
+
+        with _stdout_to_stderr() as out:
+            printer = RecordPrinter(self.record_format, out)
+
+            def write(ovl, success, warnings, fatals):
+                guard(printer.write, {
+                    'name': encode(ovl),
+                    'synced': not fatals,
+                    'messages': [message for name, message in success],
+                    'warnings': [message for name, message in warnings],
+                    'errors': [message for name, message in fatals],
+                    })
+
+            try:
+                result = self.api.sync(selection, output_results=False,
+                                       callback=write,
+                                       **self._sync_options(sync_all))
+            finally:
+                guard(printer.close)
+            self.api.update_news(selection)
+        if closed:
+            _stdout_closed(closed[0])
+        return result
+
+
+    def _print_records(self, records):
+        ''' Prints the records in the selected --format as they come.
+
+        @rtype int: number of records printed
+        '''
+        printer = RecordPrinter(self.record_format)
+        try:
+            for record in records:
+                printer.write(record)
+            printer.close()
+        except (IOError, OSError) as error:
+            if not _stdout_closed(error):
+                raise
+        return printer.count
+
+
     def Delete(self):
         ''' Deletes the selected overlay(s).
         '''
@@ -347,6 +539,10 @@ class Main(object):
         if ALL_KEYWORD in selection:
             selection = self.api.get_available()
 
+        if self.record_format:
+            return self._print_records(
+                self.api.get_records(selection, local=False)) > 0
+
         list_printer = ListPrinter(self.config)
         _complain = self.config['nocheck'] or self.config['verbose']
 
@@ -358,6 +554,119 @@ class Main(object):
         return info != {}
 
 
+    def Check(self):
+        ''' Reports installed overlays whose type or source no longer
+        matches the remote lists.
+        '''
+        self.output.info('Checking installed overlays against the remote '
+            'lists...', 2)
+        report = self.api.check_drift()
+        drifted = sorted(name for name in report
+                         if report[name]['status'] != 'ok')
+        for name in drifted:
+            entry = report[name]
+            if entry['status'] == 'missing':
+                self.output.warn('%s: not found in the remote lists'
+                    % name, 1)
+            elif entry['status'] == 'type':
+                self.output.warn('%s: type changed: %s -> %s'
+                    % (name, entry['current_type'], entry['remote_type']), 1)
+            else:
+                self.output.warn('%s: source changed: %s -> %s'
+                    % (name, entry['current_src'],
+                       ', '.join(entry['remote_srcs'])), 1)
+        if not drifted:
+            self.output.info('All %d installed overlay(s) match the remote '
+                'lists.' % len(report), 1)
+        self.output.notice('')
+        return True
+
+
+    def _print_names(self, names, local, list_printer, complain):
+        '''
+        Prints the named overlays in the order given.
+        '''
+        info = self.api.get_info_str(names, local=local,
+            verbose=self.config['verbose'], width=list_printer.width)
+        for ovl in names:
+            summary, official, supported = info[ovl]
+            list_printer.print_overlay(summary, supported, official,
+                complain)
+
+
+    def Search(self):
+        ''' Searches the remote list for the given terms.
+        '''
+        terms = self.config['search']
+        self.output.debug('Searching remote overlays for %s' % terms, 6)
+        try:
+            results = self.api.search(terms)
+        except Exception as error:
+            self.output.error('Failed to search the overlay list: %s'
+                % str(error))
+            return False
+        if not results:
+            self.output.warn('No overlays found matching "%s".'
+                % ' '.join(terms), 2)
+            self.output.notice('')
+            return False
+
+        list_printer = ListPrinter(self.config)
+        self._print_names([name for name, score in results], False,
+            list_printer, True)
+        # blank newline  -- no " *"
+        self.output.notice('')
+        return True
+
+
+    def _query_options(self):
+        '''
+        Returns the keyword arguments for LaymanAPI.query_repos() if any
+        list filtering options were given, otherwise None.
+        '''
+        options = {
+            'official': self.config['filter_official'] or None,
+            'supported': self.config['filter_supported'] or None,
+            'quality': self.config['filter_quality'],
+            'src_type': self.config['filter_type'],
+            'owner': self.config['filter_owner'],
+            'name': self.config['filter_name'],
+            'description': self.config['filter_description'],
+            'offset': self.config['offset'],
+            'limit': self.config['limit'],
+            }
+        if all(v is None for v in options.values()) and \
+            not self.config['sort']:
+            return None
+        options['regex'] = bool(self.config['filter_regex'])
+        options['sort'] = self.config['sort'] or 'name'
+        return options
+
+
+    def _list_query(self, local, options, list_printer, complain):
+        '''
+        Lists the filtered page of overlays selected by options.
+        '''
+        try:
+            total, records = self.api.query_repos(local=local, **options)
+        except Exception as error:
+            self.output.error('Failed to list overlays: %s' % str(error))
+            return False
+
+        if self.record_format:
+            self._print_records(records)
+        elif self.config['verbose']:
+            self._print_names([r['name'] for r in records], local,
+                list_printer, complain)
+        else:
+            list_printer.print_records(records, complain)
+        self.output.info('Listed %d of %d matching overlay(s).'
+            % (len(records), total), 3)
+        # blank newline  -- no " *"
+        self.output.notice('')
+        return True
+
+
     def ListRemote(self):
         ''' Lists the available overlays.
         '''
@@ -366,13 +675,19 @@ class Main(object):
         list_printer = ListPrinter(self.config)
 
         _complain = self.config['nocheck'] or self.config['verbose']
-        info = self.api.get_info_list(local=False,
+        options = self._query_options()
+        if options is not None:
+            return self._list_query(False, options, list_printer, _complain)
+        if self.record_format:
+            self._print_records(self.api.get_records(local=False))
+            return True
+        info = self.api.iter_info_list(local=False,
             verbose=self.config['verbose'], width=list_printer.width)
-        list_printer.print_shortlist(info, complain=_complain)
+        self._print_list(list_printer, info, _complain)
         # blank newline  -- no " *"
         self.output.notice('')
 
-        return info != {}
+        return True
 
 
     def ListLocal(self):
@@ -382,13 +697,18 @@ class Main(object):
         self.output.debug('Printing installed overlays.', 6)
         list_printer = ListPrinter(self.config)
 
+        options = self._query_options()
+        if options is not None:
+            return self._list_query(True, options, list_printer, True)
+        if self.record_format:
+            self._print_records(self.api.get_records(local=True))
+            return True
+
         #
         # fast way
-        info = self.api.get_info_list(verbose=self.config['verbose'],
-                                      width=list_printer.width)
-        #self.output.debug('CLI: ListLocal() info = %s' % len(info), 4)
-        #self.output.debug('\n'.join([ str(x) for x in info]), 4)
-        list_printer.print_shortlist(info, complain=True)
+        info = self.api.iter_info_list(verbose=self.config['verbose'],
+                                       width=list_printer.width)
+        self._print_list(list_printer, info, True)
         #
         # slow way
         #info = self.api.get_all_info(self.api.get_installed(), local=True)
@@ -396,7 +716,18 @@ class Main(object):
 
         # blank newline  -- no " *"
         self.output.notice('')
-        return info != {}
+        return True
+
+
+    def _print_list(self, list_printer, info, complain):
+        ''' Prints the listing rows as they are produced, stopping
+        quietly once stdout was closed.
+        '''
+        try:
+            list_printer.print_shortlist(info, complain=complain)
+        except (IOError, OSError) as error:
+            if not _stdout_closed(error):
+                raise
 
 
 if __name__ == '__main__':
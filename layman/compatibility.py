@@ -8,6 +8,13 @@
 
 from __future__ import unicode_literals
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # Python2
+    from collections import Mapping
+
+
 def encode(text, enc="UTF-8"):
     """py2, py3 compatibility function"""
     if hasattr(text, 'decode'):
@@ -45,3 +52,19 @@ def cmp_to_key(mycmp):
         def __ne__(self, other):
             return mycmp(self.obj, other.obj) != 0
     return K
+
+
+try:
+    from types import MappingProxyType as read_only
+except ImportError:
+    # Python2
+    class read_only(Mapping):
+        """Read-only view of a dict, like MappingProxyType on py3"""
+        def __init__(self, mapping):
+            self._mapping = mapping
+        def __getitem__(self, key):
+            return self._mapping[key]
+        def __iter__(self):
+            return iter(self._mapping)
+        def __len__(self):
+            return len(self._mapping)
@@ -37,6 +37,7 @@ except:
     # Import for Python2
     import ConfigParser
 
+from layman.compatibility import read_only
 from layman.output import Message
 from layman.utils import path
 
@@ -47,6 +48,41 @@ EPREFIX = "@GENTOO_PORTAGE_EPREFIX@"
 if "GENTOO_PORTAGE_EPREFIX" in EPREFIX:
     EPREFIX = ''
 
+# {overlay_defs directory: (directory mtime, sorted file:// urls)}
+_OVERLAY_DEFS_CACHE = {}
+
+
+def overlay_defs_urls(defs_dir):
+    """returns the sorted file:// urls of the *.xml files in defs_dir.
+
+    The directory is only scanned again once its mtime changed, i.e.
+    files were added, removed or renamed.
+
+    @param defs_dir: string, path of the overlay_defs directory
+    @rtype list, None if the directory can not be read
+    """
+    try:
+        mtime = os.stat(defs_dir).st_mtime
+    except OSError:
+        return None
+    cached = _OVERLAY_DEFS_CACHE.get(defs_dir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1][:]
+    try:
+        filelist = os.listdir(defs_dir)
+    except OSError:
+        return None
+    urls = []
+    for _file in sorted(filelist):
+        if not _file.endswith('.xml'):
+            continue
+        _path = os.path.join(defs_dir, _file)
+        if os.path.isfile(_path):
+            urls.append("file://" + _path)
+    _OVERLAY_DEFS_CACHE[defs_dir] = (mtime, urls)
+    return urls[:]
+
+
 def read_layman_config(config=None, defaults=None, output=None):
     """reads the config file defined in defaults['config']
     and updates the config
@@ -60,16 +96,16 @@ def read_layman_config(config=None, defaults=None, output=None):
         output.warn("Warning: not able to parse config file: %s"
             % defaults['config'])
     if config.get('MAIN', 'overlay_defs'):
-        try:
-            filelist = os.listdir(config.get('MAIN', 'overlay_defs'))
-        except OSError:
+        urls = overlay_defs_urls(config.get('MAIN', 'overlay_defs'))
+        if urls is None:
             return
-        filelist = [f for f in filelist if f.endswith('.xml')]
-        overlays = set(config.get('MAIN', 'overlays').split('\n'))
-        for _file in filelist:
-            _path = os.path.join(config.get('MAIN', 'overlay_defs'), _file)
-            if os.path.isfile(_path):
-                overlays.update(["file://" + _path])
+        # keep the configured lists first, in their given order
+        overlays = []
+        seen = set()
+        for url in config.get('MAIN', 'overlays').split('\n') + urls:
+            if url not in seen:
+                seen.add(url)
+                overlays.append(url)
         config.set('MAIN', 'overlays', '\n'.join(overlays))
 
 
@@ -101,6 +137,10 @@ class BareConfig(object):
             'conf_type': 'make.conf',
             'require_repoconfig': 'Yes',
             'clean_archive': 'yes',
+            'sync_retries': '2',
+            'retry_delay': '2',
+            'probe_sources': 'no',
+            'probe_timeout': '5',
             'make_conf' : '%(storage)s/make.conf',
             'repos_conf': path([self.root, EPREFIX,'/etc/portage/repos.conf/layman.conf']),
             'conf_module': ['make_conf', 'repos_conf'],
@@ -128,7 +168,8 @@ class BareConfig(object):
             'rsync_command': path([self.root, EPREFIX,'/usr/bin/rsync']),
             'svn_command': path([self.root, EPREFIX,'/usr/bin/svn']),
             'tar_command': path([self.root, EPREFIX,'/bin/tar']),
-            't/f_options': ['check_official', 'clean_archive', 'nocheck', 'require_repoconfig'],
+            't/f_options': ['check_official', 'clean_archive', 'nocheck',
+                            'probe_sources', 'require_repoconfig'],
             'bzr_addopts' : '',
             'bzr_syncopts' : '',
             'cvs_addopts' : '',
@@ -178,6 +219,11 @@ class BareConfig(object):
             }
         self._set_quietness(quietness)
         self.config = None
+        # resolved {key: value} of all options and its read-only view,
+        # see _resolved()
+        self._snapshot = None
+        self._snapshot_view = None
+        self._keys = None
         if read_configfile:
             defaults = self.get_defaults()
             if "%(configdir)s" in defaults['config']:
@@ -191,21 +237,66 @@ class BareConfig(object):
         self.config = ConfigParser.ConfigParser(defaults)
         self.config.add_section('MAIN')
         read_layman_config(self.config, defaults, self._options['output'])
+        self.invalidate()
+
+
+    def invalidate(self):
+        '''Drops the resolved option snapshot after an option changed.'''
+        self._snapshot = None
+        self._snapshot_view = None
+        self._keys = None
+
+
+    def _snapshot_keys(self):
+        '''Returns all option names the snapshot resolves.'''
+        names = list(self._options)
+        if self.config:
+            names.extend(self.config.options('MAIN'))
+        names.extend(self._defaults)
+        return names
+
+
+    def _resolved(self):
+        '''
+        Returns a read-only view of the {key: value} snapshot of all
+        options with the ConfigParser interpolation, %(storage)s
+        substitution and boolean parsing done, building it on first use
+        after an invalidate().
+        '''
+        if self._snapshot is None:
+            snapshot = {}
+            for key in self._snapshot_keys():
+                if key in snapshot:
+                    continue
+                try:
+                    snapshot[key] = self._resolve(key)
+                except ConfigParser.Error:
+                    # leave it to __getitem__ to report
+                    pass
+            self._snapshot = snapshot
+            self._snapshot_view = read_only(snapshot)
+        return self._snapshot_view
+
+
+    def _ordered_keys(self):
+        '''Returns the keys() list, deduplicated in order.'''
+        keys = []
+        seen = set()
+        for i in list(self._options) + list(self._defaults):
+            if i not in seen:
+                seen.add(i)
+                keys.append(i)
+        return keys
 
 
     def keys(self):
         '''Special handler for the configuration keys.
         '''
-        self._options['output'].debug(
-            'Retrieving %s options' % self.__class__.__name__, 9)
-        keys = [i for i in self._options]
-        self._options['output'].debug(
-            'Retrieving %s defaults' % self.__class__.__name__, 9)
-        keys += [i for i in self._defaults
-                 if not i in keys]
-        self._options['output'].debug(
-            'Retrieving %s done...' % self.__class__.__name__, 9)
-        return keys
+        if self._keys is None:
+            self._options['output'].debug(
+                'Retrieving %s keys', 9, self.__class__.__name__)
+            self._keys = self._ordered_keys()
+        return self._keys[:]
 
 
     def get_defaults(self):
@@ -223,6 +314,7 @@ class BareConfig(object):
     def set_option(self, option, value):
         """Sets an option to the value"""
         self._options[option] = value
+        self.invalidate()
         # handle quietness
         if option == 'quiet':
             if self._options['quiet']:
@@ -239,11 +331,22 @@ class BareConfig(object):
             self._options['output'].set_note_level(value)
 
     def __getitem__(self, key):
+        view = self._resolved()
+        try:
+            return view[key]
+        except KeyError:
+            snapshot = self._snapshot
+            value = self._resolve(key)
+            snapshot[key] = value
+            return value
+
+    def _resolve(self, key):
+        '''Looks up the value of key the slow way, see __getitem__.'''
         return self._get_(key)
 
     def _get_(self, key):
         self._options['output'].debug(
-            'Retrieving %s option: %s' % (self.__class__.__name__, key), 9)
+            'Retrieving %s option: %s', 9, self.__class__.__name__, key)
         if key == 'overlays':
             overlays = ''
             if (key in self._options
@@ -338,6 +441,7 @@ class OptionConfig(BareConfig):
                 self._set_quietness(options['quietness'])
                 options.pop('quietness')
             self._options.update(options)
+            self.invalidate()
         return
 
     def update_defaults(self, new_defaults):
@@ -347,6 +451,7 @@ class OptionConfig(BareConfig):
         """
         if new_defaults is not None:
             self._defaults.update(new_defaults)
+            self.invalidate()
         return
 
 #===============================================================================
@@ -13,10 +13,11 @@ module_spec = {
             'name': 'makeconf',
             'class': 'ConfigHandler',
             'description': __doc__,
-            'functions': ['add', 'delete', 'disable', 'enable', 'read',
-                          'update', 'write'],
+            'functions': ['add', 'batch', 'delete', 'disable', 'enable',
+                          'read', 'update', 'write'],
             'func_desc': {
                 'add': 'Adds overlay dir string to config',
+                'batch': 'Collects changes and writes the config once',
                 'delete': 'Removes overlay dir string from config',
                 'disable': 'Moves overlay dir string to DISBALED var',
                 'enable': 'Moves overlay dir string to ENABLED var',
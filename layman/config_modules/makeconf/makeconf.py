@@ -18,11 +18,21 @@
 from __future__ import unicode_literals
 
 import os
-import codecs
 import re
 
-from layman.utils import path
-from layman.compatibility import cmp_to_key, fileopen
+from   contextlib            import contextmanager
+
+from   layman.compatibility  import fileopen
+from   layman.utils          import atomic_write, path
+
+
+# The variables layman manages, in the order they are written.
+VARIABLES = ('ENABLED', 'DISABLED', 'PORTDIR_OVERLAY')
+VARIABLE_RE = re.compile(r'\b(ENABLED|DISABLED|PORTDIR_OVERLAY)\s*=\s*"([^"]*)"')
+# Entries of PORTDIR_OVERLAY that refer to the other variables.
+REFERENCES = frozenset(('$PORTDIR_OVERLAY', '${PORTDIR_OVERLAY}',
+                        '$ENABLED', '${ENABLED}',
+                        '$DISABLED', '${DISABLED}'))
 
 #===============================================================================
 #
@@ -34,129 +44,122 @@ class ConfigHandler:
     '''
     Handles modifications to /var/layman/make.conf
 
-    Check that an add/remove cycle does not modify the make.conf:
+    The file is split once into literal text and the ENABLED, DISABLED
+    and PORTDIR_OVERLAY assignments.  Changes are made to the overlay
+    lists and the file is written back atomically, once per call or once
+    per batch() of calls.  Everything outside of the three assignments is
+    kept as is.
 
-    >>> import hashlib
     >>> import tempfile
+    >>> from layman.output import Message
     >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
-    >>> write = os.path.join(tmpdir, 'make.conf')
-    >>> here = os.path.dirname(os.path.realpath(__file__))
-    >>> config = {'installed' :
-    ...           here + '/tests/testfiles/global-overlays.xml',
-    ...           'make_conf' : here + '/tests/testfiles/make.conf',
-    ...           'nocheck'    : True,
-    ...           'storage'   : '/var/lib/layman',
-    ...           'quietness':3}
-    >>> b = DB(config)
-    >>> a = ConfigHandler(config, b.overlays)
-    >>> o_md5 = str(hashlib.md5(open(here + '/tests/testfiles/make.conf').read()).hexdigest())
-    >>> a.path = write
-    >>> a.add(b.overlays['wrobel-stable'])
-    >>> [i.name for i in a.overlays]
-    ['wrobel-stable', 'wrobel-stable']
-    >>> a.add(b.overlays['wrobel'])
-    >>> [i.name for i in a.overlays]
-    ['wrobel', 'wrobel-stable', 'wrobel-stable']
-    >>> a.delete(b.overlays['wrobel-stable'])
-    >>> [i.name for i in a.overlays]
-    ['wrobel']
-    >>> a.add(b.overlays['wrobel-stable'])
-    >>> [i.name for i in a.overlays]
-    ['wrobel', 'wrobel-stable']
-    >>> a.delete(b.overlays['wrobel'])
-    >>> n_md5 = str(hashlib.md5(open(write).read()).hexdigest())
-    >>> o_md5 == n_md5
+    >>> conf = os.path.join(tmpdir, 'make.conf')
+    >>> with open(conf, 'w') as f:
+    ...     _ = f.write('# local notes\\nPORTDIR_OVERLAY="\\n$PORTDIR_OVERLAY\\n/usr/local/portage"\\n')
+    >>> config = {'output': Message(), 'make_conf': conf,
+    ...           'storage': '/var/lib/layman'}
+    >>> a = ConfigHandler(config, {})
+    >>> a.write()
     True
-    >>> os.unlink(write)
+    >>> print(open(conf).read())
+    # local notes
+    ENABLED="
+    "
+    DISABLED="
+    "
+    PORTDIR_OVERLAY="
+    $ENABLED
+    $PORTDIR_OVERLAY
+    /usr/local/portage"
+    <BLANKLINE>
     >>> import shutil
     >>> shutil.rmtree(tmpdir)
     '''
 
-    my_enabled_re  = re.compile('ENABLED\s*=\s*"([^"]*)"')
-    my_disabled_re = re.compile('DISABLED\s*=\s*"([^"]*)"')
-    my_portdir_re  = re.compile('PORTDIR_OVERLAY\s*=\s*"([^"]*)"')
-
     def __init__(self, config, overlays):
 
         self.config = config
         self.path = config['make_conf']
         self.storage = config['storage']
         self.data = ''
-        self.db = overlays
+        self.db = overlays or {}
         self.overlays = []
-        self.disabled = []
+        # names of self.overlays and of those listed in $DISABLED
+        self.names = set()
+        self.disabled = set()
         self.extra = []
         self.output = config['output']
+        # [(literal text, variable name or None), ...] in file order
+        self._chunks = None
+        self._batch = 0
+        self._dirty = False
 
         self.read(True)
 
 
+    def _tokenize(self, text):
+        '''
+        Splits make.conf text into literal chunks and the assignments of
+        VARIABLES in one pass.  Only the first assignment of each variable
+        is managed.
+
+        @rtype tuple: ([(literal, name or None), ...], {name: [entry, ...]})
+        '''
+        chunks = []
+        values = {}
+        pos = 0
+        for match in VARIABLE_RE.finditer(text):
+            name = match.group(1)
+            if name in values:
+                continue
+            values[name] = [i.strip() for i in match.group(2).split('\n')
+                            if i.strip()]
+            chunks.append((text[pos:match.start()], name))
+            pos = match.end()
+        chunks.append((text[pos:], None))
+
+        # Files written by older layman versions lack $ENABLED and
+        # $DISABLED, add them in front of PORTDIR_OVERLAY.
+        if 'PORTDIR_OVERLAY' in values:
+            missing = [name for name in VARIABLES[:2] if name not in values]
+            if missing:
+                index = [c[1] for c in chunks].index('PORTDIR_OVERLAY')
+                literal = chunks[index][0]
+                chunks[index:index + 1] = \
+                    [(literal, missing[0])] + \
+                    [('\n', name) for name in missing[1:]] + \
+                    [('\n', 'PORTDIR_OVERLAY')]
+        return chunks, values
+
+
     def add(self, overlay):
         '''
         Add an overlay to make.conf.
 
-        >>> import tempfile
-        >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
-        >>> write = os.path.join(tmpdir, 'make.conf')
-        >>> here = os.path.dirname(os.path.realpath(__file__))
-        >>> config = {'installed' :
-        ...           here + '/tests/testfiles/global-overlays.xml',
-        ...           'make_conf' : here + '/tests/testfiles/make.conf',
-        ...           'nocheck'    : True,
-        ...           'storage'   : '/var/lib/layman',
-        ...           'quietness':3}
-        >>> c = DB(config)
-        >>> a = ConfigHandler(config, c.overlays)
-        >>> a.path = write
-        >>> a.add(c.select('wrobel'))
-        >>> config['make_conf'] = write
-        >>> b = ConfigHandler(config, c.overlays)
-        >>> [i.name for i in b.overlays]
-        ['wrobel', 'wrobel-stable']
-        >>> b.extra
-        ['/usr/local/portage/ebuilds/testing', '/usr/local/portage/ebuilds/stable', '/usr/local/portage/kolab2', '/usr/local/portage/gentoo-webapps-overlay/experimental', '/usr/local/portage/gentoo-webapps-overlay/production-ready']
-
-        >>> os.unlink(write)
-        >>> import shutil
-        >>> shutil.rmtree(tmpdir)
+        @params overlay: layman.overlay.Overlay object.
+        @rtype bool: represents success or failure to write to make.conf.
         '''
+        if overlay.name in self.names:
+            self.overlays = [i for i in self.overlays
+                             if i.name != overlay.name]
         self.overlays.append(overlay)
-        return self.write()
+        self.names.add(overlay.name)
+        return self._changed()
 
 
     def delete(self, overlay):
         '''
         Delete an overlay from make.conf.
 
-        >>> import tempfile
-        >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
-        >>> write = os.path.join(tmpdir, 'make.conf')
-        >>> here = os.path.dirname(os.path.realpath(__file__))
-        >>> config = {'installed' :
-        ...           here + '/tests/testfiles/global-overlays.xml',
-        ...           'make_conf' : here + '/tests/testfiles/make.conf',
-        ...           'nocheck'    : True,
-        ...           'storage'   : '/var/lib/layman',
-        ...           'quietness':3}
-        >>> c = DB(config)
-        >>> a = ConfigHandler(config, c.overlays)
-        >>> a.path = write
-        >>> a.delete(c.select('wrobel-stable'))
-        >>> config['make_conf'] = write
-        >>> b = ConfigHandler(config, c.overlays)
-        >>> [i.name for i in b.overlays]
-        []
-        >>> b.extra
-        ['/usr/local/portage/ebuilds/testing', '/usr/local/portage/ebuilds/stable', '/usr/local/portage/kolab2', '/usr/local/portage/gentoo-webapps-overlay/experimental', '/usr/local/portage/gentoo-webapps-overlay/production-ready']
-
-        >>> os.unlink(write)
-        >>> import shutil
-        >>> shutil.rmtree(tmpdir)
+        @params overlay: layman.overlay.Overlay object.
+        @rtype bool: represents success or failure to write to make.conf.
         '''
-        self.overlays = [i
-                         for i in self.overlays
-                         if i.name != overlay.name]
-        return self.write()
+        if overlay.name in self.names:
+            self.overlays = [i for i in self.overlays
+                             if i.name != overlay.name]
+            self.names.discard(overlay.name)
+        self.disabled.discard(overlay.name)
+        return self._changed()
 
 
     def disable(self, overlay):
@@ -166,7 +169,14 @@ class ConfigHandler:
         @params overlay: layman.overlay.Overlay object.
         @rtype bool: represents success or failure to write to make.conf.
         '''
-        return self.write(disable=overlay.name)
+        if overlay.name in self.disabled:
+            msg = 'Overlay "%(repo)s" is already disabled!'\
+                    % ({'repo': overlay.name})
+            self.output.error(msg)
+            return True
+        if overlay.name in self.names:
+            self.disabled.add(overlay.name)
+        return self._changed()
 
 
     def enable(self, overlay):
@@ -176,7 +186,14 @@ class ConfigHandler:
         @params overlay: layman.overlay.Overlay object.
         @rtype bool: represents success or failure to write to make.conf.
         '''
-        return self.write(enable=overlay.name)
+        if overlay.name in self.disabled:
+            self.disabled.discard(overlay.name)
+        elif overlay.name in self.names:
+            msg = 'Overlay "%(repo)s" is already enabled!'\
+                    % ({'repo': overlay.name})
+            self.output.error(msg)
+            return False
+        return self._changed()
 
 
     def update(self, overlay):
@@ -186,193 +203,146 @@ class ConfigHandler:
         pass
 
 
+    def _changed(self):
+        '''
+        Writes the file now, or at the end of the current batch().
+
+        @rtype bool: reflects a successful/failed write (True in a batch).
+        '''
+        self._dirty = True
+        if self._batch:
+            return True
+        return self.write()
+
+
+    @contextmanager
+    def batch(self):
+        '''
+        Collects all changes made inside the with block and writes the
+        file once at its end.
+        '''
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+            if not self._batch and self._dirty:
+                self.write()
+
+
     def read(self, raise_error=False):
         '''
         Read the list of registered overlays from /var/layman/make.conf.
 
+        >>> from layman.output import Message
+        >>> from layman.dbbase import DbBase
         >>> here = os.path.dirname(os.path.realpath(__file__))
-        >>> config = {'installed' :
-        ...           here + '/tests/testfiles/global-overlays.xml',
-        ...           'make_conf' : here + '/tests/testfiles/make.conf',
-        ...           'nocheck'    : True,
-        ...           'storage'   : '/var/lib/layman',
-        ...           'quietness':3}
-        >>> c = DB(config)
+        >>> testfiles = os.path.join(here, '..', '..', 'tests', 'testfiles')
+        >>> config = {'output': Message(), 'svn_command': '/usr/bin/svn',
+        ...           'rsync_command': '/usr/bin/rsync',
+        ...           'make_conf': os.path.join(testfiles, 'make.conf'),
+        ...           'storage': '/var/lib/layman'}
+        >>> c = DbBase(config, [os.path.join(testfiles, 'global-overlays.xml')])
         >>> a = ConfigHandler(config, c.overlays)
         >>> [i.name for i in a.overlays]
         ['wrobel-stable']
         >>> a.extra
         ['/usr/local/portage/ebuilds/testing', '/usr/local/portage/ebuilds/stable', '/usr/local/portage/kolab2', '/usr/local/portage/gentoo-webapps-overlay/experimental', '/usr/local/portage/gentoo-webapps-overlay/production-ready']
         '''
-        if os.path.isfile(self.path):
-            self.content()
-
-            overlays = self.my_portdir_re.search(self.data)
-            enabled_overlays = self.my_enabled_re.search(self.data)
-            disabled_overlays = self.my_disabled_re.search(self.data)
-
-            if not overlays:
-                msg = 'MakeConf: ConfigHandler.read(); Did not find a '\
-                    'PORTDIR_OVERLAY entry in file '\
-                    '%(path)s! Did you specify the correct file?' % ({'path': self.path})
-                if raise_error:
-                    raise Exception(msg)
-                self.output.error(msg)
-                return False
-
-            overlays = [i.strip()
-                        for i in overlays.group(1).split('\n')
-                        if i.strip()]
-
-            if enabled_overlays:
-                enabled_overlays = [i.strip()
-                                    for i in enabled_overlays.group(1).split('\n')
-                                    if i.strip()]
-
-            if disabled_overlays:
-                disabled_overlays = [i.strip()
-                                     for i in disabled_overlays.group(1).split('\n')
-                                     if i.strip()]
-
-            for i in (disabled_overlays, enabled_overlays, overlays):
-                for o in (i or []):
-                    if o[:len(self.storage)] == self.storage:
-                        oname = os.path.basename(o)
-                        if  oname in self.db.keys():
-                            if i == disabled_overlays:
-                                self.disabled.append(path([self.storage,
-                                                           oname]))
-                            self.overlays.append(self.db[oname])
-                        else:
-                            # These are additional overlays that we dont know
-                            # know anything about. The user probably added
-                            # them manually.
-                            self.extra.append(o)
-                    else:
-                        # These are additional overlays that we dont know
-                        # anything about. The user probably added them
-                        # manually.
-                        self.extra.append(o)
-
-        else:
-            self.overlays = []
-            self.data     = 'PORTDIR_OVERLAY="\n"\n'
-
-        self.extra = [i for i in self.extra
-                         if ((i != '$PORTDIR_OVERLAY'
-                             and i != '${PORTDIR_OVERLAY}')
-                             and (i != '$ENABLED'
-                             and i != '${ENABLED}')
-                             and (i != '$DISABLED'
-                             and i != '${DISABLED}'))]
+        self.overlays = []
+        self.names = set()
+        self.disabled = set()
+        self.extra = []
+
+        if not os.path.isfile(self.path):
+            self.data = ''
+            self._chunks = [('', 'ENABLED'), ('\n', 'DISABLED'),
+                            ('\n', 'PORTDIR_OVERLAY'), ('', None)]
+            return True
+
+        self.content()
+        chunks, values = self._tokenize(self.data)
+
+        if 'PORTDIR_OVERLAY' not in values:
+            self._chunks = None
+            msg = 'MakeConf: ConfigHandler.read(); Did not find a '\
+                'PORTDIR_OVERLAY entry in file '\
+                '%(path)s! Did you specify the correct file?' % ({'path': self.path})
+            if raise_error:
+                raise Exception(msg)
+            self.output.error(msg)
+            return False
+        self._chunks = chunks
+
+        storage = self.storage
+        for name in ('DISABLED', 'ENABLED', 'PORTDIR_OVERLAY'):
+            for o in values.get(name, []):
+                oname = os.path.basename(o)
+                if o.startswith(storage) and oname in self.db:
+                    if name == 'DISABLED':
+                        self.disabled.add(oname)
+                    if oname not in self.names:
+                        self.names.add(oname)
+                        self.overlays.append(self.db[oname])
+                elif o not in REFERENCES:
+                    # These are additional overlays that we dont know
+                    # anything about. The user probably added them
+                    # manually.
+                    self.extra.append(o)
         return True
 
 
-    def write(self, disable=None, enable=None):
+    def _values(self):
+        '''
+        Returns the rendered value of each of the VARIABLES.
+        '''
+        self.overlays.sort(key=lambda o: o.priority)
+        enabled = [path([self.storage, i.name]) for i in self.overlays
+                   if i.name not in self.disabled]
+        disabled = [path([self.storage, name])
+                    for name in sorted(self.disabled)]
+
+        return {
+            'ENABLED': '\n' + ''.join(i + '\n' for i in enabled),
+            'DISABLED': '\n' + ''.join(i + '\n' for i in disabled),
+            'PORTDIR_OVERLAY': '\n$ENABLED\n$PORTDIR_OVERLAY\n'
+                               + '\n'.join(self.extra),
+            }
+
+
+    def text(self):
+        '''Returns the make.conf content of the current lists.'''
+        values = self._values()
+        content = []
+        for literal, name in self._chunks:
+            content.append(literal)
+            if name is not None:
+                content.append('%s="%s"' % (name, values[name]))
+        return ''.join(content)
+
+
+    def write(self):
         '''
         Write the list of registered overlays to /var/layman/make.conf.
 
-        >>> import tempfile
-        >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
-        >>> os.path.join(tmpdir, 'make.conf')
-        >>> here = os.path.dirname(os.path.realpath(__file__))
-        >>> config = {'installed' :
-        ...           here + '/tests/testfiles/global-overlays.xml',
-        ...           'make_conf' : here + '/tests/testfiles/make.conf',
-        ...           'nocheck'    : True,
-        ...           'storage'   : '/var/lib/layman',
-        ...           'quietness':3}
-        >>> c = DB(config)
-        >>> a = ConfigHandler(config, c.overlays)
-        >>> a.path = write
-        >>> a.write()
-        >>> config['make_conf'] = write
-        >>> b = ConfigHandler(config, c.overlays)
-        >>> [i.name for i in b.overlays]
-        ['wrobel-stable']
-        >>> b.extra
-        ['/usr/local/portage/ebuilds/testing', '/usr/local/portage/ebuilds/stable', '/usr/local/portage/kolab2', '/usr/local/portage/gentoo-webapps-overlay/experimental', '/usr/local/portage/gentoo-webapps-overlay/production-ready']
-
-        >>> os.unlink(write)
-        >>> import shutil
-        >>> shutil.rmtree(tmpdir)
+        @rtype bool: represents success or failure to write to make.conf.
         '''
-        def prio_sort(a, b):
-            '''Sort by priority.'''
-            if a.priority < b.priority:
-                return -1
-            elif a.priority > b.priority:
-                return 1
-            return 0
-
-        self.overlays.sort(key=cmp_to_key(prio_sort))
-
-        enabled = []
-
-        for i in self.overlays:
-            ovl = path([self.storage, i.name])
-            # We want to enable this overlay:
-            if i.name == enable:
-                if ovl in self.disabled:
-                    self.disabled.remove(ovl)
-                    enabled.append(ovl)
-                else:
-                    msg = 'Overlay "%(repo)s" is already enabled!'\
-                            % ({'repo': i.name})
-                    self.output.error(msg)
-                    return False
-            # We want to disable this overlay:
-            elif i.name == disable:
-                if ovl not in self.disabled:
-                    self.disabled.append(ovl)
-                else:
-                    msg = 'Overlay "%(repo)s" is already disabled!'\
-                            % ({'repo': i.name})
-                    self.output.error(msg)
-            # We want to keep it as-is:
-            else:
-                if ovl not in self.disabled:
-                    enabled.append(ovl)
-
-        self.disabled.sort()
-
-
-        enabled_overlays = 'ENABLED="\n'
-        enabled_overlays += '\n'.join(enabled) + '\n' if enabled else ''
-        enabled_overlays += '"'
-        disabled_overlays = 'DISABLED="\n'
-        disabled_overlays += '\n'.join(self.disabled) + '\n' if self.disabled else ''
-        disabled_overlays += '"'
-        overlays = 'PORTDIR_OVERLAY="\n'
-        overlays += '$ENABLED\n'
-        overlays += '$PORTDIR_OVERLAY\n'
-        overlays += '\n'.join(self.extra)
-        overlays += '"'
-
-        if not re.search('ENABLED=', self.data):
-            self.data = '\n'.join((enabled_overlays, disabled_overlays,
-                                   overlays))
-
-        enabled_content = self.my_enabled_re.sub(enabled_overlays, self.data)
-        disabled_content = self.my_disabled_re.sub(disabled_overlays, enabled_content)
-        content = self.my_portdir_re.sub(overlays, disabled_content)
-
-        if not self.my_portdir_re.search(content):
+        if self._chunks is None:
             self.output.error('MakeConf: ConfigHandler.write(); Oops, failed to set a '\
                 'proper PORTDIR_OVERLAY entry in file '\
                 '%(path)s! Did not overwrite the file.' % ({'path': self.path}))
             return False
 
         try:
-             with fileopen(self.path, 'w') as make_conf:
-                make_conf.write(content)
-
-        except Exception as error:
+            atomic_write(self.path, self.text())
+        except (IOError, OSError) as error:
             self.output.error('MakeConf: ConfigHandler.write(); Failed to write "'\
                 '%(path)s".\nError was:\n%(error)s' % ({'path': self.path, 'error': str(error)}))
             return False
+        self._dirty = False
         return True
 
+
     def content(self):
         '''
         Returns the content of the /var/lib/layman/make.conf file.
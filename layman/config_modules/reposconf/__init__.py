@@ -13,10 +13,11 @@ module_spec = {
             'name': 'reposconf',
             'class': 'ConfigHandler',
             'description': __doc__,
-            'functions': ['add', 'delete', 'disable', 'enable', 'read',
-                          'update', 'write'],
+            'functions': ['add', 'batch', 'delete', 'disable', 'enable',
+                          'read', 'update', 'write'],
             'func_desc': {
                 'add': 'Adds overlay information to config',
+                'batch': 'Collects changes and writes the config once',
                 'delete': 'Removes overlay information from config',
                 'disable': 'Comments out specific overlay config entry',
                 'enable': 'Uncomments specific overlay config entry',
@@ -16,15 +16,10 @@
 #
 
 import os
-import subprocess
+import re
 import time
 
-try:
-    # Import for Python3
-    import configparser as ConfigParser
-except:
-    # Import for Python2
-    import ConfigParser
+from   contextlib            import contextmanager
 
 try:
     from portage.sync.modules import layman_
@@ -33,37 +28,139 @@ except ImportError:
     sync_type = None
 
 from   layman.compatibility  import fileopen
-from   layman.utils          import path
+from   layman.utils          import atomic_write, path
+
+
+SECTION_RE = re.compile(r'^(#?)\[([^\]]+)\]\s*$')
+OPTION_RE = re.compile(r'^([^=:\s][^=:]*?)\s*[=:]\s*(.*)$')
+
+
+class Section(object):
+    '''
+    One repos.conf section.  Disabled sections are written with their
+    header and options commented out.
+    '''
+
+    def __init__(self, name, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        # [(key, value), ...] in file order; comment lines have key None
+        self.options = []
+
+
+    def get(self, key):
+        for _key, value in self.options:
+            if _key == key:
+                return value
+        return None
+
+
+    def set(self, key, value):
+        for index, (_key, _value) in enumerate(self.options):
+            if _key == key:
+                self.options[index] = (key, value)
+                return
+        self.options.append((key, value))
+
+
+    def lines(self):
+        prefix = '' if self.enabled else '#'
+        lines = ['%s[%s]' % (prefix, self.name)]
+        for key, value in self.options:
+            if key is None:
+                lines.append(value)
+            else:
+                lines.append('%s%s = %s'
+                    % (prefix, key, value.replace('\n', '\n\t')))
+        return lines
+
 
 class ConfigHandler:
+    '''
+    Handles modifications to /etc/portage/repos.conf/layman.conf
+
+    The file is parsed into a list of sections once.  Changes are made to
+    that model and written back atomically, once per call or once per
+    batch() of calls.
+
+    >>> import tempfile
+    >>> from layman.output import Message
+    >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+    >>> conf = os.path.join(tmpdir, 'layman.conf')
+    >>> with open(conf, 'w') as f:
+    ...     _ = f.write('# local notes\\n\\n[foo]\\npriority = 50\\n')
+    >>> config = {'output': Message(), 'repos_conf': conf,
+    ...           'storage': '/var/lib/layman', 'auto_sync': 'No'}
+    >>> a = ConfigHandler(config, {})
+    >>> a.names()
+    ['foo']
+    >>> a.set_enabled('foo', False)
+    True
+    >>> print(open(conf).read()) #doctest: +ELLIPSIS
+    # local notes
+    <BLANKLINE>
+    #[foo]
+    #date disabled = ...
+    #priority = 50
+    <BLANKLINE>
+    <BLANKLINE>
+    >>> ConfigHandler(config, {}).is_enabled('foo')
+    False
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    '''
 
     def __init__(self, config, overlays):
-        
+
         self.config = config
         self.output = config['output']
-        self.overlay = {}
+        self.overlays = overlays
         self.path = config['repos_conf']
         self.storage = config['storage']
+        # lines before the first section
+        self.preamble = []
+        self.sections = []
+        self._batch = 0
+        self._dirty = False
 
         self.read()
 
-    def _read_config(self, config=None):
-        '''
-        Reads the config file using a specified
-        ConfigParser.ConfigParser instance.
 
-        @param config: ConfigParser.ConfigParser instance.
+    def _parse(self, text):
         '''
-        try:
-            read_files = config.read(self.path)
-                
-            if not read_files:
-                self.output.warn("Warning, not able to parse config file: %(path)s"\
-                    % ({'path':self.path}))
-        except IOError as error:
-            self.output.error('ReposConf: ConfigHandler.read(); Failed to read "'\
-                '%(path)s".\nError was:\n%(error)s'\
-                % ({'path': self.path, 'error': str(error)}))
+        Parses repos.conf text into self.preamble and self.sections.
+        '''
+        self.preamble = []
+        self.sections = []
+        section = None
+        for line in text.splitlines():
+            match = SECTION_RE.match(line)
+            if match:
+                section = Section(match.group(2), not match.group(1))
+                self.sections.append(section)
+                continue
+            if section is None:
+                self.preamble.append(line)
+                continue
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if line[0] in ' \t' and section.options:
+                # continuation of a multi-line value
+                key, value = section.options[-1]
+                if key is not None:
+                    section.options[-1] = (key, value + '\n' + stripped)
+                    continue
+            if not section.enabled and stripped.startswith('#'):
+                stripped = stripped[1:]
+            elif section.enabled and stripped[0] in '#;':
+                section.options.append((None, line))
+                continue
+            match = OPTION_RE.match(stripped)
+            if match:
+                section.options.append((match.group(1), match.group(2)))
+            else:
+                section.options.append((None, line))
 
 
     def read(self):
@@ -72,11 +169,86 @@ class ConfigHandler:
         /etc/portage/repos.conf/layman.conf
         '''
         if os.path.isfile(self.path):
-            self.repo_conf = ConfigParser.ConfigParser()
-            self._read_config(self.repo_conf)
+            try:
+                with fileopen(self.path, 'r') as laymanconf:
+                    self._parse(laymanconf.read())
+            except IOError as error:
+                self.output.error('ReposConf: ConfigHandler.read(); Failed to read "'\
+                    '%(path)s".\nError was:\n%(error)s'\
+                    % ({'path': self.path, 'error': str(error)}))
         else:
             self.output.error('ReposConf: ConfigHandler.read(); Failed to read "'\
                 '%(path)s".\nFile not found.' % ({'path': self.path}))
+        # An empty repos.conf gets all installed overlays with the next
+        # write.  Seeding here rather than in write() keeps an overlay
+        # deleted later on from coming back.
+        if not self.sections:
+            for name in sorted(self.overlays):
+                self.sections.append(self._new_section(self.overlays[name]))
+
+
+    def _section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+
+    def names(self):
+        '''Returns the names of all sections, enabled or not.'''
+        return [section.name for section in self.sections]
+
+
+    def is_enabled(self, name):
+        '''
+        @rtype bool or None if there is no section for name.
+        '''
+        section = self._section(name)
+        if section is None:
+            return None
+        return section.enabled
+
+
+    def _new_section(self, overlay):
+        '''Returns a fresh Section describing overlay.'''
+        section = Section(overlay.name)
+        section.set('priority', str(overlay.priority))
+        section.set('location', path((self.storage, overlay.name)))
+        section.set('layman-type', overlay.sources[0].type_key)
+        if sync_type:
+            section.set('sync-type', sync_type)
+            section.set('sync-uri', overlay.sources[0].src)
+        if overlay.sources[0].branch:
+            section.set('branch', overlay.sources[0].branch)
+        section.set('auto-sync', self.config['auto_sync'])
+        return section
+
+
+    def _changed(self):
+        '''
+        Writes the file now, or at the end of the current batch().
+
+        @rtype bool: reflects a successful/failed write (True in a batch).
+        '''
+        self._dirty = True
+        if self._batch:
+            return True
+        return self.write()
+
+
+    @contextmanager
+    def batch(self):
+        '''
+        Collects all changes made inside the with block and writes the
+        file once at its end.
+        '''
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+            if not self._batch and self._dirty:
+                self.write()
 
 
     def add(self, overlay):
@@ -86,18 +258,15 @@ class ConfigHandler:
         @param overlay: layman.overlay.Overlay instance.
         @return boolean: reflects a successful/failed write to the config file.
         '''
-        self.repo_conf.add_section(overlay.name)
-        self.repo_conf.set(overlay.name, 'priority', str(overlay.priority))
-        self.repo_conf.set(overlay.name, 'location', path((self.storage, overlay.name)))
-        self.repo_conf.set(overlay.name, 'layman-type', overlay.sources[0].type_key)
-        if sync_type:
-            self.repo_conf.set(overlay.name, 'sync-type', sync_type)
-            self.repo_conf.set(overlay.name, 'sync-uri', overlay.sources[0].src)
-        if overlay.sources[0].branch:
-            self.repo_conf.set(overlay.name, 'branch', overlay.sources[0].branch)
-        self.repo_conf.set(overlay.name, 'auto-sync', self.config['auto_sync'])
+        section = self._new_section(overlay)
+        for index, old in enumerate(self.sections):
+            if old.name == overlay.name:
+                self.sections[index] = section
+                break
+        else:
+            self.sections.append(section)
 
-        return self.write()
+        return self._changed()
 
 
     def delete(self, overlay):
@@ -107,9 +276,31 @@ class ConfigHandler:
         @param overlay: layman.overlay.Overlay instance.
         @return boolean: reflects a successful/failed write to the config file.
         '''
-        self.repo_conf.remove_section(overlay.name)
+        self.sections = [section for section in self.sections
+                         if section.name != overlay.name]
 
-        return self.write(delete=overlay.name)
+        return self._changed()
+
+
+    def set_enabled(self, name, enabled):
+        '''
+        Comments out or restores the section of the named overlay.
+
+        @rtype boolean: reflects a successful/failed write to the config file.
+        '''
+        section = self._section(name)
+        if section is None:
+            return False
+        if section.enabled != enabled:
+            section.enabled = enabled
+            if enabled:
+                section.options = [(key, value) for key, value
+                                   in section.options
+                                   if key != 'date disabled']
+            else:
+                current_date = time.strftime('%x') + ' | ' + time.strftime('%X')
+                section.options.insert(0, ('date disabled', current_date))
+        return self._changed()
 
 
     def disable(self, overlay):
@@ -119,22 +310,12 @@ class ConfigHandler:
         @param overlay: layman.overlay.Overlay instance.
         @rtype boolean: reflects a successful/failed write to the config file.
         '''
-        if not self.repo_conf.has_section(overlay.name):
+        if self._section(overlay.name) is None:
             self.output.error('ReposConf: ConfigHandler.disable(); failed '\
                               'to disable "%(repo)s". Section does not exist.'\
                               % ({'repo': overlay.name}))
             return False
-        self.repo_conf.remove_section(overlay.name)
-        current_date = time.strftime('%x') + ' | ' + time.strftime('%X')
-
-        self.repo_conf.add_section(overlay.name)
-        self.repo_conf.set(overlay.name, '#date disabled', current_date)
-        self.repo_conf.set(overlay.name, '#priority', str(overlay.priority))
-        self.repo_conf.set(overlay.name, '#location', path((self.storage, overlay.name)))
-        self.repo_conf.set(overlay.name, '#sync-uri', overlay.sources[0].src)
-        self.repo_conf.set(overlay.name, '#auto-sync', self.config['auto_sync'])
-
-        return self.write(disable=overlay.name)
+        return self.set_enabled(overlay.name, False)
 
 
     def enable(self, overlay):
@@ -144,10 +325,9 @@ class ConfigHandler:
         @param overlay: layman.overlay.Overlay instance.
         @rtype boolean: reflects a successful/failed write to the config file.
         '''
-        self.repo_conf.remove_section(overlay.name)
-        success = self.add(overlay)
-
-        return success
+        if self._section(overlay.name) is None:
+            return self.add(overlay)
+        return self.set_enabled(overlay.name, True)
 
 
     def update(self, overlay):
@@ -157,33 +337,36 @@ class ConfigHandler:
         @param overlay: layman.overlay.Overlay instance.
         @return boolean: reflects a successful/failed write to the config file.
         '''
-        self.repo_conf.set(overlay.name, 'sync-uri', overlay.sources[0].src)
+        section = self._section(overlay.name)
+        if section is None:
+            return self.add(overlay)
+        section.set('sync-uri', overlay.sources[0].src)
+
+        return self._changed()
 
-        return self.write()
 
+    def text(self):
+        '''Returns the repos.conf content of the current model.'''
+        lines = list(self.preamble)
+        for section in self.sections:
+            if lines and lines[-1].strip():
+                lines.append('')
+            lines.extend(section.lines())
+        return '\n'.join(lines) + '\n\n'
 
-    def write(self, delete=None, disable=None):
+
+    def write(self):
         '''
-        Writes changes from ConfigParser to /etc/portage/repos.conf/layman.conf.
+        Writes the model to /etc/portage/repos.conf/layman.conf.
 
-        @params disable: overlay name to be disabled.
         @return boolean: represents a successful write.
         '''
         try:
-            with fileopen(self.path, 'w') as laymanconf:
-                # If the repos.conf is empty check to see if we can write
-                # all the overlays to the file.
-                if not self.repo_conf.sections():
-                    for i in self.overlays:
-                        if not i == delete:
-                            self.add(self.overlays[i])
-                self.repo_conf.write(laymanconf)
-            if disable:
-                # comments out section header of the overlay.
-                subprocess.call(['sed', '-i', 's/^\[%(ovl)s\]/#[%(ovl)s]/'\
-                                 % {'ovl': disable}, self.path])
-            return True
-        except IOError as error:
+            atomic_write(self.path, self.text())
+        except (IOError, OSError) as error:
             self.output.error('ReposConf: ConfigHandler.write(); Failed to write "'\
                 '%(path)s".\nError was:\n%(error)s'\
                 % ({'path': self.path, 'error': str(error)}))
+            return False
+        self._dirty = False
+        return True
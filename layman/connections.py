@@ -0,0 +1,248 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN HTTP CONNECTIONS
+#################################################################################
+# File:       connections.py
+#
+#             Shared HTTP session and per-host download slots
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''All HTTP downloads of a layman process go through one ConnectionPool:
+a single requests session, so connections to a host are kept alive and
+reused, and a limited number of download slots per host, so parallel
+operations do not overload a single upstream.
+
+>>> pool = ConnectionPool(host_limit=2)
+>>> pool.host('https://github.com/gentoo/foo.git')
+'github.com'
+>>> with pool.slot('https://github.com/a'), pool.slot('https://GitHub.com/b'):
+...     pool.busy('https://github.com/c'), pool.busy('https://gitweb.gentoo.org/')
+(True, False)
+>>> pool.busy('https://github.com/c')
+False
+'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import sys
+import threading
+
+from   contextlib            import contextmanager
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+from   sslfetch.connections  import Connector
+
+from   layman.version        import VERSION
+
+#===============================================================================
+#
+# Constants
+#
+#-------------------------------------------------------------------------------
+
+USERAGENT = "Layman-" + VERSION
+
+# parallel downloads per host unless the host_connections option says
+# otherwise
+HOST_LIMIT = 2
+
+# seconds to wait for a server to connect or send data
+TIMEOUT = 120
+
+#===============================================================================
+#
+# Class ConnectionPool
+#
+#-------------------------------------------------------------------------------
+
+class ConnectionPool(object):
+    '''
+    A keep-alive HTTP session shared by all threads and per-host
+    semaphores bounding the concurrent downloads from each host.
+    '''
+
+    def __init__(self, host_limit=HOST_LIMIT):
+        self.host_limit = max(1, host_limit)
+        self._lock = threading.Lock()
+        # {host: [semaphore, downloads in progress]}
+        self._hosts = {}
+        self._session = None
+
+
+    @staticmethod
+    def host(url):
+        '''Returns the lower cased host[:port] of url.'''
+        return urlparse(url).netloc.rpartition('@')[2].lower()
+
+
+    def _host_entry(self, url):
+        host = self.host(url)
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                entry = [threading.BoundedSemaphore(self.host_limit), 0]
+                self._hosts[host] = entry
+        return entry
+
+
+    def busy(self, url):
+        '''Tells whether all download slots for the host of url are taken.'''
+        entry = self._host_entry(url)
+        return entry[1] >= self.host_limit
+
+
+    @contextmanager
+    def slot(self, url):
+        '''
+        Holds one of the download slots for the host of url, waiting for
+        one to be freed if need be.
+        '''
+        entry = self._host_entry(url)
+        entry[0].acquire()
+        with self._lock:
+            entry[1] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+            entry[0].release()
+
+
+    def session(self):
+        '''
+        Returns the shared requests session, None if requests is not
+        available.
+        '''
+        if requests is None:
+            return None
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                # keep as many idle connections per host as may be in use
+                adapter = HTTPAdapter(pool_maxsize=self.host_limit)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+        return self._session
+
+
+    def head(self, url, proxies=None, timeout=TIMEOUT):
+        '''
+        Sends a HEAD request to url through the shared session.
+
+        @rtype bool: whether url answered without an error status, None
+                     if requests is not available.
+        '''
+        session = self.session()
+        if session is None:
+            return None
+        with self.slot(url):
+            try:
+                response = session.head(url, proxies=proxies,
+                    timeout=timeout, allow_redirects=True,
+                    headers={'User-Agent': USERAGENT})
+            except requests.exceptions.RequestException:
+                return False
+        return response.status_code < 400
+
+#===============================================================================
+#
+# Class PooledConnector
+#
+#-------------------------------------------------------------------------------
+
+class PooledConnector(Connector):
+    '''
+    An ssl-fetch Connector fetching through a ConnectionPool: every
+    download holds a slot of its host and connects through the shared
+    session.
+    '''
+
+    def __init__(self, output, proxies, useragent, pool):
+        Connector.__init__(self, output, proxies, useragent)
+        self.output_map = output
+        self.pool = pool
+
+
+    def connect_url(self, url, stream=False):
+        session = self.pool.session()
+        if session is None:
+            return Connector.connect_url(self, url, stream)
+        try:
+            return session.get(url, headers=self.headers,
+                               proxies=self.proxies, stream=stream,
+                               timeout=TIMEOUT)
+        except requests.exceptions.RequestException as error:
+            self.output_map['error']('PooledConnector.connect_url(); '
+                'Failed to connect to %s\nError was: %s'
+                % (url, str(error)), **self.output_map['kwargs-error'])
+            return None
+
+
+    def fetch_content(self, url, *args, **kwargs):
+        with self.pool.slot(url):
+            return Connector.fetch_content(self, url, *args, **kwargs)
+
+
+    def fetch_file(self, url, *args, **kwargs):
+        with self.pool.slot(url):
+            return Connector.fetch_file(self, url, *args, **kwargs)
+
+#===============================================================================
+#
+# Functions
+#
+#-------------------------------------------------------------------------------
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def connection_pool(config):
+    '''
+    Returns the ConnectionPool of this process, created with the
+    host_connections option of the first config asking for it.
+    '''
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ConnectionPool(int(config['host_connections']
+                                       or HOST_LIMIT))
+    return _POOL
+
+
+def connector(config, output, proxies):
+    '''
+    Returns a Connector fetching through the shared connection pool,
+    output is the ssl-fetch output map.
+    '''
+    return PooledConnector(output, proxies, USERAGENT,
+                           connection_pool(config))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -28,10 +28,15 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 #-------------------------------------------------------------------------------
 
 import os, os.path
+import time
+
+from   multiprocessing.pool     import ThreadPool
 
 from   layman.utils             import path, delete_empty_directory, get_ans
 from   layman.dbbase            import DbBase
+from   layman.locking           import LockManager, STATS_LOCK
 from   layman.repoconfmanager   import RepoConfManager
+from   layman.sourcestats       import SourceStats, retry_delays
 
 #===============================================================================
 #
@@ -63,6 +68,10 @@ class DB(DbBase):
                           )
 
         self.repo_conf = RepoConfManager(self.config, self.overlays)
+        locks = LockManager(path([config['storage'], '.locks']), self.output)
+        self.stats = SourceStats(path([config['storage'],
+                                       'source_stats.json']), self.output,
+                                 lambda: locks.lock(STATS_LOCK))
 
         self.output.debug('DB handler initiated', 6)
 
@@ -153,38 +162,131 @@ class DB(DbBase):
         '''
 
         if overlay.name not in self.overlays.keys():
-            if not self._check_official(overlay):
+            if not self.checkout(overlay):
                 return False
-            result = overlay.add(self.config['storage'])
-            if result == 0:
-                if 'priority' in self.config.keys():
-                    overlay.set_priority(self.config['priority'])
-                self.overlays[overlay.name] = overlay
-                self.write(self.path)
-                repo_ok = self.repo_conf.add(overlay)
-                if False in repo_ok:
-                    return False
-                return True
-            else:
-                mdir = path([self.config['storage'], overlay.name])
-                delete_empty_directory(mdir, self.output)
-                if os.path.exists(mdir):
-                    self.output.error('Adding repository "%s" failed!'
-                                ' Possible remains of the operation have NOT'
-                                ' been removed and may be left at "%s".'
-                                ' Please remove them manually if required.' \
-                                % (overlay.name, mdir))
-                    return False
-                else:
-                    self.output.error(
-                        'Adding repository "%s" failed!' % overlay.name)
-                    return False
+            return self.install([overlay])[overlay.name]
         else:
             self.output.error('Repository "' + overlay.name +
                 '" already in the local (installed) list!')
             return False
 
 
+    def checkout(self, overlay):
+        '''
+        Checks out the overlay into the storage directory without adding
+        it to the installed list, see install().
+
+        @rtype bool: whether the checkout succeeded.
+        '''
+        if not self._check_official(overlay):
+            return False
+        result = overlay.add(self.config['storage'], self.stats,
+                             self._probe_timeout())
+        if result == 0:
+            return True
+        return self._add_failed(overlay)
+
+
+    def install(self, overlays):
+        '''
+        Adds checked out overlays to the installed list and the repo
+        config files, writing each file once.
+
+        @params overlays: list of layman.overlays.Overlay objects.
+        @rtype dict: {overlay name: bool}
+        '''
+        results = {}
+        for overlay in overlays:
+            if 'priority' in self.config.keys():
+                overlay.set_priority(self.config['priority'])
+            self.overlays[overlay.name] = overlay
+            self._invalidate_list_cache(overlay.name)
+        if overlays:
+            self.write(self.path)
+            with self.repo_conf.transaction():
+                for overlay in overlays:
+                    repo_ok = self.repo_conf.add(overlay)
+                    results[overlay.name] = not False in repo_ok
+        return results
+
+
+    def _probe_timeout(self):
+        '''
+        Returns the probe timeout if the sources of overlays are probed
+        before adding them, else None.
+        '''
+        if not self.config['probe_sources']:
+            return None
+        return float(self.config['probe_timeout'])
+
+
+    def _add_failed(self, overlay):
+        '''
+        Cleans up after a failed overlay checkout.
+
+        @rtype bool: always False
+        '''
+        mdir = path([self.config['storage'], overlay.name])
+        delete_empty_directory(mdir, self.output)
+        if os.path.exists(mdir):
+            self.output.error('Adding repository "%s" failed!'
+                        ' Possible remains of the operation have NOT'
+                        ' been removed and may be left at "%s".'
+                        ' Please remove them manually if required.' \
+                        % (overlay.name, mdir))
+        else:
+            self.output.error(
+                'Adding repository "%s" failed!' % overlay.name)
+        return False
+
+
+    def checkout_many(self, overlays, jobs=1):
+        '''
+        Checks out several overlays, up to jobs of them in parallel,
+        without adding them to the installed list, see install().  The
+        unofficial overlay prompts are all answered before the first
+        checkout starts.
+
+        @rtype tuple: (list of the checked out overlays,
+                       {overlay name: False} for the others)
+        '''
+        results = {}
+        selected = []
+        for overlay in overlays:
+            if self._check_official(overlay):
+                selected.append(overlay)
+            else:
+                results[overlay.name] = False
+        if not selected:
+            return [], results
+
+        storage = self.config['storage']
+        probe = self._probe_timeout()
+
+        def checkout(overlay):
+            try:
+                return overlay.add(storage, self.stats, probe)
+            except Exception as error:
+                self.output.error('Adding repository "%s" failed: %s'
+                    % (overlay.name, str(error)))
+                return 1
+
+        pool = ThreadPool(max(1, min(jobs, len(selected))))
+        try:
+            codes = pool.map(checkout, selected)
+        finally:
+            pool.close()
+            pool.join()
+
+        added = []
+        for overlay, result in zip(selected, codes):
+            if result == 0:
+                added.append(overlay)
+            else:
+                results[overlay.name] = self._add_failed(overlay)
+        return added, results
+
+
     def delete(self, overlay):
         '''
         Add an overlay to the local list of overlays.
@@ -246,6 +348,7 @@ class DB(DbBase):
             overlay.delete(self.config['storage'])
             repo_ok = self.repo_conf.delete(overlay)
             del self.overlays[overlay.name]
+            self._invalidate_list_cache(overlay.name)
             self.write(self.path)
         else:
             self.output.error('No local overlay named "' + overlay.name + '"!')
@@ -297,6 +400,7 @@ class DB(DbBase):
                                                     available_srcs)
         result = [result]
         self.overlays[overlay.name].sources = source
+        self._invalidate_list_cache(overlay.name)
         result.extend(self.repo_conf.update(self.overlays[overlay.name]))
         self.write(self.path)
 
@@ -307,14 +411,41 @@ class DB(DbBase):
 
 
     def sync(self, overlay_name):
-        '''Synchronize the given overlay.'''
+        '''
+        Synchronize the given overlay.
+
+        A failed sync is retried sync_retries times, waiting retry_delay
+        seconds before the first retry and about twice as long before
+        each further one.  The outcome of every attempt goes into the
+        source statistics.
+
+        @rtype bool: False if the overlay revision is known and the sync
+                     did not change it.
+        '''
 
         overlay = self.select(overlay_name)
-        result = overlay.sync(self.config['storage'])
+        before = overlay.revision(self.config['storage'])
+        src = overlay.sources[0].src
+        delays = retry_delays(int(self.config['sync_retries'] or 0),
+                              float(self.config['retry_delay'] or 0))
+        while True:
+            start = time.time()
+            result = overlay.sync(self.config['storage'])
+            self.stats.record(src, not result, time.time() - start)
+            delay = next(delays, None) if result else None
+            if delay is None:
+                break
+            self.output.warn('Syncing overlay "%s" from %s failed, retrying '
+                'in %.1f seconds...' % (overlay_name, src, delay), 2)
+            time.sleep(delay)
         if result:
             raise Exception('Syncing overlay "' + overlay_name +
                             '" returned status ' + str(result) + '!' +
                             '\ndb.sync()')
+        after = overlay.revision(self.config['storage'])
+        self.output.debug('DB.sync(): %s revision %s -> %s', 6,
+            overlay_name, before, after)
+        return before is None or before != after
 
 
 #===============================================================================
@@ -31,13 +31,17 @@ __version__ = "$Id: overlay.py 273 2006-12-30 15:54:50Z wrobel $"
 #-------------------------------------------------------------------------------
 
 import sys, os, os.path
+import hashlib
+import re
 import xml
 import xml.etree.ElementTree as ET # Python 2.5
+import multiprocessing
 
 #from   layman.debug              import OUT
-from   layman.utils              import indent
+from   layman.utils              import indent, terminal_width
 from   layman.compatibility      import fileopen
-from   layman.overlays.overlay   import Overlay
+from   layman.overlays.overlay   import Overlay, QUALITY_LEVELS, \
+                                        overlay_record
 
 
 #py3.2+
@@ -80,6 +84,78 @@ class BrokenOverlayCatalog(ValueError):
             {'line':expat_error.lineno, 'column':expat_error.offset + 1, 'origin':origin, 'hint':hint})
 
 
+#===============================================================================
+#
+# Query sort orders
+#
+#-------------------------------------------------------------------------------
+
+SORT_KEYS = {
+    'name': lambda o: o.name.lower(),
+    'priority': lambda o: (o.priority, o.name.lower()),
+    'quality': lambda o: (QUALITY_LEVELS.index(o.quality)
+                          if o.quality in QUALITY_LEVELS
+                          else len(QUALITY_LEVELS), o.name.lower()),
+    }
+
+
+#===============================================================================
+#
+# Secondary indexes
+#
+#-------------------------------------------------------------------------------
+
+# the fields DbBase.lookup() finds overlays by
+INDEX_FIELDS = ('type', 'status', 'quality', 'src', 'owner')
+
+
+def _index_keys(overlay):
+    '''
+    Returns {field: set of values} an overlay is found by in the
+    secondary indexes.  Source types and owners are lower cased, a type
+    is found by its name (e.g. "Git") as well as its key ("git").
+    '''
+    return {
+        'type': set(t.lower() for e in overlay.sources
+                    for t in (e.type, e.type_key) if t),
+        'status': set([overlay.status]),
+        'quality': set([overlay.quality]),
+        'src': set(e.src for e in overlay.sources),
+        'owner': set(o.lower() for o in (overlay.owner_name,
+                                         overlay.owner_email) if o),
+        }
+
+
+def _text_matcher(pattern, regex):
+    '''
+    Returns a function testing a string against the pattern, either as a
+    case insensitive substring or as a regular expression.
+    '''
+    if pattern is None:
+        return None
+    if regex:
+        compiled = re.compile(pattern, re.I)
+        return lambda text: bool(text) and compiled.search(text) is not None
+    pattern = pattern.lower()
+    return lambda text: bool(text) and pattern in text.lower()
+
+
+def parse_catalog(path):
+    '''
+    Reads a catalog file and returns (path, the records of its overlays
+    in document order, see overlay_record()), the records being None if
+    the file cannot be read or parsed.  Runs in the worker processes of
+    DbBase.read_files(), so it only returns picklable values.
+    '''
+    try:
+        with fileopen(path, 'r') as df:
+            document = ET.fromstring(df.read())
+    except Exception:
+        return path, None
+    return path, [overlay_record(overlay) for overlay in
+                  document.findall('overlay') + document.findall('repo')]
+
+
 #===============================================================================
 #
 # Class DbBase
@@ -100,33 +176,95 @@ class DbBase(object):
         self.ignore_init_read_errors = ignore_init_read_errors
 
         self.overlays = {}
+        # rendered list() rows keyed by (name, width, verbose)
+        self._list_cache = {}
+        # overlay names in list() order, see _name_index()
+        self._sorted_names = None
+        # see fingerprint()
+        self._fingerprint = None
+        # {field: {value: set of names}} and {name: _index_keys()}, see
+        # _secondary_indexes()
+        self._indexes = None
+        self._indexed = {}
 
         self.output.debug('Initializing overlay list handler', 8)
 
-        path_found = False
-        for path in self.paths:
-            if not os.path.exists(path):
-                continue
-
-            self.read_file(path)
-            path_found = True
+        paths = [path for path in self.paths if os.path.exists(path)]
+        self.read_files(paths)
 
-        if not path_found:
+        if not paths:
             self.output.warn("Warning: an installed db file was not found at: %s"
                 % str(self.paths))
 
 
     def __eq__(self, other):
-        for key in set(self.overlays.keys()) | set(other.overlays.keys()):
-            if self.overlays[key] != other.overlays[key]:
-                return False
-        return True
+        return self.fingerprint() == other.fingerprint()
 
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
 
+    def fingerprint(self):
+        '''
+        Returns a SHA-256 of the fingerprints of all overlays, see
+        Overlay.refresh_fingerprint(): two catalogs defining the same
+        overlays have the same fingerprint, whatever files they were
+        read from.
+        '''
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            for name in sorted(self.overlays):
+                digest.update(('%s %s\n' % (name,
+                    self.overlays[name].fingerprint)).encode('utf-8'))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+
+    def read_files(self, paths):
+        '''
+        Reads the overlay definition files in order, later ones overwriting
+        the overlays of earlier ones.
+
+        With the parse_jobs option above 1, the files are parsed in that
+        many worker processes and merged in order as they would have been
+        read one after another.  Files the workers fail on are read again
+        here, to report the error.
+        '''
+        try:
+            jobs = min(int(self.config['parse_jobs'] or 1), len(paths))
+        except KeyError:
+            # a plain dict config without the option
+            jobs = 1
+        if jobs > 1:
+            paths = [path for path in paths if self.readable(path)]
+            try:
+                pool = multiprocessing.Pool(jobs)
+            except (OSError, ImportError) as error:
+                self.output.debug('DbBase.read_files(); no worker processes,'
+                    ' reading serially: %s', 4, error)
+            else:
+                try:
+                    results = pool.map(parse_catalog, paths)
+                finally:
+                    pool.close()
+                    pool.join()
+                for path, records in results:
+                    if records is None:
+                        self.read_file(path)
+                    else:
+                        self._add_records(records)
+                return
+
+        for path in paths:
+            self.read_file(path)
+
+
+    def readable(self, path):
+        '''Tells whether read_file() reads path at all.'''
+        return True
+
+
     def read_file(self, path):
         '''Read the overlay definition file.'''
 
@@ -162,13 +300,27 @@ class DbBase(object):
                 document.findall('repo')
 
         for overlay in overlays:
-            self.output.debug('Parsing overlay: %s' % overlay, 9)
+            self.output.debug('Parsing overlay: %s', 9, overlay)
             ovl = Overlay(config=self.config, xml=overlay,
                     ignore=self.ignore)
             self.overlays[ovl.name] = ovl
+            self._index(ovl)
+        self._sorted_names = None
+        self._fingerprint = None
         return
 
 
+    def _add_records(self, records):
+        '''Adds overlays from records returned by overlay_record().'''
+        for record in records:
+            ovl = Overlay(config=self.config, record=record,
+                    ignore=self.ignore)
+            self.overlays[ovl.name] = ovl
+            self._index(ovl)
+        self._sorted_names = None
+        self._fingerprint = None
+
+
     def add_new(self, xml=None, origin=None, from_dict=None):
         '''Reads xml text and dictionary definitions and adds
         them to the db.
@@ -193,6 +345,9 @@ class DbBase(object):
             ovl = Overlay(self.config, ovl_dict=overlay,
                     ignore=self.ignore)
             self.overlays[ovl.name] = ovl
+            self._index(ovl)
+        self._sorted_names = None
+        self._fingerprint = None
         return
 
 
@@ -217,11 +372,11 @@ class DbBase(object):
         '''
         Select an overlay from the list.
         '''
-        self.output.debug("DbBase.select(), overlay = %s" % overlay, 5)
+        self.output.debug("DbBase.select(), overlay = %s", 5, overlay)
         if not overlay in self.overlays.keys():
-            self.output.debug("DbBase.select(), unknown overlay = %s"
-                % overlay, 4)
-            self.output.debug("DbBase.select(), known overlays = %s"
+            self.output.debug("DbBase.select(), unknown overlay = %s", 4,
+                overlay)
+            self.output.debug(lambda: "DbBase.select(), known overlays = %s"
                 % ', '.join(self.overlays.keys()), 4)
             raise UnknownOverlayException(overlay)
         return self.overlays[overlay]
@@ -229,24 +384,240 @@ class DbBase(object):
     def list(self, repos=None, verbose = False, width = 0):
         '''
         List all overlays.
+
+        The overlays are sorted by name before they are rendered and each
+        rendered row is cached per (name, width, verbose).
         '''
-        result = []
+        return [row for row in self.iter_list(repos, verbose, width)]
 
-        selection = [overlay for (a, overlay) in self.overlays.items()]
+
+    def iter_list(self, repos=None, verbose = False, width = 0):
+        '''
+        Yields the rows of list() one at a time, in name order.
+        '''
         if repos is not None:
-            selection = [overlay for overlay in selection if overlay.name in repos]
+            repos = set(repos)
 
-        for overlay in selection:
-            if verbose:
-                result.append((overlay.get_infostr(), overlay.is_supported(),
-                               overlay.is_official()))
-            else:
-                result.append((overlay.short_list(width), overlay.is_supported(),
-                               overlay.is_official()))
+        if not verbose and not width:
+            width = terminal_width()-1
 
-        result = sorted(result, key=lambda summary_supported_official: summary_supported_official[0].lower())
+        for name in self._name_index():
+            if repos is not None and name not in repos:
+                continue
+            yield self._list_row(self.overlays[name], verbose, width)
+
+
+    def _name_index(self):
+        '''
+        Returns the overlay names in list() order.  The names are only
+        sorted again after the overlays changed.
+        '''
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.overlays,
+                                        key=lambda name: name.lower())
+        return self._sorted_names
+
+
+    def _secondary_indexes(self):
+        '''
+        Returns {field: {value: set of overlay names}} for the
+        INDEX_FIELDS.  The indexes are built on first use and then kept
+        up to date as overlays are read, added and deleted.
+        '''
+        if self._indexes is None:
+            self._indexes = dict((field, {}) for field in INDEX_FIELDS)
+            self._indexed = {}
+            for overlay in self.overlays.values():
+                self._index(overlay)
+        return self._indexes
+
+
+    def _index(self, overlay):
+        '''
+        (Re-)adds an overlay to the secondary indexes, if they were built.
+        '''
+        if self._indexes is None:
+            return
+        self._unindex(overlay.name)
+        keys = _index_keys(overlay)
+        for field, values in keys.items():
+            for value in values:
+                self._indexes[field].setdefault(value, set()).add(overlay.name)
+        self._indexed[overlay.name] = keys
+
+
+    def _unindex(self, name):
+        '''Removes the named overlay from the secondary indexes.'''
+        keys = self._indexed.pop(name, None)
+        if keys is None:
+            return
+        for field, values in keys.items():
+            index = self._indexes[field]
+            for value in values:
+                index[value].discard(name)
+                if not index[value]:
+                    del index[value]
+
+
+    def lookup(self, field, value):
+        '''
+        Returns the set of names of the overlays with the given value in
+        one of the INDEX_FIELDS: 'type' (a source type name or key, any
+        case), 'status', 'quality', 'src' (a source URL) or 'owner' (an
+        owner name or email, any case).
+
+        >>> from layman.output import Message
+        >>> here = os.path.dirname(os.path.realpath(__file__))
+        >>> config = {'output': Message(), 'svn_command': '/usr/bin/svn',
+        ...           'rsync_command':'/usr/bin/rsync'}
+        >>> db = DbBase(config, [here + '/tests/testfiles/global-overlays.xml'])
+        >>> sorted(db.lookup('owner', 'NOBODY@gentoo.org'))
+        ['wrobel', 'wrobel-stable']
+        >>> db.lookup('type', 'Subversion'), db.lookup('status', 'official')
+        ({'wrobel'}, {'wrobel'})
+        >>> db.lookup('src', 'rsync://gunnarwrobel.de/wrobel-stable')
+        {'wrobel-stable'}
+        '''
+        if field not in INDEX_FIELDS:
+            raise ValueError('Unknown index "%s", expected one of: %s'
+                % (field, ', '.join(INDEX_FIELDS)))
+        if field in ('type', 'owner') and value:
+            value = value.lower()
+        return set(self._secondary_indexes()[field].get(value, ()))
+
+
+    def _list_row(self, overlay, verbose, width):
+        '''
+        Returns the cached (summary, supported, official) tuple for the
+        overlay, rendering it first if necessary.
+        '''
+        key = (overlay.name, width, verbose)
+        cached = self._list_cache.get(key)
+        if cached is not None and cached[0] is overlay:
+            return cached[1]
+
+        if verbose:
+            row = (overlay.get_infostr(), overlay.is_supported(),
+                   overlay.is_official())
+        else:
+            row = (overlay.short_list(width), overlay.is_supported(),
+                   overlay.is_official())
+        self._list_cache[key] = (overlay, row)
+        return row
+
+
+    def _invalidate_list_cache(self, name=None):
+        '''
+        Drops the cached list() rows of the named overlay, or all of them,
+        along with the sorted name index and the catalog fingerprint.  A
+        changed overlay gets its fingerprint recomputed and is indexed
+        again, a deleted one leaves the secondary indexes.
+        '''
+        self._sorted_names = None
+        self._fingerprint = None
+        if name is None:
+            self._list_cache = {}
+            self._indexes = None
+            return
+        if name in self.overlays:
+            self.overlays[name].refresh_fingerprint()
+            self._index(self.overlays[name])
+        else:
+            self._unindex(name)
+        for key in [k for k in self._list_cache if k[0] == name]:
+            del self._list_cache[key]
+
+    def query(self, official=None, supported=None, quality=None,
+              src_type=None, owner=None, name=None, description=None,
+              regex=False, sort='name', reverse=False, offset=0, limit=None):
+        '''
+        Filters, sorts and pages the overlays.
+
+        Filters left at None are not applied.
+
+        @param official: bool, match the official status.
+        @param supported: bool, match the supported status.
+        @param quality: str or list of quality levels.
+        @param src_type: str or list of source types (e.g. "git" or "Git").
+        @param owner: substring (or regex) of the owner name or email.
+        @param name: substring (or regex) of the overlay name.
+        @param description: substring (or regex) of any description.
+        @param regex: bool, treat owner, name and description as regexes.
+        @param sort: one of the SORT_KEYS ("name", "priority", "quality").
+        @param reverse: bool, reverse the sort order.
+        @param offset: int, number of matching overlays to skip.
+        @param limit: int, maximum number of records returned.
+        @rtype tuple: (total number of matches, [Overlay.to_record(), ...])
+        '''
+        if sort not in SORT_KEYS:
+            raise ValueError('Unknown sort order "%s", expected one of: %s'
+                % (sort, ', '.join(sorted(SORT_KEYS))))
+
+        # the indexed filters narrow down the overlays to look at
+        names = set(self.overlays)
+        if official:
+            names &= self.lookup('status', 'official')
+        if quality is not None:
+            if not isinstance(quality, (list, tuple, set)):
+                quality = [quality]
+            names &= set().union(*[self.lookup('quality', q)
+                                   for q in quality])
+        if src_type is not None:
+            if not isinstance(src_type, (list, tuple, set)):
+                src_type = [src_type]
+            names &= set().union(*[self.lookup('type', t)
+                                   for t in src_type])
+
+        match_owner = _text_matcher(owner, regex)
+        match_name = _text_matcher(name, regex)
+        match_desc = _text_matcher(description, regex)
+
+        def wanted(overlay):
+            if official is not None and not official and \
+                    overlay.is_official():
+                return False
+            if match_name and not match_name(overlay.name):
+                return False
+            if match_owner and not (match_owner(overlay.owner_name) or
+                                    match_owner(overlay.owner_email)):
+                return False
+            if match_desc and not any(match_desc(d)
+                                      for d in overlay.descriptions):
+                return False
+            # the supported check may need to resolve commands, do it last
+            if supported is not None and overlay.is_supported() != supported:
+                return False
+            return True
+
+        selection = [self.overlays[name] for name in names
+                     if wanted(self.overlays[name])]
+        selection.sort(key=SORT_KEYS[sort], reverse=reverse)
+
+        total = len(selection)
+        offset = max(int(offset or 0), 0)
+        if limit is None:
+            page = selection[offset:]
+        else:
+            page = selection[offset:offset + max(int(limit), 0)]
+
+        return total, [overlay.to_record() for overlay in page]
+
+
+    def records(self, repos=None):
+        '''
+        Yields the Overlay.to_record() dictionaries of the overlays in
+        name order, one at a time.
+
+        @param repos: optional collection of overlay names to restrict
+                      the records to.
+        '''
+        if repos is not None:
+            repos = set(repos)
+        for name in self._name_index():
+            if repos is not None and name not in repos:
+                continue
+            yield self.overlays[name].to_record()
 
-        return result
 
     def list_ids(self):
         """returns a list of the overlay names
@@ -257,9 +257,12 @@ class DebugMessage(Message):
     #############################################################################
     ## Output Functions
 
-    def debug (self, message, level = DEBUG_LEVEL):
+    def debug (self, message, level = DEBUG_LEVEL, *args):
         '''
         This is a generic debugging method.
+
+        The message may be passed lazily as a format string plus its
+        arguments or as a callable; see Message.debug().
         '''
         ## Check the debug level first. This is the most inexpensive check.
         if level > self.debug_lev:
@@ -312,6 +315,7 @@ class DebugMessage(Message):
             not str(callerobject.__class__.__name__) in self.debug_obj):
             return
 
+        message = self._lazy(message, args)
         if type(message) not in types.StringTypes:
             message = str(message)
 
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN DRIFT CHECK
+#################################################################################
+# File:       drift.py
+#
+#             Compares the installed overlays against the remote lists
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Finds installed overlays whose type or source no longer matches the
+cached remote lists.  Works on the parsed catalogs only, so no network or
+VCS access is needed.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import sys
+
+#===============================================================================
+#
+# Constants
+#
+#-------------------------------------------------------------------------------
+
+DRIFT_OK = 'ok'
+DRIFT_MISSING = 'missing'
+DRIFT_TYPE = 'type'
+DRIFT_SOURCE = 'source'
+
+#===============================================================================
+#
+# Functions
+#
+#-------------------------------------------------------------------------------
+
+def check_drift(installed, remote, names=None):
+    '''
+    Compares installed overlays against their remote definitions.
+
+    @param installed: {name: Overlay} of the installed db.
+    @param remote: {name: Overlay} of the remote db.
+    @param names: iterable of overlay names to check, defaults to all
+                  installed overlays; names not installed are skipped.
+    @rtype dict: {name: {'status': one of the DRIFT_* constants,
+                         'current_type': str, 'remote_type': str or None,
+                         'current_src': str, 'remote_srcs': sorted list}}
+
+    A changed overlay type takes precedence over a changed source, as the
+    overlay has to be re-added in that case.
+    '''
+    if names is None:
+        names = installed
+    report = {}
+    for name in names:
+        odb = installed.get(name)
+        if odb is None:
+            continue
+        current = odb.sources[0]
+        entry = {
+            'status': DRIFT_OK,
+            'current_type': current.type,
+            'remote_type': None,
+            'current_src': current.src,
+            'remote_srcs': [],
+            }
+        report[name] = entry
+
+        ordb = remote.get(name)
+        if ordb is None:
+            entry['status'] = DRIFT_MISSING
+            continue
+        entry['remote_type'] = ordb.sources[0].type
+        remote_srcs = set(s.src for s in ordb.sources)
+        entry['remote_srcs'] = sorted(remote_srcs)
+
+        if entry['remote_type'] not in current.type:
+            entry['status'] = DRIFT_TYPE
+        elif current.src not in remote_srcs:
+            entry['status'] = DRIFT_SOURCE
+    return report
+
+
+def drift_message(name, entry):
+    '''
+    Returns the user message explaining the drift of an overlay.
+
+    @param name: str overlay name.
+    @param entry: dict, an entry of the check_drift() report.
+    @rtype str
+    '''
+    status = entry['status']
+    if status == DRIFT_MISSING:
+        return 'Overlay "%s" could not be found in the remote lists.\n' \
+               'Please check if it has been renamed and re-add if ' \
+               'necessary.' % name
+    if status == DRIFT_TYPE:
+        return 'The overlay type of overlay "%(repo_name)s" seems to have changed.\n'\
+               'The current overlay type is:\n'\
+               '\n'\
+               '  %(current_type)s\n'\
+               '\n'\
+               'while the remote overlay is of type:\n'\
+               '\n'\
+               '  %(remote_type)s\n'\
+               '\n'\
+               'the overlay will be readded using %(remote_type)s' %\
+               ({
+                   'repo_name': name,
+                   'current_type': entry['current_type'],
+                   'remote_type': entry['remote_type'],
+               })
+    if status == DRIFT_SOURCE:
+        available_srcs = entry['remote_srcs']
+        if len(available_srcs) == 1:
+            plural = ''
+            candidates = '  %s' % available_srcs[0]
+        else:
+            plural = 's'
+            candidates = '\n'.join(('  %d. %s' % (ovl + 1, v)) \
+                for ovl, v in enumerate(available_srcs))
+        return 'The source of the overlay "%(repo_name)s" seems to have changed.\n'\
+               'You currently sync from\n'\
+               '\n'\
+               '  %(current_src)s\n'\
+               '\n'\
+               'while the remote lists report\n'\
+               '\n'\
+               '%(candidates)s\n'\
+               '\n'\
+               'as correct location%(plural)s.\n'\
+               '\n'\
+               'Repo: "%(repo_name)s" was automatically updated...' %\
+               ({
+                  'repo_name': name,
+                  'current_src': entry['current_src'],
+                  'candidates': candidates,
+                  'plural': plural,
+               })
+    return ''
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN LOCKING
+#################################################################################
+# File:       locking.py
+#
+#             Cross-process locks on the layman storage directory
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Named flock(2) locks shared by all layman processes working on the same
+storage directory.
+
+Readers take shared locks, writers exclusive ones.  Locks are re-entrant
+within a process and record how long they had to be waited for.
+
+>>> import shutil, tempfile
+>>> from layman.output import Message
+>>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+>>> locks = LockManager(tmpdir, Message())
+>>> with locks.lock(INSTALLED_LOCK):
+...     with locks.lock(INSTALLED_LOCK, shared=True):
+...         sorted(locks.held())
+['installed']
+>>> locks.held()
+{}
+>>> [(name, mode) for name, mode, waited in locks.waits]
+[('installed', 'exclusive')]
+>>> shutil.rmtree(tmpdir)
+'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import errno
+import os
+import sys
+import time
+
+from   contextlib            import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#===============================================================================
+#
+# Constants
+#
+#-------------------------------------------------------------------------------
+
+SHARED = 'shared'
+EXCLUSIVE = 'exclusive'
+
+# installed.xml and the repo config files
+INSTALLED_LOCK = 'installed'
+# the cached remote lists
+CACHE_LOCK = 'cache'
+# the checkout of a single overlay, see overlay_lock()
+OVERLAY_LOCK = 'overlay-%s'
+# the sync journal
+JOURNAL_LOCK = 'journal'
+# the source statistics
+STATS_LOCK = 'stats'
+
+#===============================================================================
+#
+# Functions
+#
+#-------------------------------------------------------------------------------
+
+def overlay_lock(name):
+    '''Returns the lock name guarding the checkout of an overlay.'''
+    return OVERLAY_LOCK % name
+
+#===============================================================================
+#
+# Class LockManager
+#
+#-------------------------------------------------------------------------------
+
+class LockManager(object):
+    '''
+    Hands out the named locks kept as files in directory.
+
+    Lock ordering: an overlay lock is always taken before the installed
+    lock, never the other way round.
+
+    If the lock file cannot be opened, e.g. because an unprivileged user
+    lists the overlays of a root owned storage, or flock(2) is not
+    available, the locked code runs unlocked.
+    '''
+
+    def __init__(self, directory, output):
+        self.directory = directory
+        self.output = output
+        # {name: [file descriptor, mode]}
+        self._held = {}
+        # [(name, mode, seconds waited), ...]
+        self.waits = []
+
+
+    def held(self):
+        '''Returns {name: mode} of the locks held by this process.'''
+        return dict((name, held[1]) for name, held in self._held.items())
+
+
+    def wait_time(self):
+        '''Returns the total number of seconds spent waiting for locks.'''
+        return sum(waited for name, mode, waited in self.waits)
+
+
+    def _open(self, name):
+        '''
+        Returns a file descriptor of the lock file, None if it cannot be
+        opened.
+        '''
+        if fcntl is None:
+            return None
+        path = os.path.join(self.directory, name + '.lock')
+        try:
+            # the storage directory itself is not created here
+            if not os.path.isdir(self.directory):
+                os.mkdir(self.directory)
+            return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            pass
+        try:
+            return os.open(path, os.O_RDONLY)
+        except OSError as error:
+            self.output.debug('LockManager: not locking "%s": %s', 6,
+                path, error)
+            return None
+
+
+    def _acquire(self, fd, name, mode, wait=True):
+        '''
+        Locks fd, waiting for other processes if need be.
+
+        @rtype bool: False if the lock is busy and wait is False.
+        '''
+        operation = fcntl.LOCK_SH if mode == SHARED else fcntl.LOCK_EX
+        start = time.time()
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        except (IOError, OSError) as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            if not wait:
+                return False
+            self.output.info('Waiting for another layman process to '
+                'release the "%s" lock...' % name, 2)
+            fcntl.flock(fd, operation)
+        waited = time.time() - start
+        self.waits.append((name, mode, waited))
+        self.output.debug('LockManager: %s lock "%s" acquired after %.3fs',
+            6, mode, name, waited)
+        return True
+
+
+    @contextmanager
+    def lock(self, name, shared=False, wait=True):
+        '''
+        Holds the named lock for the duration of the with block.
+
+        A lock already held by this process is re-entered.  Requesting
+        an exclusive lock while holding a shared one upgrades it until
+        the inner block ends.
+
+        The with block gets whether the lock is held: with wait=False a
+        lock held by another process is not waited for and the block
+        gets False.
+        '''
+        mode = SHARED if shared else EXCLUSIVE
+        held = self._held.get(name)
+        if held is not None:
+            if shared or held[1] == EXCLUSIVE:
+                yield True
+                return
+            if not self._acquire(held[0], name, EXCLUSIVE, wait):
+                yield False
+                return
+            held[1] = EXCLUSIVE
+            try:
+                yield True
+            finally:
+                fcntl.flock(held[0], fcntl.LOCK_SH)
+                held[1] = SHARED
+            return
+
+        fd = self._open(name)
+        if fd is None:
+            yield True
+            return
+        try:
+            if not self._acquire(fd, name, mode, wait):
+                yield False
+                return
+            self._held[name] = [fd, mode]
+            try:
+                yield True
+            finally:
+                del self._held[name]
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -90,11 +90,11 @@ class Mounter(object):
         @rtype dict {'ovl1': 'Squashfs',...}
         '''
         mountable_ovls = {}
+        database = self.database()
 
-        for key in sorted(self.installed):
-            for ovl_type in self.installed[key].source_types():
-                if ovl_type in MOUNT_TYPES:
-                    mountable_ovls[key] = ovl_type
+        for ovl_type in MOUNT_TYPES:
+            for key in database.lookup('type', ovl_type):
+                mountable_ovls[key] = ovl_type
         return mountable_ovls
 
 
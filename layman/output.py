@@ -99,6 +99,22 @@ class MessageBase(object):
     def set_debug_level(self, debugging_level = DEBUG_LEVEL):
         self.debug_lev = debugging_level
 
+    @staticmethod
+    def _lazy(message, args):
+        """builds the text of a lazily passed message: a callable is
+        called, format arguments are applied
+
+        >>> MessageBase._lazy('%s of %d', ('one', 2))
+        'one of 2'
+        >>> MessageBase._lazy(lambda: 'built late', ())
+        'built late'
+        """
+        if callable(message):
+            message = message()
+        if args:
+            message = message % args
+        return message
+
     def do_error_callback(self, error):
         """runs the error_callback function with the error
         that occurred
@@ -129,16 +145,24 @@ class Message(MessageBase):
 
     ## Output Functions
 
-    def debug(self, info, level = OFF):
-        """empty debug function, does nothing,
-        declared here for compatibility with DebugMessage
-        """
-        if type(info) != str:#not in types.StringTypes:
-            info = encode(info)
+    def debug(self, info, level = OFF, *args):
+        """prints info if level is selected, declared here for
+        compatibility with DebugMessage.
 
+        The message is only built once the level check passed, so
+        expensive messages should be passed lazily, either as a format
+        string followed by its arguments or as a callable returning
+        the text:
+
+            output.debug('Parsing overlay: %s', 9, overlay)
+        """
         if level > self.debug_lev:
             return
 
+        info = self._lazy(info, args)
+        if type(info) != str:#not in types.StringTypes:
+            info = encode(info)
+
         for i in info.split('\n'):
             print(self.color_func('yellow', 'DEBUG: ') + i, file=self.std_out)
 
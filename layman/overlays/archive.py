@@ -12,10 +12,7 @@ from  layman.constants         import MOUNT_TYPES
 from  layman.compatibility     import fileopen
 from  layman.overlays.source   import OverlaySource, require_supported
 from  layman.utils             import path
-from  layman.version           import VERSION
-from  sslfetch.connections     import Connector
-
-USERAGENT = "Layman-" + VERSION
+from  layman.connections       import connection_pool, connector
 
 class ArchiveOverlay(OverlaySource):
 
@@ -54,7 +51,7 @@ class ArchiveOverlay(OverlaySource):
                 'kwargs-error': {'level': None},
             }
 
-            fetcher = Connector(connector_output, self.proxies, USERAGENT)
+            fetcher = connector(self.config, connector_output, self.proxies)
 
             success, archive, timestamp = fetcher.fetch_content(archive_url)
 
@@ -76,6 +73,18 @@ class ArchiveOverlay(OverlaySource):
         return pkg
 
 
+    def probe(self, timeout):
+        '''
+        Sends a HEAD request for the archive.
+
+        @rtype bool or None if it cannot be sent.
+        '''
+        if 'file://' in self.src:
+            return os.path.exists(self.src.replace('file://', ''))
+        return connection_pool(self.config).head(self.src, self.proxies,
+                                                 timeout)
+
+
     def _add_unchecked(self, base):
         def try_to_wipe(folder):
             if not os.path.exists(folder):
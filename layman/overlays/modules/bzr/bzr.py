@@ -42,6 +42,8 @@ class BzrOverlay(OverlaySource):
 
     type = 'Bzr'
     type_key = 'bzr'
+    revision_args = ['revno']
+    probe_args = ['revno']
 
     def __init__(self, parent, config, _location, ignore = 0):
 
@@ -41,6 +41,7 @@ class DarcsOverlay(OverlaySource):
 
     type = 'Darcs'
     type_key = 'darcs'
+    revision_args = ['log', '--last=1']
 
     def __init__(self, parent, config, _location, ignore = 0):
 
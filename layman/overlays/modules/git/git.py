@@ -42,6 +42,8 @@ class GitOverlay(OverlaySource):
 
     type = 'Git'
     type_key = 'git'
+    revision_args = ['rev-parse', 'HEAD']
+    probe_args = ['ls-remote', '--heads']
 
     def __init__(self, parent, config, _location, ignore = 0):
         super(GitOverlay, self).__init__(parent, config,
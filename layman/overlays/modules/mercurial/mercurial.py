@@ -44,6 +44,8 @@ class MercurialOverlay(OverlaySource):
 
     type = 'Mercurial'
     type_key = 'mercurial'
+    revision_args = ['id', '-i']
+    probe_args = ['identify']
 
     def __init__(self, parent, config,
         _location, ignore = 0):
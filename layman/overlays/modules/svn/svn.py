@@ -45,6 +45,8 @@ class SvnOverlay(OverlaySource):
 
     type = 'Subversion'
     type_key = 'svn'
+    revision_args = ['info', '--show-item', 'revision']
+    probe_args = ['info']
 
     def __init__(self, parent, config, _location,
             ignore = 0):
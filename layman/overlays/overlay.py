@@ -32,7 +32,10 @@ __version__ = "0.2"
 
 import sys, re, os, os.path
 import codecs
+import hashlib
+import json
 import locale
+import time
 import xml.etree.ElementTree as ET # Python 2.5
 
 from  layman.compatibility import encode
@@ -49,98 +52,164 @@ MOD_PATH = path = os.path.join(os.path.dirname(__file__), 'modules')
 QUALITY_LEVELS = 'core|stable|testing|experimental|graveyard'.split('|')
 
 WHITESPACE_REGEX = re.compile('\s+')
+SPACES_REGEX = re.compile(' +')
+NEWLINE_SPACE_REGEX = re.compile('\n ')
 
+#===============================================================================
+#
+# Functions
+#
+#-------------------------------------------------------------------------------
+
+def _strip_text(node):
+    res = node.text
+    if res is None:
+        return ''
+    return res.strip()
+
+
+def overlay_record(xml):
+    '''
+    Extracts the definition of an overlay from its xml element into a
+    record of plain strings, lists and tuples, see Overlay.from_record().
+    Unlike the element, a record can be pickled, so catalogs can be
+    parsed in other processes.
+
+    >>> here = os.path.dirname(os.path.realpath(__file__))
+    >>> document = ET.parse(here + '/../tests/testfiles/global-overlays.xml')
+    >>> record = overlay_record(document.findall('overlay')[0])
+    >>> record['name'], record['sources'], record['owner_email']
+    ('wrobel', [('https://overlays.gentoo.org/svn/dev/wrobel', 'svn', '')], 'nobody@gentoo.org')
+    >>> record['status'], record['quality'], record['priority']
+    ('official', None, '10')
+    '''
+    _name = xml.find('name')
+    if _name != None:
+        name = encode(_strip_text(_name))
+    elif 'name' in xml.attrib:
+        name = encode(xml.attrib['name'])
+    else:
+        name = None
+
+    sources = []
+    _sources = xml.findall('source')
+    # new xml format
+    if _sources != []:
+        for e in _sources:
+            if 'type' in e.attrib:
+                sources.append((encode(_strip_text(e)), e.attrib['type'],
+                                e.attrib.get('branch', '')))
+    #old xml format
+    elif ('src' in xml.attrib) and ('type' in xml.attrib):
+        sources.append((encode(xml.attrib['src'].strip()),
+                        xml.attrib['type'], ''))
+
+    owner_name = owner_email = None
+    _owner = xml.find('owner')
+    _email = _owner.find('email') if _owner != None else None
+    if _email != None:
+        owner_email = encode(_strip_text(_email))
+        _owner_name = _owner.find('name')
+        if _owner_name != None:
+            owner_name = encode(_strip_text(_owner_name))
+    elif 'contact' in xml.attrib:
+        owner_email = encode(xml.attrib['contact'])
+
+    h = xml.find('homepage')
+    l = xml.find('link')
+    if h != None:
+        homepage = encode(_strip_text(h))
+    elif l != None:
+        homepage = encode(_strip_text(l))
+    else:
+        homepage = None
+
+    _irc = xml.find('irc')
+
+    return {
+        'name': name,
+        'sources': sources,
+        'owner_name': owner_name,
+        'owner_email': owner_email,
+        'descriptions': [encode(WHITESPACE_REGEX.sub(' ', _strip_text(d)))
+                         for d in xml.findall('description')],
+        'status': encode(xml.attrib['status'])
+                  if 'status' in xml.attrib else None,
+        'quality': encode(xml.attrib['quality'])
+                   if 'quality' in xml.attrib else None,
+        'priority': xml.attrib.get('priority'),
+        'homepage': homepage,
+        'feeds': [encode(_strip_text(e)) for e in xml.findall('feed')],
+        'irc': encode(_strip_text(_irc)) if _irc != None else None,
+        }
+
+#===============================================================================
+#
+# Class Overlay
+#
+#-------------------------------------------------------------------------------
 
 class Overlay(object):
     ''' Derive the real implementations from this.'''
 
     def __init__(self, config, xml=None, ovl_dict=None,
-        ignore = 0):
+        ignore = 0, record=None):
         self.config = config
         self.output = config['output']
         self.module_controller = Modules(path=MOD_PATH,
                                          namepath='layman.overlays.modules',
                                          output=self.output)
         self._encoding_ = get_encoding(self.output)
+        # see refresh_fingerprint()
+        self.fingerprint = None
 
         if xml is not None:
             self.from_xml(xml, ignore)
         elif ovl_dict is not None:
             self.from_dict(ovl_dict, ignore)
+        elif record is not None:
+            self.from_record(record, ignore)
 
 
     def from_xml(self, xml, ignore):
         """Process an xml overlay definition
         """
-        def strip_text(node):
-            res = node.text
-            if res is None:
-                return ''
-            return res.strip()
+        self.from_record(overlay_record(xml), ignore)
 
-        _name = xml.find('name')
-        if _name != None:
-            self.name = encode(strip_text(_name))
-        elif 'name' in xml.attrib:
-            self.name = encode(xml.attrib['name'])
-        else:
-            raise Exception('Overlay from_xml(), "' + self.name + \
-                'is missing a "name" entry!')
 
-        _sources = xml.findall('source')
-        # new xml format
-        if _sources != []:
-            _sources = [e for e in _sources if 'type' in e.attrib]
-        #old xml format
-        elif ('src' in xml.attrib) and ('type' in xml.attrib):
-            s = ET.Element('source', type=xml.attrib['type'])
-            s.text = xml.attrib['src']
-            _sources = [s]
-            del s
-
-        def create_overlay_source(source_elem):
-            _branch = ''
-            _type = source_elem.attrib['type']
+    def from_record(self, record, ignore):
+        """Process an overlay record as returned by overlay_record()
+        """
+        self.name = record['name']
+        if self.name is None:
+            raise Exception('Overlay from_xml(), an overlay is missing a '
+                '"name" entry!')
+
+        def create_overlay_source(source_):
+            _location, _type, _branch = source_
             self.ovl_type = _type
-            if 'branch' in source_elem.attrib:
-                _branch = source_elem.attrib['branch']
 
             try:
                 _class = self.module_controller.get_class(_type)
             except InvalidModuleName:
                 _class = self.module_controller.get_class('stub')
 
-            _location = encode(strip_text(source_elem))
-
             self.branch = _branch
 
             return _class(parent=self, config=self.config,
                 _location=_location, ignore=ignore)
 
-        if not len(_sources):
+        if not len(record['sources']):
             raise Exception('Overlay from_xml(), "' + self.name + \
                 '" is missing a "source" entry!')
 
-        self.sources = [create_overlay_source(e) for e in _sources]
+        self.sources = [create_overlay_source(e) for e in record['sources']]
 
-        _owner = xml.find('owner')
-        if _owner == None:
-            _email = None
-        else:
-            _email = _owner.find('email')
-        if _owner != None and _email != None:
-            self.owner_email = encode(strip_text(_email))
-            _name = _owner.find('name')
-            if _name != None:
-                self.owner_name = encode(strip_text(_name))
-            else:
-                self.owner_name = None
-        elif 'contact' in xml.attrib:
-            self.owner_email = encode(xml.attrib['contact'])
-            self.owner_name = None
+        self.owner_name = record['owner_name']
+        if record['owner_email'] is not None:
+            self.owner_email = record['owner_email']
         else:
             self.owner_email = ''
-            self.owner_name = None
             if not ignore:
                 raise Exception('Overlay  from_xml(), "' + self.name + \
                     '" is missing an "owner.email" entry!')
@@ -148,59 +217,30 @@ class Overlay(object):
                 self.output.warn('Overlay "' + self.name + '" is missing a '
                          '"owner.email" entry!', 4)
 
-        _desc = xml.findall('description')
-        if _desc != None:
-            self.descriptions = []
-            for d in _desc:
-                d = WHITESPACE_REGEX.sub(' ', strip_text(d))
-                self.descriptions.append(encode(d))
-        else:
-            self.descriptions = ['']
-            if not ignore:
-                raise Exception('Overlay  from_xml(), "' + self.name + \
-                    '" is missing a description" entry!')
-            elif ignore == 1:
-                self.output.warn('Overlay "' + self.name + '" is missing a '
-                         '"description" entry!', 4)
+        self.descriptions = list(record['descriptions'])
 
-        if 'status' in xml.attrib:
-            self.status = encode(xml.attrib['status'])
-        else:
-            self.status = None
+        self.status = record['status']
 
         self.quality = 'experimental'
-        if 'quality' in xml.attrib:
-            if xml.attrib['quality'] in set(QUALITY_LEVELS):
-                self.quality = encode(xml.attrib['quality'])
+        if record['quality'] in set(QUALITY_LEVELS):
+            self.quality = record['quality']
 
-        if 'priority' in xml.attrib:
-            self.priority = int(xml.attrib['priority'])
+        if record['priority'] is not None:
+            self.priority = int(record['priority'])
         else:
             self.priority = 50
 
-        h = xml.find('homepage')
-        l = xml.find('link')
-        if h != None:
-            self.homepage = encode(strip_text(h))
-        elif l != None:
-            self.homepage = encode(strip_text(l))
-        else:
-            self.homepage = None
+        self.homepage = record['homepage']
+        self.feeds = list(record['feeds'])
+        self.irc = record['irc']
 
-        self.feeds = [encode(strip_text(e)) \
-            for e in xml.findall('feed')]
-
-        _irc = xml.find('irc')
-        if _irc != None:
-            self.irc = encode(strip_text(_irc))
-        else:
-            self.irc = None
+        self.refresh_fingerprint()
 
 
     def from_dict(self, overlay, ignore):
         """Process an overlay dictionary definition
         """
-        self.output.debug("Overlay from_dict(); overlay" + str(overlay), 6)
+        self.output.debug("Overlay from_dict(); overlay%s", 6, overlay)
         _name = overlay['name']
         if _name != None:
             self.name = encode(_name)
@@ -297,21 +337,30 @@ class Overlay(object):
         else:
             self.irc = None
 
+        self.refresh_fingerprint()
         #xml = self.to_xml()
         # end of from_dict
 
 
+    def refresh_fingerprint(self):
+        '''
+        Computes self.fingerprint, a SHA-256 of everything to_xml() writes
+        about the overlay, the sources in no particular order.  Overlays
+        with the same definition have the same fingerprint.  It is
+        computed when the overlay is parsed, so code changing the overlay
+        afterwards has to call this again.
+        '''
+        content = [self.name, self.owner_name, self.owner_email,
+                   self.descriptions, self.status, self.quality,
+                   self.priority, self.homepage, self.feeds or [], self.irc,
+                   sorted((s.src, s.__class__.type_key, s.branch or '')
+                          for s in self.sources)]
+        self.fingerprint = hashlib.sha256(json.dumps(content)
+            .encode('utf-8')).hexdigest()
+
+
     def __eq__(self, other):
-        for i in ('descriptions', 'homepage', 'name', 'owner_email',
-                'owner_name', 'priority', 'status'):
-            if getattr(self, i) != getattr(other, i):
-                return False
-        for i in self.sources + other.sources:
-            if not i in self.sources:
-                return False
-            if not i in other.sources:
-                return False
-        return True
+        return self.fingerprint == other.fingerprint
 
 
     def __ne__(self, other):
@@ -321,6 +370,13 @@ class Overlay(object):
     def set_priority(self, priority):
         '''Set the priority of this overlay.'''
         self.priority = int(priority)
+        self.refresh_fingerprint()
+
+
+    def set_source(self, src):
+        '''Points the source of this installed overlay at src.'''
+        self.sources[0].src = src
+        self.refresh_fingerprint()
 
 
     def to_xml(self):
@@ -376,20 +432,37 @@ class Overlay(object):
         return repo
 
 
-    def add(self, base):
+    def add(self, base, stats=None, probe=None):
+        '''
+        Adds the overlay from the first of its sources that works.  With
+        a layman.sourcestats.SourceStats instance the sources are tried
+        fastest healthy one first and the outcome of each is recorded.
+        With a probe timeout as well, all sources are probed in parallel
+        first, see SourceStats.probe().
+        '''
         res = 1
         first_s = True
-        for s in self.sources:
+        sources = self.sources
+        if stats is not None:
+            if probe is not None and len(sources) > 1:
+                stats.probe(sources, probe)
+            sources = stats.rank(sources, key=lambda s: s.src)
+        for s in sources:
             if not first_s:
                 self.output.info("\nTrying next source of listed sources...", 4)
+            start = time.time()
             try:
                 res = s.add(base)
-                if res == 0:
-                    # Worked, throw other sources away
-                    self.sources = [s]
-                    break
             except Exception as error:
                 self.output.warn(str(error), 4)
+                res = 1
+            if stats is not None:
+                stats.record(s.src, res == 0, time.time() - start)
+            if res == 0:
+                # Worked, throw other sources away
+                self.sources = [s]
+                self.refresh_fingerprint()
+                break
             first_s = False
         return res
 
@@ -411,7 +484,7 @@ class Overlay(object):
                     if res == 0:
                         # Updating it worked, no need to bother 
                         # checking other sources.
-                        self.sources[0].src = src
+                        self.set_source(src)
                         result = True
                         break
                 except Exception as error:
@@ -423,7 +496,7 @@ class Overlay(object):
             # so it can be written to the installed.xml.
             self.output.debug("overlay.update(); type: %s does not support"\
                 " source URL updating" % self.sources[0].type, 4)
-            self.sources[0].src = available_srcs.pop()
+            self.set_source(available_srcs.pop())
             result = True
         return (self.sources, result)
 
@@ -434,6 +507,12 @@ class Overlay(object):
         return self.sources[0].sync(base)
 
 
+    def revision(self, base):
+        '''Returns the checked out revision, None if it is unknown.'''
+        assert len(self.sources) == 1
+        return self.sources[0].revision(base)
+
+
     def delete(self, base):
         assert len(self.sources) == 1
         return self.sources[0].delete(base)
@@ -473,16 +552,16 @@ class Overlay(object):
 
 
         for description in self.descriptions:
-            description = re.compile(' +').sub(' ', description)
-            description = re.compile('\n ').sub('\n', description)
+            description = SPACES_REGEX.sub(' ', description)
+            description = NEWLINE_SPACE_REGEX.sub('\n', description)
             result += '\nDescription:'
             result += '\n  '.join(('\n' + description).split('\n'))
             result += '\n'
 
         if self.homepage != None:
             link = self.homepage
-            link = re.compile(' +').sub(' ', link)
-            link = re.compile('\n ').sub('\n', link)
+            link = SPACES_REGEX.sub(' ', link)
+            link = NEWLINE_SPACE_REGEX.sub('\n', link)
             result += '\nLink:'
             result += '\n  '.join(('\n' + link).split('\n'))
             result += '\n'
@@ -529,6 +608,32 @@ class Overlay(object):
         return encoder(name + mtype + source, self._encoding_)
 
 
+    def to_record(self):
+        '''
+        Returns a plain dictionary of the overlay information, without
+        any pre-formatted strings.
+
+        @rtype dict
+        '''
+        return {
+            'name': self.name,
+            'owner_name': self.owner_name,
+            'owner_email': self.owner_email,
+            'homepage': self.homepage,
+            'irc': self.irc,
+            'description': list(self.descriptions),
+            'feeds': self.feeds,
+            'sources': [(e.src, e.type, e.branch) for e in self.sources],
+            'src_uris': list(self.source_uris()),
+            'src_types': list(self.source_types()),
+            'priority': self.priority,
+            'quality': self.quality,
+            'status': self.status,
+            'official': self.is_official(),
+            'supported': self.is_supported(),
+            }
+
+
     def is_official(self):
         '''Is the overlay official?'''
         return self.status == 'official'
@@ -20,7 +20,7 @@ import copy
 import sys
 import shutil
 import subprocess
-from layman.utils import path, resolve_command, run_command
+from layman.utils import command_output, path, resolve_command, run_command
 
 supported_cache = {}
 
@@ -49,6 +49,10 @@ def require_supported(binaries, _output):
 class OverlaySource(object):
 
     type_key = None
+    # arguments making the command print the checked out revision
+    revision_args = None
+    # arguments making the command query the source URL appended to them
+    probe_args = None
 
     def __init__(self, parent, config, _location,
             ignore = 0):
@@ -90,6 +94,33 @@ class OverlaySource(object):
         '''Sync the overlay.'''
         pass
 
+    def revision(self, base):
+        '''
+        Returns the checked out revision of the overlay, None if the
+        overlay type has no revisions or it cannot be determined.
+        '''
+        if self.revision_args is None:
+            return None
+        target = path([base, self.parent.name])
+        if not os.path.isdir(target):
+            return None
+        return command_output(self.config, self.command(),
+                              list(self.revision_args), cwd=target)
+
+    def probe(self, timeout):
+        '''
+        Checks cheaply whether the source answers within timeout seconds.
+
+        @rtype bool or None if the overlay type cannot be probed.
+        '''
+        if self.probe_args is None:
+            return None
+        if not self.is_supported():
+            return False
+        return command_output(self.config, self.command(),
+                              self.probe_args + [self.src],
+                              timeout=timeout) is not None
+
     def delete(self, base):
         '''Delete the overlay.'''
         mdir = path([base, self.parent.name])
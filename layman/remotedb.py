@@ -27,8 +27,11 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 #-------------------------------------------------------------------------------
 
 import os, os.path
+import subprocess
 import sys
 import hashlib
+import json
+import time
 
 GPG_ENABLED = False
 try:
@@ -39,13 +42,70 @@ except ImportError:
     pass
 
 
-from   layman.utils             import encoder
+from   layman.utils             import atomic_write, encoder
 from   layman.dbbase            import DbBase
-from   layman.version           import VERSION
 from   layman.compatibility     import fileopen
-from   sslfetch.connections     import Connector
+from   layman.search            import SearchIndex
+from   layman.catalogdiff       import CatalogDiff
+from   layman.connections       import connector
+
+# keyring files whose changes invalidate cached signature verifications,
+# public-keys.d/ is where gpg 2.4 keeps the keys when keyboxd is used
+KEYRING_FILES = ['pubring.kbx', 'pubring.gpg', 'trustdb.gpg',
+                 'public-keys.d/pubring.db', 'public-keys.d/pubring.db-wal']
+
+# {$GNUPGHOME: the homedir gpg uses with it}, see gpg_homedir()
+_GPG_HOMEDIRS = {}
+
+
+def sha256(data):
+    '''Returns the hex sha256 of str or bytes data.'''
+    if not isinstance(data, bytes):
+        data = data.encode('UTF-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def gpg_homedir():
+    '''
+    Returns the home directory gpg uses, as reported by gpgconf.  Without
+    a working gpgconf it is $GNUPGHOME or ~/.gnupg.
+    '''
+    env = os.environ.get('GNUPGHOME')
+    if env not in _GPG_HOMEDIRS:
+        homedir = None
+        try:
+            with open(os.devnull, 'w') as devnull:
+                homedir = subprocess.check_output(
+                    ['gpgconf', '--list-dirs', 'homedir'],
+                    stderr=devnull).decode('UTF-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        if homedir:
+            # gpgconf percent-escapes colons
+            homedir = homedir.replace('%3a', ':').replace('%25', '%')
+        else:
+            homedir = env or os.path.expanduser('~/.gnupg')
+        _GPG_HOMEDIRS[env] = homedir
+    return _GPG_HOMEDIRS[env]
+
+
+def keyring_state(homedir=None):
+    '''
+    Returns a digest of the size and mtime of the gpg keyring files in
+    homedir or the one gpg uses, see gpg_homedir(), which changes
+    whenever keys are imported, removed or their trust is changed.
+    '''
+    if homedir is None:
+        homedir = gpg_homedir()
+    state = []
+    for name in KEYRING_FILES:
+        try:
+            info = os.stat(os.path.join(homedir, name))
+        except OSError:
+            continue
+        state.append('%s %d %r' % (name, info.st_size, info.st_mtime))
+    return sha256('\n'.join(state))
 
-USERAGENT = "Layman-" + VERSION
 
 class RemoteDB(DbBase):
     '''Handles fetching the remote overlay list.'''
@@ -57,7 +117,9 @@ class RemoteDB(DbBase):
         self.detached_urls = []
         self.signed_urls = []
         self.proxies = config.proxies
-        
+        self._search_index = None
+        self.last_diff = None
+
         self.urls  = [i.strip()
             for i in config['overlays'].split('\n') if len(i)]
 
@@ -68,8 +130,8 @@ class RemoteDB(DbBase):
                 'bypassing...', 2)
 
         # add up the lists to load for display, etc.
-        # unsigned overlay lists
-        paths = [self.filepath(i) + '.xml' for i in self.urls]
+        # unsigned overlay lists, local ones are read in place
+        paths = [self.list_path(i) for i in self.urls]
         # detach-signed lists
         paths.extend([self.filepath(i[0]) + '.xml' for i in self.detached_urls])
         # single file signed, compressed, clearsigned
@@ -101,14 +163,79 @@ class RemoteDB(DbBase):
         return 'Try running "sudo layman -f" to re-fetch that file'
 
 
+    # overrider
+    def readable(self, path):
+        '''Cached lists that do not match their metadata are not read.'''
+        return self.cache_intact(path)
+
+
+    def read_file(self, path):
+        '''
+        Reads a cached list unless it does not match its metadata.
+        '''
+        if self.readable(path):
+            DbBase.read_file(self, path)
+
+
+    @staticmethod
+    def meta_path(mpath):
+        '''Returns the path of the metadata file of a cached list.'''
+        return mpath + '.meta'
+
+
+    @classmethod
+    def read_meta(cls, mpath):
+        '''
+        Returns the recorded {'sha256', 'size', 'timestamp'} of a cached
+        list, None if there is no (readable) metadata file.
+        '''
+        try:
+            with fileopen(cls.meta_path(mpath), 'r') as meta_file:
+                return json.loads(meta_file.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def cache_intact(self, mpath):
+        '''
+        Compares the size of a cached list to its metadata, a cheap way
+        to tell a complete file from a truncated or otherwise mangled
+        one without parsing it.  Lists without metadata, like local ones
+        read in place, are assumed to be intact.
+
+        @rtype bool
+        '''
+        meta = self.read_meta(mpath)
+        if meta is None:
+            return True
+        try:
+            size = os.path.getsize(mpath)
+        except OSError:
+            # leave the error handling to read_file()
+            return True
+        if size == meta.get('size'):
+            return True
+        self.output.warn('The cached overlay list %s is %d bytes, but %d '
+            'bytes were recorded; skipping it.\n%s'
+            % (mpath, size, meta.get('size'), self._broken_catalog_hint()))
+        return False
+
+
     def cache(self):
         '''
         Copy the remote overlay list to the local cache.
 
+        The differences between the previously cached lists and the
+        updated ones are kept in self.last_diff.
+
         @rtype tuple: reflects whether the cache has updates and whether or not
         the cache retrieval was successful.
         '''
         has_updates = False
+        # read() below merges the downloads into self.overlays
+        previous = dict(self.overlays)
+        previous_fingerprint = self.fingerprint()
+        self.last_diff = None
         self._create_storage(self.config['storage'])
         # succeeded reset when a failure is detected
         succeeded = True
@@ -121,20 +248,24 @@ class RemoteDB(DbBase):
             'kwargs-info': {'level': 2},
             'kwargs-error':{'level': None},
         }
-        fetcher = Connector(connector_output, self.proxies, USERAGENT)
+        fetcher = connector(self.config, connector_output, self.proxies)
 
         for index in range(0, 3):
             self.output.debug("RemoteDB.cache() index = %s" %str(index), 2)
             urls = url_lists[index]
-            if need_gpg[index] and len(urls) and self.gpg is None:
-                #initialize our gpg instance
-                self.init_gpg()
+            # gpg is only started once a list needs verifying
             # main working loop
             for url in urls:
                 sig = ''
                 self.output.debug("RemoteDB.cache() url = %s is a tuple=%s"
                     %(str(url), str(isinstance(url, tuple))), 2)
                 filepath, mpath, tpath, sig = self._paths(url)
+                if not need_gpg[index] and self._local_path(url):
+                    success, changed = self._check_local(url, tpath)
+                    has_updates = max(has_updates, changed)
+                    if not success:
+                        succeeded = False
+                    continue
                 if 'file://' in url:
                     success, olist, timestamp = self._fetch_file(
                         url, mpath, tpath)
@@ -152,7 +283,8 @@ class RemoteDB(DbBase):
                     % str(len(olist)), 2)
                 # GPG handling
                 if need_gpg[index]:
-                    olist, verified = self.verify_gpg(url, sig, olist)
+                    olist, verified = self.verify_gpg(url, sig, olist,
+                                                      fetcher)
                     if not verified:
                         self.output.debug("RemoteDB.cache() gpg returned "
                             "verified = %s" %str(verified), 2)
@@ -175,9 +307,83 @@ class RemoteDB(DbBase):
 
             self.output.debug("RemoteDB.cache() self.urls:  has_updates, "
                 "succeeded %s, %s" % (str(has_updates), str(succeeded)), 4)
+
+        if has_updates:
+            self._reload_cached_lists()
+            self.update_search_index()
+        # rewritten lists may still define the same overlays
+        if has_updates and self.fingerprint() != previous_fingerprint:
+            self.last_diff = CatalogDiff(previous, self.overlays)
+            self.output.debug('RemoteDB.cache(); catalog changes: %s'
+                % str(self.last_diff.to_dict()), 4)
+        else:
+            self.last_diff = CatalogDiff(previous, previous)
         return has_updates, succeeded
 
 
+    def _reload_cached_lists(self):
+        '''
+        Re-reads all cached lists so overlays dropped from an updated list
+        do not linger in this db.
+        '''
+        self.overlays = {}
+        self._invalidate_list_cache()
+        self.read_files([path for path in self.paths
+                         if os.path.exists(path)])
+
+
+    def search_path(self):
+        '''Returns the path of the search index stored with the cache.'''
+        return self.config['cache'] + '_search.json'
+
+
+    def search_index(self):
+        '''
+        Returns the search index for the cached lists, loading it from disk
+        and bringing it up to date if required.
+
+        @rtype layman.search.SearchIndex
+        '''
+        if self._search_index is None:
+            index = SearchIndex(self.search_path(), self.output)
+            index.load()
+            self._search_index = index
+            if set(index.docs) != set(self.overlays):
+                self.update_search_index()
+        return self._search_index
+
+
+    def update_search_index(self):
+        '''
+        Incrementally re-indexes the overlays that changed since the search
+        index was last written and saves it if we are allowed to.
+
+        @rtype tuple: (number of (re-)indexed overlays, number removed)
+        '''
+        if self._search_index is None:
+            self._search_index = SearchIndex(self.search_path(), self.output)
+            self._search_index.load()
+        counts = self._search_index.update(self.overlays.values())
+        self.output.debug('RemoteDB.update_search_index(); indexed %d, '
+            'removed %d' % counts, 4)
+        if counts != (0, 0) and self.check_path([self.search_path()],
+                                                 hint=False):
+            self._search_index.save()
+        return counts
+
+
+    def search(self, terms, limit=None):
+        '''
+        Searches the overlay names, descriptions, owners, homepages and
+        feeds.
+
+        @param terms: str or list of str.
+        @param limit: int, maximum number of results.
+        @rtype list: [(overlay name, score), ...] best matches first.
+        '''
+        return self.search_index().search(terms, limit)
+
+
     def _paths(self, url):
         self.output.debug("RemoteDB._paths(), url is tuple %s" % str(url), 2)
         if isinstance(url, tuple):
@@ -204,6 +410,50 @@ class RemoteDB(DbBase):
         return
 
 
+    @staticmethod
+    def _local_path(url):
+        '''Returns the file path of a file:// url, None for other urls.'''
+        if url.startswith('file://'):
+            return url[len('file://'):]
+        return None
+
+
+    def list_path(self, url):
+        '''
+        Returns the path an unsigned list is read from: the file itself
+        for file:// urls, the cached copy for all others.
+        '''
+        return self._local_path(url) or self.filepath(url) + '.xml'
+
+
+    def _check_local(self, url, tpath):
+        '''
+        Local lists are not copied to the cache, we only record their
+        mtime to tell whether they changed since the last fetch.
+
+        @rtype tuple: (success, changed) reflecting whether the list
+            could be read and whether it changed.
+        '''
+        try:
+            timestamp = str(os.stat(self._local_path(url)).st_mtime)
+        except OSError as error:
+            self.output.error('RemoteDB._check_local(); Failed to read the '
+                'overlay list from: %s\nError was:%s\n' % (url, str(error)))
+            return False, False
+        previous = ''
+        if os.path.exists(tpath):
+            with fileopen(tpath, 'r') as previous_file:
+                previous = previous_file.read()
+        if previous == timestamp:
+            self.output.info('Local list already up to date: %s' % url, 4)
+            return True, False
+        self.output.info('Local list changed: %s' % url, 5)
+        if self.check_path([tpath]):
+            with fileopen(tpath, 'w') as out_file:
+                out_file.write(timestamp)
+        return True, True
+
+
     def filepath(self, url):
         '''Return a unique file name for the url.'''
 
@@ -295,26 +545,102 @@ class RemoteDB(DbBase):
         return olist
 
 
-    @staticmethod
-    def write_cache(olist, mpath, tpath=None, timestamp=None):
-        has_updates = False
+    @classmethod
+    def write_cache(cls, olist, mpath, tpath=None, timestamp=None):
+        '''
+        Atomically replaces the cached list at mpath, then records its
+        sha256, size and timestamp in the metadata file and finally
+        updates the timestamp file used for conditional downloads.
+        A list with the same sha256 as the cached one is not written
+        again.
+
+        @rtype bool: reflects whether the cached list changed.
+        '''
+        if isinstance(olist, bytes):
+            data = olist
+        else:
+            data = olist.encode('UTF-8')
+        meta = {
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'size': len(data),
+            'timestamp': None if timestamp is None else str(timestamp),
+            }
+        previous = cls.read_meta(mpath)
+        has_updates = not (previous is not None
+                           and previous.get('sha256') == meta['sha256']
+                           and os.path.exists(mpath)
+                           and os.path.getsize(mpath) == meta['size'])
         try:
-            with fileopen(mpath, 'w') as out_file:
-                out_file.write(olist)
+            if has_updates:
+                atomic_write(mpath, olist)
+            atomic_write(cls.meta_path(mpath), json.dumps(meta))
 
             if timestamp is not None and tpath is not None:
-                with fileopen(tpath, 'w') as out_file:
-                    out_file.write(str(timestamp))
-
-            has_updates = True
+                atomic_write(tpath, str(timestamp))
 
         except Exception as error:
             raise IOError('Failed to temporarily cache overlays list in'
                           ' ' + mpath + '\nError was:\n' + str(error))
         return has_updates
 
-    def verify_gpg(self, url, sig, olist):
-        '''Verify and decode it.'''
+    def gpg_cache_path(self):
+        '''Returns the path of the cached signature verifications.'''
+        return self.config['cache'] + '_gpg.json'
+
+
+    def _verified(self):
+        '''
+        Returns the cached successful verifications of detached
+        signatures, {verification key: {'result': ..., 'time': ...}}.
+        '''
+        path = self.gpg_cache_path()
+        if not os.path.exists(path):
+            return {}
+        try:
+            with fileopen(path, 'r') as cached:
+                verified = json.loads(cached.read())
+        except (IOError, OSError, ValueError) as error:
+            self.output.debug('RemoteDB._verified(); ignoring %s: %s'
+                % (path, str(error)), 2)
+            return {}
+        return verified if isinstance(verified, dict) else {}
+
+
+    def _verification_key(self, olist, sig):
+        '''
+        Returns the key of a verification of olist against the detached
+        signature file sig: the sha256 of both and the keyring state.
+        '''
+        with open(sig, 'rb') as sigfile:
+            signature = sigfile.read()
+        return '%s:%s:%s' % (sha256(olist), sha256(signature),
+                             keyring_state())
+
+
+    def _store_verified(self, key, result):
+        '''Remembers a successful verification, dropping stale ones.'''
+        path = self.gpg_cache_path()
+        if not self.check_path([path], hint=False):
+            return
+        verified = self._verified()
+        # only the latest verification of each list is worth keeping
+        verified = dict((old, entry) for old, entry in verified.items()
+                        if entry.get('sig') != result['sig'])
+        verified[key] = result
+        try:
+            atomic_write(path, json.dumps(verified, sort_keys=True))
+        except (IOError, OSError) as error:
+            self.output.debug('RemoteDB._store_verified(); failed to write '
+                '%s: %s' % (path, str(error)), 2)
+
+
+    def verify_gpg(self, url, sig, olist, fetcher):
+        '''
+        Verify and decode it.
+
+        A detached signature that verified the same list with the same
+        keyring before is not checked by gpg again.
+        '''
         self.output.debug("RemoteDB: verify_gpg(), verify & decrypt olist: "
             " %s, type(olist)=%s" % (str(url),str(type(olist))), 2)
         #self.output.debug(olist, 2)
@@ -322,13 +648,29 @@ class RemoteDB(DbBase):
         # detached sig
         if sig:
             self.output.debug("RemoteDB.verify_gpg(), detached sig", 2)
-            self.dl_sig(url[1], sig)
+            if not self.dl_sig(url[1], sig, fetcher):
+                self.output.error("Failed to fetch the signature of "
+                    "gpg-signed url: %s" % url[1])
+                return '', False
+            key = self._verification_key(olist, sig)
+            cached = self._verified().get(key)
+            if cached is not None:
+                self.output.info("GPG signature already verified for "
+                    "gpg-signed url.", 4)
+                self.output.info('\tSignature result:'
+                    + str(cached['result']), 4)
+                return olist, True
+            self.init_gpg()
             gpg_result = self.gpg.verify(
                 inputtxt=olist,
                 inputfile=sig)
+            if gpg_result.verified[0]:
+                self._store_verified(key, {'sig': sig, 'time': time.time(),
+                    'result': [str(item) for item in gpg_result.verified]})
         # armoured signed file, compressed or clearsigned
         else:
             self.output.debug("RemoteDB.verify_gpg(), single signed file", 2)
+            self.init_gpg()
             gpg_result = self.gpg.decrypt(
                 inputtxt=olist)
             olist = gpg_result.output
@@ -345,12 +687,24 @@ class RemoteDB(DbBase):
         return olist, gpg_result.verified[0]
 
 
-    def dl_sig(self, url, sig):
+    def dl_sig(self, url, sig, fetcher):
+        '''
+        Downloads the detached signature at url to sig, unless the copy
+        there is still current.
+
+        @rtype bool: whether a signature is available at sig.
+        '''
         self.output.debug("RemoteDB.dl_sig() url=%s, sig=%s" % (url, sig), 2)
-        success, newsig, timestamp = self._fetch_url(url, sig)
+        tpath = sig + '.timestamp'
+        success, newsig, timestamp = fetcher.fetch_content(url, tpath)
         if success:
-            success = self.write_cache(newsig, sig)
-        return success
+            self.write_cache(newsig, sig, tpath, timestamp)
+            return True
+        if os.path.exists(sig):
+            self.output.debug("RemoteDB.dl_sig() using the cached "
+                "signature", 2)
+            return True
+        return False
 
 
     def init_gpg(self):
@@ -19,7 +19,10 @@ import os
 import re
 import sys
 
+from   contextlib   import contextmanager
+
 from layman.module import Modules, InvalidModuleName
+from layman.utils import file_stamp
 
 if sys.hexversion >= 0x30200f0:
     STR = str
@@ -28,6 +31,7 @@ else:
 
 MOD_PATH = path = os.path.join(os.path.dirname(__file__), 'config_modules')
 
+
 class RepoConfManager:
 
     def __init__(self, config, overlays):
@@ -40,6 +44,9 @@ class RepoConfManager:
         self.module_controller = Modules(path=MOD_PATH,
                                          namepath='layman.config_modules',
                                          output=self.output)
+        # {conf type: [handler, file stamp]}
+        self._handlers = {}
+        self._transaction = 0
 
         if isinstance(self.conf_types, STR):
             self.conf_types = re.split(',\s+', self.conf_types)
@@ -49,6 +56,76 @@ class RepoConfManager:
                 + '\nis required in order to continue...')
 
 
+    def _handler(self, types):
+        '''
+        Returns the config handler of a conf type.
+
+        Handlers are kept across calls and only re-created, re-reading
+        their file, when the file was changed by someone else since it
+        was last read or written.
+        '''
+        types = types.replace('.', '')
+        cached = self._handlers.get(types)
+        if cached is not None:
+            if self._transaction or \
+                    file_stamp(cached[0].path) == cached[1]:
+                return cached[0]
+            self.output.debug('RepoConfManager: %s changed on disk, '
+                'reading it again', 6, cached[0].path)
+        handler = self.module_controller.get_class(types)\
+                          (self.config, self.overlays)
+        self._handlers[types] = [handler, file_stamp(handler.path)]
+        return handler
+
+
+    def _restamp(self):
+        '''
+        Records the state of the config files after our own writes.
+        '''
+        for cached in self._handlers.values():
+            cached[1] = file_stamp(cached[0].path)
+
+
+    def _call(self, method, overlay):
+        '''
+        Calls method on the handler of every conf type.
+
+        @rtype list of the handler results.
+        '''
+        results = []
+        for types in self.conf_types:
+            conf = self._handler(types)
+            results.append(getattr(conf, method)(overlay))
+        if not self._transaction:
+            self._restamp()
+        return results
+
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Collects all changes made inside the with block and writes each
+        config file once at its end.
+
+        The handlers report success for changes made inside the block,
+        failures to write at its end are reported as errors.
+        '''
+        if not self.config['require_repoconfig']:
+            yield self
+            return
+        batches = [self._handler(types).batch() for types in self.conf_types]
+        for batch in batches:
+            batch.__enter__()
+        self._transaction += 1
+        try:
+            yield self
+        finally:
+            self._transaction -= 1
+            for batch in reversed(batches):
+                batch.__exit__(None, None, None)
+            self._restamp()
+
+
     def add(self, overlay):
         '''
         Adds overlay information to the specified config type(s).
@@ -57,14 +134,7 @@ class RepoConfManager:
         @return boolean: represents success or failure.
         '''
         if self.config['require_repoconfig']:
-            results = []
-            for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.add(overlay)
-                results.append(conf_ok)
-            return results
+            return self._call('add', overlay)
         return [True]
 
 
@@ -77,14 +147,7 @@ class RepoConfManager:
         @return boolean: represents success or failure.
         '''
         if self.config['require_repoconfig']:
-            results = []
-            for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.delete(overlay)
-                results.append(conf_ok)
-            return results
+            return self._call('delete', overlay)
         return [True]
 
 
@@ -97,14 +160,9 @@ class RepoConfManager:
         @return boolean: represents success or failure.
         '''
         if self.config['require_repoconfig']:
-            for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.disable(overlay)
-            return conf_ok
+            return self._call('disable', overlay)[-1]
         return True
-                                                                                                                                                
+
 
     def enable(self, overlay):
         '''
@@ -115,29 +173,17 @@ class RepoConfManager:
         @return boolean: represents success or failure.
         '''
         if self.config['require_repoconfig']:
-            for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.enable(overlay)
-            return conf_ok
+            return self._call('enable', overlay)[-1]
         return True
 
-    
+
     def update(self, overlay):
         '''
         Updates the source URL for the specified config type(s).
-    
+
         @param overlay: layman.overlay.Overlay instance.
         @return boolean: represents success or failure.
         '''
         if self.config['require_repoconfig']:
-            results = []
-            for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.update(overlay)
-                results.append(conf_ok)
-            return results
+            return self._call('update', overlay)
         return [True]
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN SEARCH INDEX
+#################################################################################
+# File:       search.py
+#
+#             Full-text search over the overlay catalog
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Inverted index over the overlay names, descriptions, owners, homepages
+and feeds of the cached remote lists.'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import bisect
+import hashlib
+import json
+import os
+import re
+import sys
+
+from   layman.compatibility     import fileopen
+from   layman.utils             import atomic_write, encoder
+
+#===============================================================================
+#
+# Constants
+#
+#-------------------------------------------------------------------------------
+
+INDEX_VERSION = 1
+
+TOKEN_REGEX = re.compile(r'[^\W_]+', re.UNICODE)
+
+# Score added for every occurrence of a token in the given field.
+FIELD_WEIGHTS = (
+    ('name', 10),
+    ('owner_name', 3),
+    ('descriptions', 2),
+    ('homepage', 1),
+    ('feeds', 1),
+    )
+
+
+def tokenize(text):
+    '''
+    Splits text into lower case word tokens.
+
+    >>> tokenize('KDE-frameworks: Qt5 & more')
+    ['kde', 'frameworks', 'qt5', 'more']
+    '''
+    if not text:
+        return []
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def overlay_terms(overlay):
+    '''
+    Returns a {token: score} dictionary for the searchable fields of an
+    overlay.
+    '''
+    terms = {}
+    for field, weight in FIELD_WEIGHTS:
+        value = getattr(overlay, field, None)
+        if not value:
+            continue
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        for text in value:
+            for token in tokenize(text):
+                terms[token] = terms.get(token, 0) + weight
+    # an exact name match always wins
+    name = overlay.name.lower()
+    terms[name] = terms.get(name, 0) + 10
+    return terms
+
+
+def terms_fingerprint(terms):
+    '''Returns a stable digest of an overlay's {token: score} dictionary.'''
+    text = '\n'.join('%s %d' % (t, terms[t]) for t in sorted(terms))
+    return hashlib.sha1(encoder(text, 'UTF-8')).hexdigest()
+
+
+#===============================================================================
+#
+# Class SearchIndex
+#
+#-------------------------------------------------------------------------------
+
+class SearchIndex(object):
+    '''
+    Inverted index mapping tokens to the overlays containing them.
+
+    >>> class Ovl(object):
+    ...     def __init__(self, name, desc):
+    ...         self.name = name
+    ...         self.descriptions = [desc]
+    >>> index = SearchIndex()
+    >>> index.update([Ovl('kde', 'KDE desktop'), Ovl('gnome', 'Gnome apps')])
+    (2, 0)
+    >>> index.search('desk')
+    [('kde', 2)]
+    >>> index.search('kde')
+    [('kde', 44)]
+    >>> index.update([Ovl('kde', 'KDE desktop')])
+    (0, 1)
+    >>> index.search('gnome')
+    []
+    '''
+
+    def __init__(self, path=None, output=None):
+        self.path = path
+        self.output = output
+        self.docs = {}
+        self.postings = {}
+        self._tokens = None
+
+
+    def load(self):
+        '''
+        Reads the index from self.path.
+
+        @rtype bool: reflects whether a usable index was read.
+        '''
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with fileopen(self.path, 'r') as index_file:
+                data = json.load(index_file)
+        except (IOError, OSError, ValueError) as error:
+            if self.output:
+                self.output.warn('Ignoring unreadable search index %s: %s'
+                    % (self.path, str(error)), 4)
+            return False
+        if data.get('version') != INDEX_VERSION:
+            return False
+        self.docs = data['docs']
+        self.postings = data['postings']
+        self._tokens = None
+        return True
+
+
+    def save(self):
+        '''
+        Atomically writes the index to self.path.
+
+        @rtype bool: reflects whether the index was written.
+        '''
+        if not self.path:
+            return False
+        data = {'version': INDEX_VERSION, 'docs': self.docs,
+                'postings': self.postings}
+        try:
+            atomic_write(self.path, json.dumps(data, sort_keys=True))
+        except (IOError, OSError) as error:
+            if self.output:
+                self.output.warn('Failed to write the search index %s: %s'
+                    % (self.path, str(error)), 4)
+            return False
+        return True
+
+
+    def _remove(self, name):
+        for token in self.docs[name]['terms']:
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(name, None)
+            if not posting:
+                del self.postings[token]
+        del self.docs[name]
+
+
+    def update(self, overlays):
+        '''
+        Brings the index in line with the given overlays, only re-indexing
+        overlays whose searchable content changed.
+
+        @param overlays: iterable of layman.overlays.Overlay objects; this
+                         is the complete catalog, missing names are dropped.
+        @rtype tuple: (number of (re-)indexed overlays, number removed)
+        '''
+        indexed = removed = 0
+        seen = set()
+        for overlay in overlays:
+            seen.add(overlay.name)
+            terms = overlay_terms(overlay)
+            fingerprint = terms_fingerprint(terms)
+            doc = self.docs.get(overlay.name)
+            if doc is not None and doc['fingerprint'] == fingerprint:
+                continue
+            if doc is not None:
+                self._remove(overlay.name)
+            self.docs[overlay.name] = {'fingerprint': fingerprint,
+                                       'terms': sorted(terms)}
+            for token, score in terms.items():
+                self.postings.setdefault(token, {})[overlay.name] = score
+            indexed += 1
+
+        for name in [n for n in self.docs if n not in seen]:
+            self._remove(name)
+            removed += 1
+
+        if indexed or removed:
+            self._tokens = None
+        return indexed, removed
+
+
+    def search(self, query, limit=None):
+        '''
+        Ranks the overlays matching every word of the query.  Words match
+        indexed tokens by prefix.
+
+        @param query: str or list of str search terms.
+        @param limit: int, maximum number of results.
+        @rtype list: [(overlay name, score), ...] best matches first.
+        '''
+        if not isinstance(query, (list, tuple)):
+            query = [query]
+        words = []
+        for text in query:
+            words.extend(tokenize(text))
+        if not words:
+            return []
+
+        if self._tokens is None:
+            self._tokens = sorted(self.postings)
+
+        scores = None
+        for word in words:
+            matches = {}
+            start = bisect.bisect_left(self._tokens, word)
+            for token in self._tokens[start:]:
+                if not token.startswith(word):
+                    break
+                # whole word matches rank above prefix matches
+                bonus = 2 if token == word else 1
+                for name, score in self.postings[token].items():
+                    matches[name] = matches.get(name, 0) + score * bonus
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((name, scores[name] + matches[name])
+                              for name in scores if name in matches)
+            if not scores:
+                return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return ranked
+
+
+#===============================================================================
+#
+# Testing
+#
+#-------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
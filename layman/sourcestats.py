@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN SOURCE STATISTICS
+#################################################################################
+# File:       sourcestats.py
+#
+#             Remembers how well overlay sources perform
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Keeps the success rate and latency of each overlay source URL, so that
+adding, syncing and failing over prefer the fastest healthy source.
+
+The statistics are a JSON file in the storage directory:
+
+    {source URL: {"ok": int, "failed": int, "latency": seconds or null,
+                  "last_failure": time or null,
+                  "probe": seconds or null, "probed": time or null}}
+
+"latency" is a moving average of the duration of successful operations,
+"probe" the time the last probe of the source took, null if it did not
+answer.
+
+>>> import shutil, tempfile
+>>> from layman.output import Message
+>>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+>>> stats = SourceStats(os.path.join(tmpdir, 'stats.json'), Message())
+>>> stats.record('git://slow', True, 20.0)
+>>> stats.record('git://fast', True, 2.0)
+>>> stats.record('git://broken', False)
+>>> stats.rank(['git://broken', 'git://new', 'git://slow', 'git://fast'])
+['git://fast', 'git://new', 'git://slow', 'git://broken']
+>>> # recent probes come first
+>>> stats.record_probes({'git://slow': 0.1, 'git://new': 0.5,
+...                       'git://fast': None})
+>>> stats.rank(['git://broken', 'git://new', 'git://slow', 'git://fast'])
+['git://slow', 'git://new', 'git://broken', 'git://fast']
+>>> shutil.rmtree(tmpdir)
+'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from   contextlib            import contextmanager
+from   multiprocessing.pool  import ThreadPool
+
+from   layman.compatibility  import fileopen
+from   layman.utils          import atomic_write
+
+#===============================================================================
+#
+# Constants
+#
+#-------------------------------------------------------------------------------
+
+# weight of the latest duration in the latency average
+LATENCY_WEIGHT = 0.3
+
+# sources succeeding less often are tried last
+HEALTHY_RATE = 0.5
+
+# seconds a probe result is used before the source is probed again
+PROBE_MAX_AGE = 86400
+
+#===============================================================================
+#
+# Functions
+#
+#-------------------------------------------------------------------------------
+
+def retry_delays(retries, base):
+    '''
+    Yields the seconds to wait before each of the retries: doubling from
+    base, each randomly stretched or shrunk by up to half so parallel
+    runs do not retry in lock step.
+
+    >>> [round(delay) for delay in retry_delays(3, 0)]
+    [0, 0, 0]
+    >>> all(2 <= delay <= 6 for delay in list(retry_delays(2, 2))[1:])
+    True
+    '''
+    for attempt in range(retries):
+        yield base * 2 ** attempt * random.uniform(0.5, 1.5)
+
+#===============================================================================
+#
+# Class SourceStats
+#
+#-------------------------------------------------------------------------------
+
+class SourceStats(object):
+    '''
+    Success rates and latencies of source URLs.  Every record re-reads
+    the file and writes it back while holding the lock returned by the
+    optional lock function, so concurrent layman processes add up their
+    observations.
+    '''
+
+    def __init__(self, path, output, lock=None):
+        self.path = path
+        self.output = output
+        self.sources = {}
+        self._thread_lock = threading.Lock()
+        self._lock = lock
+        self.load()
+
+
+    def load(self):
+        '''Re-reads the statistics, a missing file has none.'''
+        sources = None
+        if os.path.exists(self.path):
+            try:
+                with fileopen(self.path, 'r') as stats:
+                    sources = json.loads(stats.read())
+            except (IOError, OSError, ValueError) as error:
+                self.output.warn('Ignoring the unreadable source statistics '
+                    '%s: %s' % (self.path, str(error)), 2)
+        self.sources = sources if isinstance(sources, dict) else {}
+
+
+    def save(self):
+        '''Writes the statistics, failures are only warned about.'''
+        try:
+            atomic_write(self.path, json.dumps(self.sources, sort_keys=True,
+                                               indent=1))
+        except (IOError, OSError) as error:
+            self.output.warn('Failed to write the source statistics %s: %s'
+                % (self.path, str(error)), 2)
+
+
+    @contextmanager
+    def _update(self):
+        '''
+        Re-reads the statistics, lets the with block change them and
+        saves them, all while holding the statistics lock.
+        '''
+        with self._thread_lock:
+            if self._lock is None:
+                self.load()
+                yield
+                self.save()
+                return
+            with self._lock():
+                self.load()
+                yield
+                self.save()
+
+
+    def _entry(self, src):
+        return self.sources.setdefault(src, {'ok': 0, 'failed': 0,
+            'latency': None, 'last_failure': None,
+            'probe': None, 'probed': None})
+
+
+    def record(self, src, ok, seconds=None):
+        '''Records the outcome and duration of an operation on src.'''
+        with self._update():
+            entry = self._entry(src)
+            if ok:
+                entry['ok'] += 1
+                if seconds is not None:
+                    if entry['latency'] is None:
+                        entry['latency'] = seconds
+                    else:
+                        entry['latency'] += LATENCY_WEIGHT * (seconds
+                                                - entry['latency'])
+            else:
+                entry['failed'] += 1
+                entry['last_failure'] = time.time()
+
+
+    def record_probes(self, results):
+        '''
+        Records probe results {source URL: seconds, None if the source
+        did not answer}.
+        '''
+        now = time.time()
+        with self._update():
+            for src, seconds in results.items():
+                entry = self._entry(src)
+                entry['probe'] = seconds
+                entry['probed'] = now
+
+
+    def probed(self, src, max_age=PROBE_MAX_AGE):
+        '''
+        Returns (whether src was probed within max_age seconds, seconds
+        the probe took or None if it did not answer).
+        '''
+        entry = self.sources.get(src, {})
+        probed = entry.get('probed')
+        if probed is None or time.time() - probed > max_age:
+            return False, None
+        return True, entry.get('probe')
+
+
+    def probe(self, sources, timeout, max_age=PROBE_MAX_AGE):
+        '''
+        Probes the OverlaySource objects without a probe result younger
+        than max_age in parallel, see OverlaySource.probe(), and records
+        the results.  Sources that cannot be probed are left out.
+        '''
+        todo = [source for source in sources
+                if not self.probed(source.src, max_age)[0]]
+        if not todo:
+            return
+
+        def run(source):
+            start = time.time()
+            try:
+                reachable = source.probe(timeout)
+            except Exception as error:
+                self.output.debug('SourceStats.probe(); %s: %s', 6,
+                    source.src, error)
+                reachable = False
+            return source.src, reachable, time.time() - start
+
+        pool = ThreadPool(len(todo))
+        try:
+            results = pool.map(run, todo)
+        finally:
+            pool.close()
+            pool.join()
+        self.output.debug('SourceStats.probe(); results %s', 4, results)
+        self.record_probes(dict((src, seconds if reachable else None)
+            for src, reachable, seconds in results if reachable is not None))
+
+
+    def success_rate(self, src):
+        '''
+        Returns the estimated chance an operation on src succeeds, 0.5 for
+        unknown sources.
+        '''
+        entry = self.sources.get(src, {})
+        ok = entry.get('ok', 0)
+        return (ok + 1.0) / (ok + entry.get('failed', 0) + 2)
+
+
+    def latency(self, src):
+        '''Returns the average duration on src, None if unknown.'''
+        return self.sources.get(src, {}).get('latency')
+
+
+    def rank(self, items, key=None):
+        '''
+        Returns the items, source URLs or objects whose URL is returned by
+        key: sources that did not answer a recent probe last, then the
+        unhealthy ones, the others fastest probe and fastest operations
+        first.  Sources without a measurement count as average; ties keep
+        their order.
+        '''
+        if key is None:
+            key = lambda item: item
+
+        def average(values):
+            values = [value for value in values if value is not None]
+            return sum(values) / len(values) if values else 0
+
+        probes = dict((key(item), self.probed(key(item))) for item in items)
+        probe_average = average(seconds for recent, seconds
+                                in probes.values() if recent)
+        latency_average = average(self.latency(key(item)) for item in items)
+
+        def cost(item):
+            src = key(item)
+            recent, probe = probes[src]
+            latency = self.latency(src)
+            return (recent and probe is None,
+                    self.success_rate(src) < HEALTHY_RATE,
+                    probe_average if probe is None else probe,
+                    latency_average if latency is None else latency)
+
+        return sorted(items, key=cost)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
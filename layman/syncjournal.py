@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN SYNC JOURNAL
+#################################################################################
+# File:       syncjournal.py
+#
+#             Records the progress of sync runs
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Keeps a journal of sync runs in the storage directory, so an interrupted
+run can be resumed and recently synced overlays can be skipped.
+
+The journal is a JSON file:
+
+    {"run": {"started": time, "finished": time or null},
+     "overlays": {name: {"attempted": time, "synced": time or null,
+                         "result": "ok" or "failed",
+                         "changed": time or null, "idle": int,
+                         "skipped": int}}}
+
+"changed" is the last sync that brought changes, "idle" counts the
+successful syncs since that brought none and "skipped" the adaptive runs
+that left the overlay out since its last successful sync.
+
+>>> import shutil, tempfile
+>>> from layman.output import Message
+>>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+>>> journal = SyncJournal(os.path.join(tmpdir, 'journal.json'), Message())
+>>> started = journal.begin()
+>>> journal.record('wrobel', True)
+>>> # the run was interrupted before wrobel-stable was synced
+>>> journal = SyncJournal(os.path.join(tmpdir, 'journal.json'), Message())
+>>> journal.begin(resume=True) == started
+True
+>>> journal.due(['wrobel', 'wrobel-stable'], since=started)
+['wrobel-stable']
+>>> journal.end()
+>>> journal.begin(resume=True) > started
+True
+>>> journal.due(['wrobel', 'wrobel-stable'], max_age=3600)
+['wrobel-stable']
+>>> # wrobel brought no changes twice: it sits out the next 3 adaptive runs
+>>> journal.record('wrobel', True, changed=False)
+>>> journal.record('wrobel', True, changed=False)
+>>> [journal.schedule(['wrobel', 'wrobel-stable']) for run in range(4)]
+[['wrobel-stable'], ['wrobel-stable'], ['wrobel-stable'], ['wrobel', 'wrobel-stable']]
+>>> shutil.rmtree(tmpdir)
+'''
+
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import json
+import os
+import re
+import sys
+import time
+
+from   contextlib            import contextmanager
+
+from   layman.compatibility  import fileopen
+from   layman.utils          import atomic_write
+
+#===============================================================================
+#
+# Functions
+#
+#-------------------------------------------------------------------------------
+
+# adaptive runs skipped at most between two syncs of a dormant overlay
+MAX_SKIPPED = 32
+
+AGE_RE = re.compile(r'^\s*(\d+)\s*([smhd]?)\s*$')
+AGE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_age(text):
+    '''
+    Converts an age like "90", "30m", "12h" or "2d" to seconds.
+
+    >>> parse_age('90'), parse_age('30m'), parse_age('2d')
+    (90, 1800, 172800)
+    '''
+    match = AGE_RE.match(text)
+    if not match:
+        raise ValueError('Invalid age "%s", expected a number of seconds '
+            'optionally followed by one of s, m, h or d' % text)
+    return int(match.group(1)) * AGE_UNITS[match.group(2)]
+
+#===============================================================================
+#
+# Class SyncJournal
+#
+#-------------------------------------------------------------------------------
+
+class SyncJournal(object):
+    '''
+    Records when each overlay was last synced and whether the most recent
+    sync run finished.
+
+    Every change re-reads the file and writes it back atomically while
+    holding the lock returned by the optional lock function, so several
+    layman processes can share one journal.
+    '''
+
+    def __init__(self, path, output, lock=None):
+        self.path = path
+        self.output = output
+        self._lock = lock
+        self.data = {'run': None, 'overlays': {}}
+        self.load()
+
+
+    def load(self):
+        '''Re-reads the journal file, a missing file is an empty journal.'''
+        data = None
+        if os.path.exists(self.path):
+            try:
+                with fileopen(self.path, 'r') as journal:
+                    data = json.loads(journal.read())
+            except (IOError, OSError, ValueError) as error:
+                self.output.warn('Ignoring the unreadable sync journal %s: %s'
+                    % (self.path, str(error)), 2)
+        if not isinstance(data, dict):
+            data = {}
+        self.data = {'run': data.get('run'),
+                     'overlays': data.get('overlays') or {}}
+
+
+    def save(self):
+        '''
+        Writes the journal.  Failures are only warned about, as the
+        journal is not needed to sync.
+        '''
+        try:
+            atomic_write(self.path, json.dumps(self.data, sort_keys=True,
+                                               indent=1))
+        except (IOError, OSError) as error:
+            self.output.warn('Failed to write the sync journal %s: %s'
+                % (self.path, str(error)), 2)
+
+
+    @contextmanager
+    def _update(self):
+        '''
+        Re-reads the journal, lets the with block change self.data and
+        saves it, all while holding the journal lock.
+        '''
+        if self._lock is None:
+            self.load()
+            yield self.data
+            self.save()
+            return
+        with self._lock():
+            self.load()
+            yield self.data
+            self.save()
+
+
+    def begin(self, resume=False):
+        '''
+        Starts a sync run.  With resume an unfinished run is continued
+        instead.
+
+        @rtype float: the time the run started.
+        '''
+        with self._update() as data:
+            run = data['run']
+            if not (resume and run and run.get('finished') is None):
+                run = {'started': time.time(), 'finished': None}
+                data['run'] = run
+        return run['started']
+
+
+    def end(self):
+        '''Marks the current sync run as finished.'''
+        with self._update() as data:
+            if data['run']:
+                data['run']['finished'] = time.time()
+
+
+    def record(self, name, ok, changed=True):
+        '''
+        Records the result of syncing the named overlay and whether the
+        sync brought changes.
+        '''
+        now = time.time()
+        with self._update() as data:
+            entry = data['overlays'].setdefault(name, {'synced': None})
+            entry['attempted'] = now
+            entry['result'] = 'ok' if ok else 'failed'
+            if ok:
+                entry['synced'] = now
+                entry['skipped'] = 0
+                if changed:
+                    entry['changed'] = now
+                    entry['idle'] = 0
+                else:
+                    entry['idle'] = entry.get('idle', 0) + 1
+
+
+    def schedule(self, names):
+        '''
+        Picks the overlays an adaptive run syncs: after n syncs in a row
+        that brought no changes, an overlay sits out 2**n - 1 runs, but
+        never more than MAX_SKIPPED.  The skipped ones are recorded.
+
+        @rtype list: the names, in order, to sync.
+        '''
+        due = []
+        with self._update() as data:
+            for name in names:
+                entry = data['overlays'].get(name)
+                if entry is None or entry.get('result') != 'ok':
+                    due.append(name)
+                    continue
+                wait = min(2 ** entry.get('idle', 0) - 1, MAX_SKIPPED)
+                if entry.get('skipped', 0) >= wait:
+                    due.append(name)
+                else:
+                    entry['skipped'] = entry.get('skipped', 0) + 1
+        return due
+
+
+    def last_synced(self, name):
+        '''Returns the time of the last successful sync, or None.'''
+        return self.data['overlays'].get(name, {}).get('synced')
+
+
+    def is_due(self, name, since=None, max_age=None, now=None):
+        '''
+        Tells whether the named overlay still needs a sync: it was not
+        synced successfully since the given time nor within the last
+        max_age seconds.
+        '''
+        synced = self.last_synced(name)
+        if synced is None:
+            return True
+        if since is not None and synced >= since:
+            return False
+        if max_age is not None and (now or time.time()) - synced < max_age:
+            return False
+        return True
+
+
+    def due(self, names, since=None, max_age=None):
+        '''Returns the names, in order, that still need a sync.'''
+        now = time.time()
+        return [name for name in names
+                if self.is_due(name, since, max_age, now)]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(sys.modules[__name__])
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN MICROBENCHMARKS
+#################################################################################
+# File:       benchmark.py
+#
+#             Times hot code paths
+#
+# Copyright:
+#             (c) Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Microbenchmarks for code paths that run many times per layman call.
+
+Run with: python layman/tests/benchmark.py [number of iterations]
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__version__ = "0.1"
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+import timeit
+
+from  layman.config           import BareConfig
+from  layman.output           import Message
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+#===============================================================================
+#
+# Benchmarks
+#
+#-------------------------------------------------------------------------------
+
+def config_lookup(number, debug_level):
+    '''
+    Times config['storage'] on a BareConfig read from the shipped
+    layman.cfg.
+
+    @rtype float: seconds per lookup
+    '''
+    output = Message()
+    output.set_debug_level(debug_level)
+    config = BareConfig(output=output, read_configfile=True,
+        config=os.path.join(HERE, '..', '..', 'etc', 'layman.cfg'))
+    lookup = lambda: config['storage']
+    return min(timeit.repeat(lookup, number=number, repeat=3)) / number
+
+
+def main(number):
+    print('config[\'storage\'] lookups, %d iterations:' % number)
+    # debug levels above 0 but below the lookup message level still take
+    # the fast path
+    for level in (0, 8):
+        print('  debug level %d: %.2f usec per lookup'
+              % (level, config_lookup(number, level) * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
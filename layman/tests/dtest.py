@@ -55,6 +55,8 @@ import layman.cli                #CT
 import layman.config             #CT
 import layman.db                 #CT
 import layman.dbbase             #CT
+import layman.output             #CT
+import layman.search             #CT
 import layman.utils              #CT
 import layman.overlays.overlay   #CT
 import layman.overlays.tar       #CT
@@ -72,6 +74,8 @@ def test_suite():
         doctest.DocTestSuite(layman.argsparser),
         doctest.DocTestSuite(layman.db),
         doctest.DocTestSuite(layman.dbbase),
+        doctest.DocTestSuite(layman.output),
+        doctest.DocTestSuite(layman.search),
         doctest.DocTestSuite(layman.utils),
         doctest.DocTestSuite(layman.overlays.overlay),
         doctest.DocTestSuite(layman.overlays.tar),
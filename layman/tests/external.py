@@ -18,10 +18,15 @@ from __future__ import print_function
 
 '''Runs external (non-doctest) test cases.'''
 
+import io
+import json
 import os
 import sys
 import shutil
+import subprocess
 import tempfile
+import threading
+import time
 import unittest
 import xml.etree.ElementTree as ET # Python 2.5
 #Py3
@@ -32,15 +37,26 @@ except ImportError:
 
 from  layman.argsparser       import ArgsParser
 from  layman.api              import LaymanAPI
+from  layman.cli              import RecordPrinter
 from  layman.db               import DB
 from  layman.dbbase           import DbBase
+from  layman.drift            import check_drift, drift_message
 from  layman.compatibility    import fileopen
-from  layman.config           import BareConfig, OptionConfig
+from  layman.connections      import ConnectionPool, connection_pool
+from  layman.config_modules.makeconf.makeconf import (ConfigHandler
+                                                      as MakeConf)
+from  layman.config_modules.reposconf.reposconf import (ConfigHandler
+                                                        as ReposConf)
+from  layman.config           import (BareConfig, OptionConfig,
+                                      overlay_defs_urls)
+from  layman.locking          import LockManager, JOURNAL_LOCK, overlay_lock
 from  layman.maker            import Interactive
+from  layman.mounter          import Mounter
 from  layman.output           import Message
 from  layman.overlays.overlay import Overlay
-from  layman.remotedb         import RemoteDB
+from  layman.remotedb         import RemoteDB, gpg_homedir, keyring_state
 from  layman.repoconfmanager  import RepoConfManager
+from  layman.syncjournal      import SyncJournal, parse_age
 from  layman.utils            import path
 from  warnings import filterwarnings, resetwarnings
 
@@ -129,8 +145,122 @@ class AddDeleteEnableDisableFromDB(unittest.TestCase):
         self.assertTrue(success)
 
 
+class CheckoutManyDB(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        storage = os.path.join(tmpdir, 'storage')
+        os.mkdir(storage)
+        makeconf = os.path.join(tmpdir, 'make.conf')
+        with fileopen(makeconf, 'w') as f:
+            f.write('PORTDIR_OVERLAY="\n$PORTDIR_OVERLAY"')
+
+        catalog = '<?xml version="1.0" ?>\n<repositories version="1.0">\n'
+        for name in ['first', 'second']:
+            src = os.path.join(tmpdir, name + '.git')
+            subprocess.check_call(['git', 'init', '-q', '--bare', src])
+            catalog += '<repo quality="experimental" status="unofficial">'\
+                '<name>%s</name><description>Test</description>'\
+                '<owner><email>nobody@gentoo.org</email></owner>'\
+                '<source type="git">%s</source></repo>\n' % (name, src)
+        catalog += '</repositories>'
+
+        my_opts = {
+                   'installed' : os.path.join(tmpdir, 'installed.xml'),
+                   'make_conf' : makeconf,
+                   'conf_type' : ['make.conf'],
+                   'check_official': False,
+                   'nocheck'   : 'yes',
+                   'storage'   : storage,
+                   'quietness' : 1,
+                  }
+        config = OptionConfig(my_opts)
+        remote = DbBase(config, [])
+        remote.read(catalog, 'catalog.xml')
+
+        db = DB(config)
+        added, failed = db.checkout_many([remote.select('first'),
+                                          remote.select('second')], jobs=2)
+        self.assertEqual(failed, {})
+        self.assertTrue(os.path.isdir(os.path.join(storage, 'second')))
+        self.assertEqual(sorted(DB(config).overlays), [])
+        results = db.install(added)
+        self.assertEqual(results, {'first': True, 'second': True})
+        self.assertEqual(sorted(DB(config).overlays), ['first', 'second'])
+
+        shutil.rmtree(tmpdir)
+
+
 # Tests archive overlay types (squashfs, tar)
 # http://bugs.gentoo.org/show_bug.cgi?id=304547
+class AddReposLocking(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        upstream = os.path.join(tmpdir, 'upstream')
+        subprocess.check_call(['git', 'init', '-q', upstream])
+        subprocess.check_call(['git', '-C', upstream, '-c', 'user.name=nobody',
+            '-c', 'user.email=nobody@gentoo.org', 'commit', '-q',
+            '--allow-empty', '-m', 'first'])
+        catalog = os.path.join(tmpdir, 'remote.xml')
+        with fileopen(catalog, 'w') as f:
+            f.write('<?xml version="1.0" ?>\n<repositories>')
+            for name in ('first', 'second', 'third', 'fourth'):
+                f.write('<repo quality="experimental" status="official">'
+                    '<name>%s</name><description>Test</description>'
+                    '<owner><email>nobody@gentoo.org</email></owner>'
+                    '<source type="git">file://%s</source></repo>'
+                    % (name, upstream))
+            f.write('</repositories>')
+        storage = os.path.join(tmpdir, 'storage')
+        os.mkdir(storage)
+        config = OptionConfig({'storage': storage,
+                               'installed': os.path.join(tmpdir, 'installed.xml'),
+                               'repos_conf': os.path.join(tmpdir, 'repos.conf'),
+                               'conf_type': ['repos.conf'],
+                               'overlays': ['file://' + catalog],
+                               'nocheck': 'yes', 'check_official': False,
+                               'proxy': None, 'quietness': 0})
+        api = LaymanAPI(config)
+
+        # another process can read and change the installed list while
+        # an overlay is checked out, but not touch that overlay
+        seen = []
+        def probe(name):
+            locks = LockManager(os.path.join(storage, '.locks'), Message())
+            with locks.lock('installed', wait=False) as installed:
+                with locks.lock(overlay_lock(name), wait=False) as overlay:
+                    seen.append((name, installed, overlay))
+        checkout, checkout_many = DB.checkout, DB.checkout_many
+        def probing_checkout(db, overlay):
+            probe(overlay.name)
+            return checkout(db, overlay)
+        def probing_checkout_many(db, overlays, jobs=1):
+            for overlay in overlays:
+                probe(overlay.name)
+            return checkout_many(db, overlays, jobs)
+        DB.checkout, DB.checkout_many = probing_checkout, probing_checkout_many
+        try:
+            self.assertTrue(api.add_repos('first'))
+            self.assertTrue(api.add_repos(['second', 'third'], jobs=2))
+        finally:
+            DB.checkout, DB.checkout_many = checkout, checkout_many
+
+        self.assertEqual(seen, [('first', True, False), ('second', True, False),
+                                ('third', True, False)])
+        self.assertEqual(sorted(DB(config).overlays),
+                         ['first', 'second', 'third'])
+        self.assertFalse(api.add_repos('first'))
+        # a repo given twice is checked out once
+        self.assertTrue(api.add_repos(['fourth', 'fourth'], jobs=2))
+
+        # as many overlay locks as "layman -a ALL" may need
+        names = ['overlay%d' % i for i in range(700)]
+        with api._overlay_locks(names):
+            self.assertEqual(len(api._locks.held()), 700)
+        self.assertEqual(api._locks.held(), {})
+
+        shutil.rmtree(tmpdir)
+
+
 class ArchiveAddRemoveSync(unittest.TestCase):
 
     def _create_squashfs_overlay(self):
@@ -236,6 +366,36 @@ class ArchiveAddRemoveSync(unittest.TestCase):
             os.rmdir(temp_dir_path)
 
 
+class CheckDrift(unittest.TestCase):
+    def test(self):
+        config = {'output': Message()}
+        installed = DbBase(config, [HERE + '/testfiles/global-overlays.xml'])
+        remote_xml = '''<?xml version="1.0" ?>
+<layman>
+  <overlay type="git" src="git://example.org/wrobel.git"
+           contact="nobody@gentoo.org" name="wrobel">
+    <description>Test</description>
+  </overlay>
+</layman>'''
+        remote = DbBase(config, [])
+        remote.read(remote_xml, 'remote.xml')
+
+        report = check_drift(installed.overlays, remote.overlays)
+        self.assertEqual(sorted(report), ['wrobel', 'wrobel-stable'])
+        self.assertEqual(report['wrobel']['status'], 'type')
+        self.assertEqual(report['wrobel']['remote_type'], 'Git')
+        self.assertEqual(report['wrobel']['remote_srcs'],
+                         ['git://example.org/wrobel.git'])
+        self.assertEqual(report['wrobel-stable']['status'], 'missing')
+        self.assertTrue('wrobel-stable' in
+                        drift_message('wrobel-stable', report['wrobel-stable']))
+
+        report = check_drift(installed.overlays, installed.overlays,
+                             ['wrobel', 'unknown'])
+        self.assertEqual(list(report), ['wrobel'])
+        self.assertEqual(report['wrobel']['status'], 'ok')
+
+
 class CLIArgs(unittest.TestCase):
 
     def test(self):
@@ -327,6 +487,137 @@ class CreateConfig(unittest.TestCase):
             getattr(self, 'make_%s' % i)
 
 
+class OverlayDefs(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        for name in ['b.xml', 'a.xml', 'notes.txt']:
+            with fileopen(os.path.join(tmpdir, name), 'w') as f:
+                f.write('')
+        urls = overlay_defs_urls(tmpdir)
+        self.assertEqual(urls, ['file://' + os.path.join(tmpdir, 'a.xml'),
+                                'file://' + os.path.join(tmpdir, 'b.xml')])
+
+        with fileopen(os.path.join(tmpdir, '0.xml'), 'w') as f:
+            f.write('')
+        # make sure the directory mtime differs from the cached one
+        os.utime(tmpdir, (0, 0))
+        self.assertEqual(overlay_defs_urls(tmpdir)[0],
+                         'file://' + os.path.join(tmpdir, '0.xml'))
+        self.assertEqual(overlay_defs_urls(tmpdir + '/missing'), None)
+
+        shutil.rmtree(tmpdir)
+
+
+class ConfigSnapshot(unittest.TestCase):
+    def test(self):
+        a = OptionConfig(options={'storage': '/tmp/snapshot'})
+        self.assertEqual(a['storage'], '/tmp/snapshot')
+        self.assertEqual(a['nocheck'], True)
+        self.assertEqual(a['unknown'], None)
+        # the snapshot cannot be changed behind the config's back
+        with self.assertRaises(TypeError):
+            a._resolved()['storage'] = '/tmp/other'
+
+        # Options set later replace the resolved values.
+        a.set_option('nocheck', False)
+        self.assertEqual(a['nocheck'], False)
+        a.update({'cache': '/tmp/elsewhere'})
+        self.assertEqual(a['cache'], '/tmp/elsewhere')
+        a.update_defaults({'umask': '0002'})
+        self.assertEqual(a['umask'], '0002')
+
+        keys = a.keys()
+        self.assertEqual(len(keys), len(set(keys)))
+        a.set_option('new_option', 1)
+        self.assertTrue('new_option' in a.keys())
+
+
+class CacheMetaRemoteDB(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        cache = os.path.join(tmpdir, 'cache')
+        my_opts = {
+                   'overlays' :
+                   ['file://' + HERE + '/testfiles/global-overlays.xml'],
+                   'cache' : cache,
+                   'nocheck'    : 'yes',
+                   'proxy' : None,
+                   'quietness': 3,
+                  }
+        config = OptionConfig(my_opts)
+        db = RemoteDB(config)
+        with fileopen(HERE + '/testfiles/global-overlays.xml', 'r') as f:
+            olist = f.read()
+        mpath = cache + '_test.xml'
+        tpath = cache + '_test.timestamp'
+
+        self.assertTrue(db.write_cache(olist, mpath, tpath, 42))
+        meta = db.read_meta(mpath)
+        self.assertEqual(meta['size'], os.path.getsize(mpath))
+        self.assertEqual(meta['timestamp'], '42')
+        self.assertEqual(len(meta['sha256']), 64)
+        with fileopen(tpath, 'r') as f:
+            self.assertEqual(f.read(), '42')
+        # the same content is not written again
+        self.assertFalse(db.write_cache(olist, mpath, tpath, 43))
+        self.assertTrue(db.cache_intact(mpath))
+
+        # a truncated list is skipped instead of breaking the parser
+        with fileopen(mpath, 'w') as f:
+            f.write(olist[:100])
+        self.assertFalse(db.cache_intact(mpath))
+        db.overlays = {}
+        db.read_file(mpath)
+        self.assertEqual(db.overlays, {})
+        # and written again on the next fetch
+        self.assertTrue(db.write_cache(olist, mpath, tpath, 44))
+        db.read_file(mpath)
+        self.assertEqual(sorted(db.overlays), ['wrobel', 'wrobel-stable'])
+
+        shutil.rmtree(tmpdir)
+
+
+class CatalogDiffRemoteDB(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        catalog = os.path.join(tmpdir, 'overlays.xml')
+        shutil.copy(HERE + '/testfiles/global-overlays.xml', catalog)
+        my_opts = {
+                   'overlays' : ['file://' + catalog],
+                   'cache' : os.path.join(tmpdir, 'cache'),
+                   'nocheck'    : 'yes',
+                   'proxy' : None
+                  }
+        config = OptionConfig(my_opts)
+        db = RemoteDB(config)
+        self.assertEqual(sorted(db.overlays), ['wrobel', 'wrobel-stable'])
+        db.cache()
+        self.assertTrue(db.last_diff.is_empty())
+
+        with fileopen(catalog, 'r') as xml:
+            text = xml.read()
+        text = text.replace('name = "wrobel"', 'name = "wrobel-dev"')
+        text = text.replace('rsync://gunnarwrobel.de/wrobel-stable',
+                            'rsync://gunnarwrobel.de/stable')
+        with fileopen(catalog, 'w') as xml:
+            xml.write(text)
+        os.utime(catalog, (0, 0))
+
+        db.cache()
+        self.assertEqual(sorted(db.overlays), ['wrobel-dev', 'wrobel-stable'])
+        diff = db.last_diff.to_dict()
+        self.assertEqual(diff['added'], [])
+        self.assertEqual(diff['removed'], [])
+        self.assertEqual(diff['renamed'], [('wrobel', 'wrobel-dev')])
+        self.assertEqual(diff['changed'], {'wrobel-stable':
+            {'sources': (['rsync://gunnarwrobel.de/wrobel-stable'],
+                         ['rsync://gunnarwrobel.de/stable'])}})
+        self.assertEqual(db.last_diff.affected(),
+                         set(['wrobel-dev', 'wrobel-stable']))
+
+        shutil.rmtree(tmpdir)
+
+
 class FetchRemoteList(unittest.TestCase):
 
     def test(self):
@@ -347,7 +638,7 @@ class FetchRemoteList(unittest.TestCase):
         api = LaymanAPI(config)
         self.assertTrue(api.fetch_remote_list())
 
-        filename = api._get_remote_db().filepath(config['overlays']) + '.xml'
+        filename = api._get_remote_db().list_path(config['overlays'])
 
         with fileopen(filename, 'r') as b:
             self.assertEqual(b.readlines()[19], '      A collection of ebuilds from Gunnar Wrobel [wrobel@gentoo.org].\n')
@@ -382,10 +673,56 @@ class FetchRemoteList(unittest.TestCase):
                     None)]
         self.assertEqual(info['sources'], sources)
 
-        os.unlink(filename)
         shutil.rmtree(tmpdir)
 
 
+class FingerprintDbBase(unittest.TestCase):
+    def test(self):
+        config = BareConfig()
+        global_list = HERE + '/testfiles/global-overlays.xml'
+        first = DbBase(config, [global_list])
+        second = DbBase(config, [global_list])
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+        self.assertTrue(first == second)
+
+        # same overlays written in the other format
+        filename = tempfile.mkstemp()[1]
+        first.write(filename)
+        rewritten = DbBase(config, [filename])
+        os.unlink(filename)
+        self.assertEqual(first.fingerprint(), rewritten.fingerprint())
+
+        # catalogs with different overlays compare unequal
+        del second.overlays['wrobel']
+        second._invalidate_list_cache('wrobel')
+        self.assertTrue(first != second)
+        self.assertTrue(second != first)
+
+        overlay = rewritten.overlays['wrobel']
+        fingerprint = overlay.fingerprint
+        overlay.set_priority(99)
+        self.assertNotEqual(overlay.fingerprint, fingerprint)
+        self.assertNotEqual(overlay, first.overlays['wrobel'])
+        rewritten._invalidate_list_cache('wrobel')
+        self.assertNotEqual(first.fingerprint(), rewritten.fingerprint())
+
+        # so does pointing an overlay at another of its sources
+        overlay = rewritten.overlays['wrobel-stable']
+        fingerprint = overlay.fingerprint
+        overlay.update('/tmp', ['rsync://example.org/wrobel-stable'])
+        self.assertNotEqual(overlay.fingerprint, fingerprint)
+        overlay.set_source('rsync://gunnarwrobel.de/wrobel-stable')
+        self.assertEqual(overlay.fingerprint, fingerprint)
+
+        # the order of the sources does not matter
+        sources = [('git://a', 'git', ''), ('https://b', 'git', '')]
+        definition = {'name': 'multi', 'owner_email': 'a@b',
+                      'descriptions': ['x'], 'sources': sources}
+        one = Overlay(config, ovl_dict=definition)
+        definition['sources'] = sources[::-1]
+        self.assertEqual(Overlay(config, ovl_dict=definition), one)
+
+
 class FormatBranchCategory(unittest.TestCase):
     def _run(self, number):
         #config = {'output': Message()}
@@ -414,6 +751,186 @@ class FormatBranchCategory(unittest.TestCase):
         self.assertTrue(os1 == os2)
 
 
+class HostConnectionLimit(unittest.TestCase):
+    def test(self):
+        pool = ConnectionPool(host_limit=2)
+        running = {}
+        peaks = {}
+        lock = threading.Lock()
+
+        def download(url):
+            host = pool.host(url)
+            with pool.slot(url):
+                with lock:
+                    running[host] = running.get(host, 0) + 1
+                    peaks[host] = max(peaks.get(host, 0), running[host])
+                time.sleep(0.05)
+                with lock:
+                    running[host] -= 1
+
+        urls = ['https://github.com/%d.tar.gz' % i for i in range(6)] + \
+               ['https://gitweb.gentoo.org/%d.tar.gz' % i for i in range(2)]
+        threads = [threading.Thread(target=download, args=(url,))
+                   for url in urls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peaks, {'github.com': 2, 'gitweb.gentoo.org': 2})
+        self.assertFalse(pool.busy('https://github.com/'))
+
+        # all connectors share the pool of the process
+        config = BareConfig()
+        self.assertTrue(connection_pool(config) is connection_pool(config))
+
+
+class IterListDbBase(unittest.TestCase):
+    def test(self):
+        config = {
+                  'output': Message(),
+                  'svn_command': '/usr/bin/svn',
+                  'rsync_command':'/usr/bin/rsync'
+                 }
+        db = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+
+        rows = db.iter_list(width=80)
+        self.assertFalse(isinstance(rows, list))
+        self.assertEqual(list(rows), db.list(width=80))
+        rows = list(db.iter_list(repos=['wrobel-stable'], width=80))
+        self.assertEqual(rows, [db._list_row(db.overlays['wrobel-stable'],
+                                             False, 80)])
+
+        overlay = db.overlays.pop('wrobel')
+        db._invalidate_list_cache('wrobel')
+        self.assertEqual(db._name_index(), ['wrobel-stable'])
+        overlay.name = 'Awrobel'
+        db.overlays[overlay.name] = overlay
+        db._invalidate_list_cache(overlay.name)
+        self.assertEqual(db._name_index(), ['Awrobel', 'wrobel-stable'])
+
+
+class IndexedLookupDbBase(unittest.TestCase):
+    def test(self):
+        config = BareConfig()
+        db = DbBase(config, [HERE + '/testfiles/global-overlays.xml'])
+        self.assertEqual(db.lookup('status', 'official'), set(['wrobel']))
+        self.assertEqual(db.lookup('type', 'rsync'), set(['wrobel-stable']))
+        self.assertEqual(db.lookup('quality', 'experimental'),
+                         set(['wrobel', 'wrobel-stable']))
+        self.assertRaises(ValueError, db.lookup, 'homepage', 'x')
+
+        # added overlays are indexed
+        db.add_new(from_dict={'name': 'squash', 'owner_email': 'Me@b',
+                              'descriptions': ['x'], 'quality': 'stable',
+                              'sources': [('/tmp/squash.img', 'squashfs',
+                                           None)]})
+        self.assertEqual(db.lookup('type', 'Squashfs'), set(['squash']))
+        self.assertEqual(db.lookup('owner', 'me@b'), set(['squash']))
+        self.assertEqual(db.lookup('src', '/tmp/squash.img'), set(['squash']))
+
+        # changed overlays are indexed again
+        db.overlays['squash'].sources[0].src = '/tmp/other.img'
+        db._invalidate_list_cache('squash')
+        self.assertEqual(db.lookup('src', '/tmp/squash.img'), set())
+        self.assertEqual(db.lookup('src', '/tmp/other.img'), set(['squash']))
+
+        # deleted ones leave the indexes
+        del db.overlays['wrobel']
+        db._invalidate_list_cache('wrobel')
+        self.assertEqual(db.lookup('status', 'official'), set())
+        self.assertEqual(db.lookup('quality', 'experimental'),
+                         set(['wrobel-stable']))
+
+        total, records = db.query(quality=['stable', 'core'])
+        self.assertEqual([r['name'] for r in records], ['squash'])
+        total, records = db.query(official=False, src_type=['Rsync', 'git'])
+        self.assertEqual([r['name'] for r in records], ['wrobel-stable'])
+
+        mounter = Mounter(lambda: db, db.list_ids, config=config)
+        self.assertEqual(mounter.mountables, {'squash': 'Squashfs'})
+
+
+class LockStorage(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        locks = LockManager(tmpdir, Message())
+        holder = subprocess.Popen([sys.executable, '-c',
+            'import sys, time\n'
+            'from layman.locking import LockManager\n'
+            'from layman.output import Message\n'
+            'with LockManager(sys.argv[1], Message()).lock("installed"):\n'
+            '    print("locked")\n'
+            '    sys.stdout.flush()\n'
+            '    time.sleep(0.5)\n', tmpdir],
+            stdout=subprocess.PIPE,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.assertEqual(holder.stdout.readline().strip(), b'locked')
+
+        # other locks are not affected...
+        with locks.lock('overlay-wrobel'):
+            pass
+        self.assertTrue(locks.waits[-1][2] < 0.4)
+        # ...while readers wait for the writer to finish
+        with locks.lock('installed', shared=True):
+            self.assertEqual(locks.held(), {'installed': 'shared'})
+        holder.wait()
+        holder.stdout.close()
+        self.assertEqual(locks.waits[-1][:2], ('installed', 'shared'))
+        self.assertTrue(locks.waits[-1][2] > 0.2)
+        self.assertTrue(locks.wait_time() >= locks.waits[-1][2])
+
+        shutil.rmtree(tmpdir)
+
+
+class MakeConfHandler(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        makeconf = os.path.join(tmpdir, 'make.conf')
+        with fileopen(makeconf, 'w') as f:
+            f.write('USE="-*"\n'
+                    'PORTDIR_OVERLAY="\n$PORTDIR_OVERLAY\n/usr/local/portage"\n'
+                    'CFLAGS="-O2"\n')
+        config = {
+                  'output': Message(),
+                  'make_conf': makeconf,
+                  'storage': '/var/lib/layman',
+                  'svn_command': '/usr/bin/svn',
+                  'rsync_command':'/usr/bin/rsync'
+                 }
+        db = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+        conf = MakeConf(config, db.overlays)
+
+        with conf.batch():
+            self.assertTrue(conf.add(db.overlays['wrobel']))
+            self.assertTrue(conf.add(db.overlays['wrobel-stable']))
+            self.assertTrue(conf.disable(db.overlays['wrobel']))
+            # nothing is written before the batch ends
+            self.assertEqual(MakeConf(config, db.overlays).overlays, [])
+
+        with fileopen(makeconf, 'r') as f:
+            self.assertEqual(f.read(),
+                             'USE="-*"\n'
+                             'ENABLED="\n/var/lib/layman/wrobel-stable\n"\n'
+                             'DISABLED="\n/var/lib/layman/wrobel\n"\n'
+                             'PORTDIR_OVERLAY="\n$ENABLED\n$PORTDIR_OVERLAY\n'
+                             '/usr/local/portage"\n'
+                             'CFLAGS="-O2"\n')
+
+        conf = MakeConf(config, db.overlays)
+        self.assertEqual(sorted(conf.names), ['wrobel', 'wrobel-stable'])
+        self.assertEqual(conf.disabled, set(['wrobel']))
+        self.assertEqual(conf.extra, ['/usr/local/portage'])
+        self.assertFalse(conf.enable(db.overlays['wrobel-stable']))
+        self.assertTrue(conf.enable(db.overlays['wrobel']))
+        self.assertTrue(conf.delete(db.overlays['wrobel-stable']))
+
+        conf = MakeConf(config, db.overlays)
+        self.assertEqual([o.name for o in conf.overlays], ['wrobel'])
+        self.assertEqual(conf.disabled, set())
+
+        shutil.rmtree(tmpdir)
+
+
 class MakeOverlayXML(unittest.TestCase):
 
     def test(self):
@@ -509,6 +1026,104 @@ class OverlayObjTest(unittest.TestCase):
         self.getshortlist()
 
 
+class ProbeSources(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        storage = os.path.join(tmpdir, 'storage')
+        os.mkdir(storage)
+        makeconf = os.path.join(tmpdir, 'make.conf')
+        with fileopen(makeconf, 'w') as f:
+            f.write('PORTDIR_OVERLAY="\n$PORTDIR_OVERLAY"')
+        missing = os.path.join(tmpdir, 'missing.git')
+        good = os.path.join(tmpdir, 'good')
+        subprocess.check_call(['git', 'init', '-q', good])
+        subprocess.check_call(['git', '-C', good, '-c', 'user.name=nobody',
+            '-c', 'user.email=nobody@gentoo.org', 'commit', '-q',
+            '--allow-empty', '-m', 'first'])
+        catalog = '<?xml version="1.0" ?>\n<repositories version="1.0">'\
+            '<repo quality="experimental" status="unofficial">'\
+            '<name>foo</name><description>Test</description>'\
+            '<owner><email>nobody@gentoo.org</email></owner>'\
+            '<source type="git">%s</source><source type="git">%s</source>'\
+            '</repo></repositories>' % (missing, good)
+
+        config = OptionConfig({
+                   'installed' : os.path.join(tmpdir, 'installed.xml'),
+                   'make_conf' : makeconf,
+                   'conf_type' : ['make.conf'],
+                   'check_official': False,
+                   'nocheck'   : 'yes',
+                   'storage'   : storage,
+                   'probe_sources': True,
+                   'quietness' : 1,
+                  })
+        remote = DbBase(config, [])
+        remote.read(catalog, 'catalog.xml')
+
+        # the listed first source does not answer and is never tried
+        db = DB(config)
+        self.assertTrue(db.add(remote.select('foo')))
+        self.assertEqual(db.select('foo').sources[0].src, good)
+        self.assertEqual(db.stats.probed(missing), (True, None))
+        recent, seconds = db.stats.probed(good)
+        self.assertTrue(recent and seconds < 5)
+        self.assertEqual(db.stats.sources[missing]['failed'], 0)
+
+        # probe results are reused
+        with fileopen(db.stats.path, 'r') as stats:
+            probed = json.loads(stats.read())[good]['probed']
+        db.stats.probe(remote.select('foo').sources, 5)
+        self.assertEqual(db.stats.sources[good]['probed'], probed)
+
+        shutil.rmtree(tmpdir)
+
+
+class ParallelReadDbBase(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        paths = []
+        for number in range(4):
+            path = os.path.join(tmpdir, 'list-%d.xml' % number)
+            with fileopen(path, 'w') as catalog:
+                catalog.write('<?xml version="1.0" ?>\n<repositories>'
+                    '<repo quality="stable" status="official" priority="%d">'
+                    '<name>shared</name><description>List %d</description>'
+                    '<owner><email>nobody@gentoo.org</email></owner>'
+                    '<source type="git" branch="main">git://%d</source>'
+                    '<feed>http://%d/feed</feed></repo>'
+                    '<overlay type="svn" src="svn://%d" contact="a@b"'
+                    ' name="only-%d"><description>x</description></overlay>'
+                    '</repositories>' % ((number,) * 6))
+            paths.append(path)
+        broken = os.path.join(tmpdir, 'broken.xml')
+        with fileopen(broken, 'w') as catalog:
+            catalog.write('<repositories><repo>')
+
+        config = BareConfig()
+        serial = DbBase(config, paths)
+        config.set_option('parse_jobs', '3')
+        parallel = DbBase(config, paths)
+
+        self.assertEqual(sorted(parallel.overlays), ['only-0', 'only-1',
+                         'only-2', 'only-3', 'shared'])
+        # the last list wins, as when read one after another
+        shared = parallel.overlays['shared']
+        self.assertEqual((shared.priority, shared.descriptions),
+                         (3, ['List 3']))
+        for name, overlay in serial.overlays.items():
+            other = parallel.overlays[name]
+            self.assertEqual(overlay, other)
+            for attr in ('quality', 'feeds', 'irc', 'branch', 'ovl_type'):
+                self.assertEqual(getattr(overlay, attr), getattr(other, attr))
+            self.assertEqual([s.src for s in overlay.sources],
+                             [s.src for s in other.sources])
+
+        # lists the workers fail on are reported as before
+        self.assertRaises(Exception, DbBase, config, paths + [broken])
+
+        shutil.rmtree(tmpdir)
+
+
 class PathUtil(unittest.TestCase):
 
     def test(self):
@@ -541,6 +1156,56 @@ class Unicode(unittest.TestCase):
         self._overlays_bug(286290)
 
 
+class RecordOutput(unittest.TestCase):
+    def test(self):
+        config = {
+                  'output': Message(),
+                  'svn_command': '/usr/bin/svn',
+                  'rsync_command':'/usr/bin/rsync'
+                 }
+        db = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+
+        out = io.StringIO()
+        printer = RecordPrinter('json', out)
+        for record in db.records():
+            printer.write(record)
+        printer.close()
+        records = json.loads(out.getvalue())
+        self.assertEqual([r['name'] for r in records],
+                         ['wrobel', 'wrobel-stable'])
+        self.assertEqual(records[0]['src_uris'],
+                         ['https://overlays.gentoo.org/svn/dev/wrobel'])
+
+        out = io.StringIO()
+        printer = RecordPrinter('jsonl', out)
+        for record in db.records(repos=['wrobel-stable']):
+            printer.write(record)
+        printer.close()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['name'], 'wrobel-stable')
+
+        out = io.StringIO()
+        RecordPrinter('json', out).close()
+        self.assertEqual(json.loads(out.getvalue()), [])
+
+        # while syncing, nothing but the records may reach stdout
+        script = subprocess.Popen([sys.executable, '-c',
+            'import os, sys\n'
+            'from layman.cli import _stdout_to_stderr\n'
+            'with _stdout_to_stderr() as out:\n'
+            '    print("news")\n'
+            '    os.system("echo git")\n'
+            '    out.write("record\\n")\n'
+            'print("done")\n'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        stdout, stderr = script.communicate()
+        self.assertEqual(script.returncode, 0)
+        self.assertEqual(stdout.split(), [b'record', b'done'])
+        self.assertEqual(stderr.split(), [b'news', b'git'])
+
+
 class ReadWriteSelectListDbBase(unittest.TestCase):
 
     def list_db(self):
@@ -578,6 +1243,12 @@ class ReadWriteSelectListDbBase(unittest.TestCase):
             self.assertEqual(info[i][0].decode('utf-8'), test_info[i])
             print(info[i][0].decode('utf-8'))
 
+        # Rendered rows are cached per (overlay, width, verbose).
+        cached = db.list(verbose=False, width=80)
+        self.assertTrue(cached[0] is info[0])
+        self.assertEqual(db.list(repos=['wrobel-stable'], width=80),
+                         [info[1]])
+
     def read_db(self):
         output = Message()
         config = {'output': output}
@@ -623,6 +1294,210 @@ class ReadWriteSelectListDbBase(unittest.TestCase):
         self.write_db()
 
 
+class QueryDbBase(unittest.TestCase):
+
+    def test(self):
+        config = {
+                  'output': Message(),
+                  'svn_command': '/usr/bin/svn',
+                  'rsync_command':'/usr/bin/rsync'
+                 }
+        db = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+
+        total, records = db.query()
+        self.assertEqual(total, 2)
+        self.assertEqual([r['name'] for r in records],
+                         ['wrobel', 'wrobel-stable'])
+
+        total, records = db.query(official=True)
+        self.assertEqual([r['name'] for r in records], ['wrobel'])
+        self.assertEqual(records[0]['src_types'], ['Subversion'])
+
+        total, records = db.query(src_type='rsync')
+        self.assertEqual([r['name'] for r in records], ['wrobel-stable'])
+
+        total, records = db.query(description='gunnar')
+        self.assertEqual([r['name'] for r in records], ['wrobel-stable'])
+
+        total, records = db.query(name='^wrobel$', regex=True)
+        self.assertEqual([r['name'] for r in records], ['wrobel'])
+
+        total, records = db.query(sort='priority', reverse=True, limit=1)
+        self.assertEqual(total, 2)
+        self.assertEqual([r['name'] for r in records], ['wrobel-stable'])
+
+        total, records = db.query(offset=1, limit=5)
+        self.assertEqual([r['name'] for r in records], ['wrobel-stable'])
+
+        self.assertRaises(ValueError, db.query, sort='size')
+
+
+class RepoConfTransaction(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        makeconf = os.path.join(tmpdir, 'make.conf')
+        reposconf = os.path.join(tmpdir, 'repos.conf')
+        with fileopen(makeconf, 'w') as f:
+            f.write('PORTDIR_OVERLAY="\n$PORTDIR_OVERLAY"\n')
+        with fileopen(reposconf, 'w') as f:
+            f.write('[local]\nlocation = /usr/local/portage\n')
+
+        my_opts = {
+                   'installed' :
+                   HERE + '/testfiles/global-overlays.xml',
+                   'make_conf' : makeconf,
+                   'nocheck'    : 'yes',
+                   'storage'   : tmpdir,
+                   'repos_conf' : reposconf,
+                   'conf_type' : ['make.conf', 'repos.conf'],
+                   }
+        config = OptionConfig(my_opts)
+        config.set_option('quietness', 3)
+        db = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+        conf = RepoConfManager(config, db.overlays)
+
+        with conf.transaction():
+            self.assertEqual(conf.add(db.overlays['wrobel']), [True, True])
+            self.assertEqual(conf.add(db.overlays['wrobel-stable']),
+                             [True, True])
+            # nothing is written before the transaction ends
+            self.assertEqual(ReposConf(config, {}).names(), ['local'])
+            self.assertEqual(MakeConf(config, db.overlays).overlays, [])
+
+        self.assertEqual(ReposConf(config, {}).names(),
+                         ['local', 'wrobel', 'wrobel-stable'])
+        self.assertEqual(sorted(MakeConf(config, db.overlays).names),
+                         ['wrobel', 'wrobel-stable'])
+
+        # handlers are kept while their files are unchanged...
+        handler = conf._handler('make.conf')
+        self.assertEqual(conf.delete(db.overlays['wrobel']), [True, True])
+        self.assertTrue(conf._handler('make.conf') is handler)
+
+        # ...and read again after someone else changed them
+        with fileopen(makeconf, 'w') as f:
+            f.write('PORTDIR_OVERLAY="\n$PORTDIR_OVERLAY\n/usr/local/portage"\n')
+        handler = conf._handler('make.conf')
+        self.assertEqual(handler.overlays, [])
+        self.assertEqual(handler.extra, ['/usr/local/portage'])
+
+        shutil.rmtree(tmpdir)
+
+
+class ReposConfHandler(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        reposconf = os.path.join(tmpdir, 'layman.conf')
+        with fileopen(reposconf, 'w') as f:
+            f.write('# kept\n\n[local]\nlocation = /usr/local/portage\n')
+        config = {
+                  'output': Message(),
+                  'repos_conf': reposconf,
+                  'storage': '/var/lib/layman',
+                  'auto_sync': 'No',
+                  'svn_command': '/usr/bin/svn',
+                  'rsync_command':'/usr/bin/rsync'
+                 }
+        db = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+        conf = ReposConf(config, db.overlays)
+
+        with conf.batch():
+            self.assertTrue(conf.add(db.overlays['wrobel']))
+            self.assertTrue(conf.add(db.overlays['wrobel-stable']))
+            self.assertTrue(conf.disable(db.overlays['wrobel']))
+            # nothing is written before the batch ends
+            self.assertEqual(ReposConf(config, {}).names(), ['local'])
+
+        conf = ReposConf(config, db.overlays)
+        self.assertEqual(conf.names(), ['local', 'wrobel', 'wrobel-stable'])
+        self.assertFalse(conf.is_enabled('wrobel'))
+        with fileopen(reposconf, 'r') as f:
+            text = f.read()
+        self.assertTrue(text.startswith('# kept\n\n[local]\n'))
+        self.assertTrue('#[wrobel]\n' in text)
+        self.assertTrue('#location = /var/lib/layman/wrobel\n' in text)
+
+        self.assertTrue(conf.enable(db.overlays['wrobel']))
+        self.assertTrue(conf.delete(db.overlays['wrobel-stable']))
+        conf = ReposConf(config, db.overlays)
+        self.assertEqual(conf.names(), ['local', 'wrobel'])
+        self.assertTrue(conf.is_enabled('wrobel'))
+        self.assertEqual(conf._section('wrobel').get('location'),
+                         '/var/lib/layman/wrobel')
+
+        # deleting the only overlay of an empty file does not write it
+        # back, see DB.delete()
+        os.unlink(reposconf)
+        only = {'wrobel': db.overlays['wrobel']}
+        conf = ReposConf(config, only)
+        self.assertTrue(conf.delete(only['wrobel']))
+        del only['wrobel']
+        self.assertEqual(ReposConf(config, only).names(), [])
+        with fileopen(reposconf, 'r') as f:
+            self.assertFalse('[wrobel]' in f.read())
+
+        shutil.rmtree(tmpdir)
+
+
+class GPGVerificationCache(unittest.TestCase):
+    class NotModified(object):
+        def fetch_content(self, url, tpath=None):
+            return (False, '', '')
+
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        config = OptionConfig({'overlays': '', 'nocheck': 'yes',
+                               'cache': os.path.join(tmpdir, 'cache'),
+                               'proxy': None})
+        db = RemoteDB(config)
+        url = ('https://example.org/repositories.xml',
+               'https://example.org/repositories.xml.asc')
+        sig = db.filepath(url[0]) + '.sig'
+        olist = '<repositories version="1.0"/>'
+        fetcher = self.NotModified()
+
+        # no signature, cached or fetched: nothing to verify against
+        self.assertEqual(db.verify_gpg(url, sig, olist, fetcher), ('', False))
+
+        with fileopen(sig, 'w') as sigfile:
+            sigfile.write('signature')
+        key = db._verification_key(olist, sig)
+        db._store_verified(key, {'sig': sig, 'time': 0, 'result': ['True']})
+        # the unchanged list and signature are not handed to gpg again
+        self.assertEqual(db.verify_gpg(url, sig, olist, fetcher),
+                         (olist, True))
+        self.assertEqual(db.gpg, None)
+        self.assertNotEqual(db._verification_key(olist + ' ', sig), key)
+
+        homedir = os.path.join(tmpdir, 'gnupg')
+        os.mkdir(homedir)
+        state = keyring_state(homedir)
+        with fileopen(os.path.join(homedir, 'pubring.kbx'), 'w') as keyring:
+            keyring.write('key')
+        self.assertNotEqual(keyring_state(homedir), state)
+        # gpg 2.4 with keyboxd keeps its keys in a database
+        state = keyring_state(homedir)
+        os.mkdir(os.path.join(homedir, 'public-keys.d'))
+        with fileopen(os.path.join(homedir, 'public-keys.d', 'pubring.db'),
+                      'w') as keyring:
+            keyring.write('key')
+        self.assertNotEqual(keyring_state(homedir), state)
+
+        # by default the keyring gpg itself uses is looked at
+        previous = os.environ.get('GNUPGHOME')
+        os.environ['GNUPGHOME'] = homedir
+        try:
+            self.assertEqual(gpg_homedir(), homedir)
+            self.assertEqual(keyring_state(), keyring_state(homedir))
+        finally:
+            if previous is None:
+                del os.environ['GNUPGHOME']
+            else:
+                os.environ['GNUPGHOME'] = previous
+
+        shutil.rmtree(tmpdir)
+
+
 class RemoteDBCache(unittest.TestCase):
     def test(self):
         tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
@@ -637,8 +1512,23 @@ class RemoteDBCache(unittest.TestCase):
         config = OptionConfig(my_opts)
         db = RemoteDB(config)
         self.assertEquals(db.cache(), (True, True))
-
-        db_xml = fileopen(db.filepath(config['overlays']) + '.xml')
+        # unchanged local lists are not reported as updates
+        self.assertEquals(db.cache(), (False, True))
+
+        # updated lists are read again in one go, so parse_jobs applies
+        read = []
+        db.read_files = read.append
+        db._reload_cached_lists()
+        self.assertEqual(read, [[HERE + '/testfiles/global-overlays.xml']])
+        del db.read_files
+        db._reload_cached_lists()
+
+        # local lists are read in place instead of being copied
+        self.assertEqual(db.list_path(config['overlays']),
+                         HERE + '/testfiles/global-overlays.xml')
+        self.assertFalse(os.path.exists(db.filepath(config['overlays'])
+                                        + '.xml'))
+        db_xml = fileopen(db.list_path(config['overlays']))
 
         test_line = '      A collection of ebuilds from Gunnar Wrobel '\
                     '[wrobel@gentoo.org].\n'
@@ -651,6 +1541,294 @@ class RemoteDBCache(unittest.TestCase):
         keys = sorted(db.overlays)
         self.assertEqual(keys, ['wrobel', 'wrobel-stable'])
 
+        # a local list that cannot be read is a failure
+        my_opts['overlays'] = ['file://' + tmpdir + '/missing.xml']
+        db = RemoteDB(OptionConfig(my_opts))
+        self.assertEquals(db.cache(), (False, False))
+
+        shutil.rmtree(tmpdir)
+
+
+class SearchRemoteDB(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        cache = os.path.join(tmpdir, 'cache')
+        my_opts = {
+                   'overlays' :
+                   ['file://' + HERE + '/testfiles/global-overlays.xml'],
+                   'cache' : cache,
+                   'nocheck'    : 'yes',
+                   'proxy' : None
+                  }
+        config = OptionConfig(my_opts)
+        db = RemoteDB(config)
+        db.cache()
+        self.assertTrue(os.path.exists(db.search_path()))
+        # the index is readable like the lists, without temporary files
+        self.assertEqual(os.stat(db.search_path()).st_mode & 0o777, 0o644)
+        self.assertEqual([f for f in os.listdir(os.path.dirname(
+            db.search_path())) if f.startswith('.')], [])
+
+        names = lambda results: [name for name, score in results]
+        self.assertEqual(names(db.search('gunnar')), ['wrobel-stable'])
+        self.assertEqual(names(db.search('wrobel')),
+                         ['wrobel', 'wrobel-stable'])
+        self.assertEqual(names(db.search('wrobel', limit=1)), ['wrobel'])
+        self.assertEqual(db.search('nonexistent'), [])
+
+        # A fresh db reads the stored index.
+        db = RemoteDB(config)
+        self.assertEqual(names(db.search('gunnar')), ['wrobel-stable'])
+
+        shutil.rmtree(tmpdir)
+
+
+class SourceRetryStats(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        storage = os.path.join(tmpdir, 'storage')
+        os.mkdir(storage)
+        makeconf = os.path.join(tmpdir, 'make.conf')
+        with fileopen(makeconf, 'w') as f:
+            f.write('PORTDIR_OVERLAY="\n$PORTDIR_OVERLAY"')
+        missing = os.path.join(tmpdir, 'missing.git')
+        good = os.path.join(tmpdir, 'good')
+        subprocess.check_call(['git', 'init', '-q', good])
+        subprocess.check_call(['git', '-C', good, '-c', 'user.name=nobody',
+            '-c', 'user.email=nobody@gentoo.org', 'commit', '-q',
+            '--allow-empty', '-m', 'first'])
+        catalog = '<?xml version="1.0" ?>\n<repositories version="1.0">'\
+            '<repo quality="experimental" status="unofficial">'\
+            '<name>foo</name><description>Test</description>'\
+            '<owner><email>nobody@gentoo.org</email></owner>'\
+            '<source type="git">%s</source><source type="git">%s</source>'\
+            '</repo></repositories>' % (missing, good)
+
+        config = OptionConfig({
+                   'installed' : os.path.join(tmpdir, 'installed.xml'),
+                   'make_conf' : makeconf,
+                   'conf_type' : ['make.conf'],
+                   'check_official': False,
+                   'nocheck'   : 'yes',
+                   'storage'   : storage,
+                   'sync_retries': '2',
+                   'retry_delay': '0',
+                   'quietness' : 1,
+                  })
+        remote = DbBase(config, [])
+        remote.read(catalog, 'catalog.xml')
+
+        # the broken first source is recorded and tried last from now on
+        db = DB(config)
+        self.assertTrue(db.add(remote.select('foo')))
+        stats = db.stats.sources
+        self.assertEqual((stats[missing]['failed'], stats[good]['ok']), (1, 1))
+        self.assertEqual(db.stats.rank([missing, good]), [good, missing])
+        self.assertFalse(db.sync('foo'))
+
+        # a failing source is retried before giving up
+        shutil.move(good, good + '.away')
+        self.assertRaises(Exception, db.sync, 'foo')
+        self.assertEqual(db.stats.sources[good]['failed'], 3)
+        shutil.move(good + '.away', good)
+        self.assertFalse(DB(config).sync('foo'))
+        self.assertEqual(DB(config).stats.sources[good]['ok'], 3)
+
+        # parallel processes do not lose each other's records
+        stats = os.path.join(tmpdir, 'stats.json')
+        recorders = [subprocess.Popen([sys.executable, '-c',
+            'import sys\n'
+            'from layman.locking import LockManager, STATS_LOCK\n'
+            'from layman.output import Message\n'
+            'from layman.sourcestats import SourceStats\n'
+            'locks = LockManager(sys.argv[1], Message())\n'
+            'stats = SourceStats(sys.argv[2], Message(),\n'
+            '                    lambda: locks.lock(STATS_LOCK))\n'
+            'for run in range(25):\n'
+            '    stats.record("git://shared", True, 1.0)\n',
+            os.path.join(tmpdir, '.locks'), stats],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+            for process in range(4)]
+        for recorder in recorders:
+            self.assertEqual(recorder.wait(), 0)
+        with fileopen(stats, 'r') as data:
+            self.assertEqual(json.loads(data.read())['git://shared']['ok'],
+                             100)
+
+        shutil.rmtree(tmpdir)
+
+
+class SyncAdaptive(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        config = OptionConfig({'storage': tmpdir, 'nocheck': 'yes',
+                               'proxy': None, 'quietness': 0})
+        ovl = Overlay(config=config, ovl_dict={
+                    'name': 'wrobel',
+                    'descriptions': ['Test'],
+                    'owner_email': 'nobody@gentoo.org',
+                    'sources': [['file://' + tmpdir + '/upstream', 'git', '']],
+                   }, ignore=config['ignore'])
+        self.assertEqual(ovl.revision(tmpdir), None)
+
+        checkout = os.path.join(tmpdir, 'wrobel')
+        git = ['git', '-C', checkout, '-c', 'user.name=nobody',
+               '-c', 'user.email=nobody@gentoo.org']
+        subprocess.check_call(['git', 'init', '-q', checkout])
+        subprocess.check_call(git + ['commit', '-q', '--allow-empty',
+                                     '-m', 'first'])
+        first = ovl.revision(tmpdir)
+        self.assertEqual(len(first), 40)
+        subprocess.check_call(git + ['commit', '-q', '--allow-empty',
+                                     '-m', 'second'])
+        self.assertNotEqual(ovl.revision(tmpdir), first)
+
+        # dormant overlays back off, changing ones are synced every run
+        journal = SyncJournal(os.path.join(tmpdir, 'journal.json'), Message())
+        names = ['wrobel', 'wrobel-stable']
+        journal.record('wrobel', True, changed=False)
+        journal.record('wrobel-stable', True, changed=True)
+        runs = []
+        for run in range(6):
+            due = journal.schedule(names)
+            runs.append(due)
+            for name in due:
+                journal.record(name, True, changed=name != 'wrobel')
+        self.assertEqual(runs, [['wrobel-stable'], names, ['wrobel-stable'],
+                                ['wrobel-stable'], ['wrobel-stable'], names])
+        # a failed sync is retried on the next run
+        journal.record('wrobel', False)
+        self.assertEqual(journal.schedule(names), names)
+
+        shutil.rmtree(tmpdir)
+
+
+class SyncFailover(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        storage = os.path.join(tmpdir, 'storage')
+        os.mkdir(storage)
+        good = os.path.join(tmpdir, 'good')
+        mirror = os.path.join(tmpdir, 'mirror')
+        subprocess.check_call(['git', 'init', '-q', good])
+        subprocess.check_call(['git', '-C', good, '-c', 'user.name=nobody',
+            '-c', 'user.email=nobody@gentoo.org', 'commit', '-q',
+            '--allow-empty', '-m', 'first'])
+        subprocess.check_call(['git', 'clone', '-q', '--bare', good, mirror])
+        catalog = os.path.join(tmpdir, 'remote.xml')
+        with fileopen(catalog, 'w') as f:
+            f.write('<?xml version="1.0" ?>\n<repositories>'
+                '<repo quality="experimental" status="official">'
+                '<name>foo</name><description>Test</description>'
+                '<owner><email>nobody@gentoo.org</email></owner>'
+                '<source type="git">%s</source>'
+                '<source type="rsync">rsync://localhost/foo</source>'
+                '<source type="git">%s</source>'
+                '</repo></repositories>' % (good, mirror))
+        config = OptionConfig({'storage': storage,
+                               'installed': os.path.join(tmpdir, 'installed.xml'),
+                               'repos_conf': os.path.join(tmpdir, 'repos.conf'),
+                               'conf_type': ['repos.conf'],
+                               'overlays': ['file://' + catalog],
+                               'sync_retries': '0',
+                               'nocheck': 'yes', 'check_official': False,
+                               'proxy': None, 'quietness': 0})
+        checkout = os.path.join(storage, 'foo')
+        origin = lambda: subprocess.check_output(['git', '-C', checkout,
+            'config', 'remote.origin.url']).decode('UTF-8').strip()
+        installed = lambda: DB(config).select('foo').sources[0].src
+
+        api = LaymanAPI(config)
+        self.assertTrue(api.add_repos('foo'))
+        self.assertEqual(installed(), good)
+
+        # only the other git source is tried, and recorded once it worked
+        shutil.move(good, good + '.away')
+        self.assertTrue(LaymanAPI(config).sync('foo', output_results=False))
+        self.assertEqual((installed(), origin()), (mirror, mirror))
+        self.assertFalse('rsync://localhost/foo' in DB(config).stats.sources)
+
+        # if no source works, the checkout keeps its own
+        shutil.move(mirror, mirror + '.away')
+        self.assertFalse(LaymanAPI(config).sync('foo', output_results=False))
+        self.assertEqual((installed(), origin()), (mirror, mirror))
+
+        shutil.rmtree(tmpdir)
+
+
+class SyncJournalResume(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        path = os.path.join(tmpdir, 'sync_journal.json')
+        locks = LockManager(os.path.join(tmpdir, '.locks'), Message())
+        lock = lambda: locks.lock(JOURNAL_LOCK)
+        names = ['wrobel', 'wrobel-stable', 'foo']
+
+        journal = SyncJournal(path, Message(), lock)
+        started = journal.begin()
+        journal.record('wrobel', True)
+        journal.record('wrobel-stable', False)
+        # the run is interrupted before foo and never ended
+
+        journal = SyncJournal(path, Message(), lock)
+        self.assertEqual(journal.begin(resume=True), started)
+        self.assertEqual(journal.due(names, since=started),
+                         ['wrobel-stable', 'foo'])
+        with fileopen(path, 'r') as data:
+            entry = json.loads(data.read())['overlays']['wrobel-stable']
+        self.assertEqual(entry['result'], 'failed')
+        self.assertEqual(entry['synced'], None)
+        journal.end()
+
+        # a finished run is not resumed, max_age still applies
+        self.assertTrue(journal.begin(resume=True) > started)
+        self.assertEqual(journal.due(names, max_age=parse_age('1h')),
+                         ['wrobel-stable', 'foo'])
+        self.assertEqual(journal.due(names, max_age=0), names)
+        self.assertRaises(ValueError, parse_age, '2 weeks')
+
+        # an overlay locked by another worker is not waited for
+        holder = subprocess.Popen([sys.executable, '-c',
+            'import sys, time\n'
+            'from layman.locking import LockManager\n'
+            'from layman.output import Message\n'
+            'with LockManager(sys.argv[1], Message()).lock("overlay-foo"):\n'
+            '    print("locked")\n'
+            '    sys.stdout.flush()\n'
+            '    time.sleep(0.5)\n', os.path.join(tmpdir, '.locks')],
+            stdout=subprocess.PIPE,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.assertEqual(holder.stdout.readline().strip(), b'locked')
+        with locks.lock(overlay_lock('foo'), wait=False) as locked:
+            self.assertFalse(locked)
+        with locks.lock(overlay_lock('wrobel'), wait=False) as locked:
+            self.assertTrue(locked)
+        holder.wait()
+        holder.stdout.close()
+
+        # syncing a single overlay in between leaves the run unfinished
+        storage = os.path.join(tmpdir, 'storage')
+        os.mkdir(storage)
+        config = OptionConfig({'storage': storage,
+                               'installed': os.path.join(tmpdir, 'installed.xml'),
+                               'overlays': ['file://' + HERE +
+                                            '/testfiles/global-overlays.xml'],
+                               'nocheck': 'yes', 'proxy': None,
+                               'quietness': 0})
+        api = LaymanAPI(config)
+        journal = api._get_sync_journal()
+        started = journal.begin()
+        journal.record('wrobel', True)
+        api.sync('foo', output_results=False)
+        journal.load()
+        self.assertEqual(journal.data['run'],
+                         {'started': started, 'finished': None})
+        api.sync(names, output_results=False, resume=True, sync_all=True)
+        self.assertEqual(api.sync_skipped, ['wrobel'])
+        journal.load()
+        self.assertEqual(journal.data['run']['started'], started)
+        self.assertTrue(journal.data['run']['finished'])
+
         shutil.rmtree(tmpdir)
 
 
@@ -36,10 +36,14 @@ import copy
 import locale
 import os
 import re
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import types
 
+from  layman.compatibility  import fileopen
 from  layman.output         import Message
 
 if sys.hexversion >= 0x30200f0:
@@ -288,22 +292,37 @@ def run_command(config, command, args, **kwargs):
     return result
 
 
-def verify_overlay_src(current_src, remote_srcs):
+def command_output(config, command, args, cwd=None, timeout=None):
     '''
-    Verifies that the src-url of the overlay in
-    that database is in the set of reported src_urls
-    by the remote database.
-
-    @param current_src: current source URL.
-    @param remote_srcs: set of available sources reported by remote database.
-    @rtype tuple: returns tuple of set/str of source(s), and boolean reflecting
-    whether current_src is valid or not.
+    Runs a command quietly and returns its stripped output, None if it
+    could not be run, failed or was killed after timeout seconds.
     '''
-    if current_src not in remote_srcs:
-        # return remote_srcs and boolean
-        # stating that it's not valid.
-        return remote_srcs, False
-    return current_src, True
+    output = config['output']
+    file_to_run = resolve_command(command, output.debug)[1]
+    if not file_to_run:
+        return None
+    try:
+        proc = subprocess.Popen([file_to_run] + args, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, proc.kill)
+            timer.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+    except (IOError, OSError) as error:
+        output.debug('Utils.command_output(): %s failed: %s' % (command,
+            str(error)), 6)
+        return None
+    if proc.returncode:
+        output.debug('Utils.command_output(): %s returned %d' % (command,
+            proc.returncode), 6)
+        return None
+    return stdout.decode('UTF-8', 'replace').strip()
+
 
 def delete_empty_directory(mdir, output=None):
     # test for a usable output parameter,
@@ -325,6 +344,55 @@ def delete_empty_directory(mdir, output=None):
                 output.warn('Hint: You are not root.')
 
 
+def atomic_write(path, text):
+    '''
+    Writes text to path through a temporary file in the same directory
+    which is renamed over path, so readers never see a partial file.
+    The permissions of an existing file are kept, new files get 0644.
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
+    >>> target = os.path.join(tmpdir, 'test.conf')
+    >>> atomic_write(target, 'one')
+    >>> atomic_write(target, 'two')
+    >>> open(target).read()
+    'two'
+    >>> os.listdir(tmpdir)
+    ['test.conf']
+    >>> import shutil
+    >>> shutil.rmtree(tmpdir)
+    '''
+    if os.path.exists(path):
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    else:
+        mode = 0o644
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix='.' + os.path.basename(path) + '.')
+    try:
+        os.close(fd)
+        with fileopen(tmp, 'w') as out_file:
+            out_file.write(text)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def file_stamp(path):
+    '''
+    Returns what is compared to tell whether a file was changed since it
+    was last read or written: its (mtime, size), or None if it is missing.
+    '''
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_mtime, info.st_size)
+
+
 def create_overlay_dict(**kwargs):
     """Creates a complete empty reository definition.
     Then fills it with values passed in